@@ -3,10 +3,10 @@ Created on May 9, 2010
 
 '''
 
-from lxml import etree
 from lxml.cssselect import CSSSelector
 
 from flickr_data_miner.analyzer import  Analyzer
+from flickr_data_miner import extractor
 
 
 class CommentAnalyzer(Analyzer):
@@ -16,7 +16,11 @@ class CommentAnalyzer(Analyzer):
     CREATE_TABLES = (
                     "CREATE TABLE IF NOT EXISTS  image_comment (image_id integer REFERENCES images(id) ON DELETE CASCADE,commenter_id text,commentdate text,content text)", 
                     )
+    CREATE_INDEXES = (
+                    "CREATE INDEX IF NOT EXISTS image_comment_image_id ON image_comment (image_id)",
+                    )
     NAME = 'comments'
+    FIELDS = (extractor.COMMENTS,)
     
     def init(self):
         self._count=0
@@ -26,8 +30,7 @@ class CommentAnalyzer(Analyzer):
         self._comments = CSSSelector('.comment-content > p')
         self._dates = CSSSelector('.comment-content > p > small')
         
-    def parse_file(self, id, tag, data):
-        doc = etree.HTML(data)
+    def extract(self, id, tag, doc):
         comments = self._cs(doc)
         values = list()
         for i, c in zip(xrange(10),comments):
@@ -41,32 +44,77 @@ class CommentAnalyzer(Analyzer):
                 comment=""
                 date=""  
             values.append((id, commenter,date, comment))
-            
-        self.repository.db_conn.executemany('INSERT INTO image_comment (image_id, commenter_id,commentdate,content) VALUES (?,?,?,?)', values)
+        return values
+    
+    def extract_fields(self, id, tag, fields):
+        values = list()
+        for commenters, comments, dates in fields[extractor.COMMENTS][:10]:
+            try:
+                values.append((id, commenters[0], dates[0], comments[0]))
+            except IndexError:
+                values.append((id, "", "", ""))
+        return values
+    
+    def store(self, id, tag, values):
+        self.repository.writer.insert_many('image_comment', ('image_id', 'commenter_id', 'commentdate', 'content'), values)
         
     def do_count_all(self, line):
         """ Returns the number of all assigned comments. """
 
-        number = self.repository.db_conn.execute('SELECT COUNT(content) FROM image_comment').fetchone()
-        print 'There are %i comments assigned to images.' % number
+        print 'There are %i comments assigned to images.' % self.comment_count()
     
     def do_count_single(self, line):
-        """ Returns the number of single assigned comments. """
-        imageid = str(raw_input('Enter the image id you want to search(e.g. 12345678):'))
-        number =self.repository.db_conn.execute("SELECT COUNT(content) FROM image_comment WHERE image_id = '%s'"%imageid).fetchone()
-        print 'There are %i comments assigned to image %i' %(number[0],imageid)
+        """ Usage: count_single [image id]. Returns the number of single 
+            assigned comments. 
+        """
+        imageid = self._image_id(line)
+        if imageid is None:
+            return
+        print 'There are %i comments assigned to image %i' %(self.comment_count(imageid),imageid)
         
     
     def do_list_all(self, line):
         """ Lists all comments. """
         
-        comments = self.repository.db_conn.execute('SELECT content FROM image_comment ORDER BY image_id')
-        for comment, in comments:
+        for comment in self.comments():
             print comment
     
     def do_list_single(self, line):
-        """ Lists choosed comments. """
-        imageid = str(raw_input('Enter the image id you want to search(e.g. 12345678):'))
-        comments = self.repository.db_conn.execute("SELECT content FROM image_comment WHERE image_id = '%s'"%imageid)
-        for comment, in comments:
-            print comment
\ No newline at end of file
+        """ Usage: list_single [image id]. Lists choosed comments. """
+        imageid = self._image_id(line)
+        if imageid is None:
+            return
+        for comment in self.comments(imageid):
+            print comment
+            
+    def _image_id(self, line):
+        """ Gets the image id from the command line or asks for it. Makes 
+            sure the index for the lookup exists.
+        """
+        
+        imageid = line.strip() or raw_input('Enter the image id you want to search(e.g. 12345678):')
+        try:
+            imageid = long(imageid)
+        except ValueError:
+            print "**ERROR** %s is not an image id" % imageid
+            return None
+        # repositories initialized before the index existed
+        self.create_indexes()
+        return imageid
+    
+    # The queries of the commands. They are overridden to answer the
+    # commands for several repositories (see federation).
+    
+    def comment_count(self, image_id=None):
+        """ Number of comments (of the image <image_id>). """
+        
+        if image_id is None:
+            return self.repository.db_conn.execute('SELECT COUNT(content) FROM image_comment').fetchone()[0]
+        return self.repository.db_conn.execute("SELECT COUNT(content) FROM image_comment WHERE image_id = ?", (image_id,)).fetchone()[0]
+    
+    def comments(self, image_id=None):
+        """ The comments (of the image <image_id>), ordered by image. """
+        
+        if image_id is None:
+            return (comment for comment, in self.repository.db_conn.execute('SELECT content FROM image_comment ORDER BY image_id'))
+        return (comment for comment, in self.repository.db_conn.execute("SELECT content FROM image_comment WHERE image_id = ?", (image_id,)))
\ No newline at end of file
@@ -0,0 +1,373 @@
+'''
+Created on Nov 27, 2010
+
+'''
+
+import re, zlib
+import numpy as np
+
+from flickr_data_miner.analyzer import  Analyzer
+
+
+class DuplicateAnalyzer(Analyzer):
+    """ Finds images with nearly the same tags, e.g. the photos of a set
+        that were all tagged alike.
+
+        The similarity of two images is the Jaccard similarity of their tag
+        sets (optionally together with the shingles, i.e. the word
+        triples, of their comments). It is estimated by MinHash signatures
+        and only images that share a band of their signatures (LSH) are
+        compared, so not every pair of images has to be compared. The tags
+        and shingles are hashed by their text, so the signatures do not
+        depend on the ids of a repository.
+
+        Two images whose similarity reaches the threshold are put into the
+        same cluster, represented by its image with the smallest id. The
+        other images of the clusters can be excluded from the TDMs (see
+        PCAAnalyzer).
+
+        The signatures and clusters are computed from the tables of the
+        tags and comments analyzers once all pages are stored, so this
+        analyzer must come after them and does not read the pages itself.
+    """
+
+    TABLES = ("minhash", "lsh_bucket", "duplicate")
+    CREATE_TABLES = (
+                    "CREATE TABLE IF NOT EXISTS minhash (image_id integer PRIMARY KEY, signature blob)",
+                    "CREATE TABLE IF NOT EXISTS lsh_bucket (band integer, bucket integer, image_id integer)",
+                    "CREATE TABLE IF NOT EXISTS duplicate (image_id integer PRIMARY KEY, cluster integer)",
+                    )
+    CREATE_INDEXES = (
+                    "CREATE INDEX IF NOT EXISTS lsh_bucket_bucket ON lsh_bucket (band, bucket)",
+                    "CREATE INDEX IF NOT EXISTS lsh_bucket_image_id ON lsh_bucket (image_id)",
+                    "CREATE INDEX IF NOT EXISTS duplicate_cluster ON duplicate (cluster)",
+                    )
+    NAME = 'duplicates'
+    NEEDS_PAGES = False
+
+    # the signatures have BANDS * ROWS hash values. Images with a
+    # similarity of 0.8 share a band with a probability of 99.9 %, images
+    # with 0.3 with 4.7 %.
+    BANDS = 20
+    ROWS = 5
+    # the hash functions are (a * x + b) mod PRIME
+    PRIME = 2**31 - 1
+    SEED = 1
+
+    THRESHOLD = 0.8
+    # pairs whose estimated similarity is this much below the threshold are
+    # still compared exactly (the estimate has a standard deviation of
+    # about 0.04 at 0.8)
+    MARGIN = 0.15
+    # smaller sets say little about the images (e.g. only the searched tag)
+    MIN_ELEMENTS = 3
+    # number of rows read from the DB at once
+    FETCH_SIZE = 10000
+
+    # settings in the repository info
+    THRESHOLD_KEY = 'duplicates:threshold'
+    COMMENTS_KEY = 'duplicates:comments'
+    EXCLUDE_KEY = 'duplicates:exclude'
+
+    def init(self):
+        random = np.random.RandomState(self.SEED)
+        hashes = self.BANDS * self.ROWS
+        self._a = random.randint(1, self.PRIME, hashes).astype(np.int64)
+        self._b = random.randint(0, self.PRIME, hashes).astype(np.int64)
+
+    def remove(self):
+        super(DuplicateAnalyzer, self).remove()
+        self.repository.db_conn.execute('DELETE FROM repository_info WHERE key IN (?,?,?)',
+                                        (self.THRESHOLD_KEY, self.COMMENTS_KEY, self.EXCLUDE_KEY))
+
+    @property
+    def threshold(self):
+        return float(self.repository.get_info(self.THRESHOLD_KEY, self.THRESHOLD))
+
+    @property
+    def with_comments(self):
+        return self.repository.get_info(self.COMMENTS_KEY) == '1'
+
+    @property
+    def excluded(self):
+        """ Whether the duplicates are excluded from the TDMs. """
+
+        return self.repository.get_info(self.EXCLUDE_KEY) == '1'
+
+    def finish(self):
+        """ Computes the signatures, the LSH buckets and the clusters of
+            all images (new pages can change every cluster).
+        """
+
+        # the rows of the other analyzers might still be buffered
+        self.repository.writer.flush()
+        self.detect()
+
+    def detect(self):
+        """ Computes the signatures, the LSH buckets and the clusters. """
+
+        db = self.repository.db_conn
+        images = np.array([id for id, in db.execute('SELECT id FROM images ORDER BY id')], dtype=np.int64)
+        signatures, offsets, elements = self.signatures(images)
+        selected = np.flatnonzero(np.diff(offsets) >= self.MIN_ELEMENTS)
+        images, signatures = images[selected], signatures[selected]
+        sets = [elements[offsets[i]:offsets[i + 1]] for i in selected]
+        buckets = self._buckets(signatures)
+        clusters = self._clusters(signatures, buckets, sets)
+
+        for table in self.TABLES:
+            db.execute('DELETE FROM ' + table)
+        db.executemany('INSERT INTO minhash (image_id, signature) VALUES (?,?)',
+                       ((long(id), buffer(signature.tostring())) for id, signature in zip(images, signatures)))
+        db.executemany('INSERT INTO lsh_bucket (band, bucket, image_id) VALUES (?,?,?)',
+                       ((band, long(bucket), long(images[i])) for band in xrange(self.BANDS)
+                        for i, bucket in enumerate(buckets[:, band])))
+        in_cluster = clusters != np.arange(len(images))
+        in_cluster[clusters[in_cluster]] = True
+        db.executemany('INSERT INTO duplicate (image_id, cluster) VALUES (?,?)',
+                       ((long(images[i]), long(images[clusters[i]])) for i in np.flatnonzero(in_cluster)))
+        db.commit()
+
+    def signatures(self, images):
+        """ Computes the MinHash signatures of the images.
+
+            INPUT:
+                - images: The sorted ids of the images.
+
+            OUTPUT:
+                A tuple (signatures, offsets, elements): an array of images 
+                x hashes and the sets of the images, the sorted elements of 
+                image i are elements[offsets[i]:offsets[i + 1]].
+        """
+
+        signatures = np.empty((len(images), self.BANDS * self.ROWS), dtype=np.uint32)
+        signatures.fill(self.PRIME)
+        parts = []
+
+        db = self.repository.db_conn
+        tags = db.execute('SELECT id, name FROM tag ORDER BY id').fetchall()
+        tag_ids = np.array([id for id, _ in tags], dtype=np.int64)
+        tag_hashes = np.array([self._hash(name) for _, name in tags], dtype=np.int64)
+        cursor = db.execute('SELECT image_id, tag_id FROM image_tag')
+        while True:
+            rows = cursor.fetchmany(self.FETCH_SIZE)
+            if not rows:
+                break
+            rows = np.array(rows, dtype=np.int64)
+            parts.append(self._add_elements(signatures, images, rows[:, 0],
+                                            tag_hashes[np.searchsorted(tag_ids, rows[:, 1])]))
+
+        if self.with_comments:
+            cursor = self.repository.db_conn.execute('SELECT image_id, content FROM image_comment')
+            while True:
+                rows = cursor.fetchmany(self.FETCH_SIZE)
+                if not rows:
+                    break
+                ids, shingles = [], []
+                for image_id, comment in rows:
+                    for shingle in self._shingles(comment):
+                        ids.append(image_id)
+                        shingles.append(shingle)
+                parts.append(self._add_elements(signatures, images, np.array(ids, dtype=np.int64),
+                                                np.array(shingles, dtype=np.int64)))
+
+        documents = np.concatenate([np.zeros(0, dtype=np.int64)] + [d for d, _ in parts])
+        elements = np.concatenate([np.zeros(0, dtype=np.int64)] + [e for _, e in parts])
+        order = np.lexsort((elements, documents))
+        documents, elements = documents[order], elements[order]
+        # an element can occur twice, e.g. a shingle in two comments
+        unique = np.r_[True, (documents[1:] != documents[:-1]) | (elements[1:] != elements[:-1])]
+        documents, elements = documents[unique], elements[unique]
+        offsets = np.searchsorted(documents, np.arange(len(images) + 1))
+        return signatures, offsets, elements
+
+    def _hash(self, text):
+        """ A hash of a tag or a shingle that does not depend on the
+            repository.
+        """
+
+        if isinstance(text, unicode):
+            text = text.encode('utf-8')
+        return zlib.crc32(text) & 0xffffffff
+
+    def _shingles(self, comment):
+        """ Hashes of the word triples of a comment (without the date). """
+
+        words = [word for word in re.split("[^\w']+", comment.lower()[:comment.rfind('Posted')]) if word]
+        # the bit above the hash keeps shingles and tags apart
+        return [self._hash(' '.join(words[i:i+3])) | 2**32 for i in xrange(max(len(words) - 2, 0))]
+
+    def _add_elements(self, signatures, images, ids, elements):
+        """ Adds the elements of the sets of the images <ids> to the
+            signatures.
+
+            OUTPUT:
+                A tuple (documents, elements), the indexes of the images 
+                and their elements, without the unknown images.
+        """
+
+        documents = np.searchsorted(images, ids)
+        known = images[np.minimum(documents, len(images) - 1)] == ids if len(images) else np.zeros(len(ids), dtype=bool)
+        documents, elements = documents[known], elements[known]
+        if not len(documents):
+            return documents, elements
+        order = np.argsort(documents, kind='mergesort')
+        documents, elements = documents[order], elements[order]
+        hashes = (self._a * (elements[:, np.newaxis] % self.PRIME) + self._b) % self.PRIME
+        starts = np.flatnonzero(np.r_[True, documents[1:] != documents[:-1]])
+        first = documents[starts]
+        signatures[first] = np.minimum(signatures[first], np.minimum.reduceat(hashes, starts, axis=0))
+        return documents, elements
+
+    def _buckets(self, signatures):
+        """ Numbers the distinct bands of the signatures.
+
+            OUTPUT:
+                An array of images x bands, images with the same number in
+                a band share the band.
+        """
+
+        buckets = np.empty((len(signatures), self.BANDS), dtype=np.int64)
+        for band in xrange(self.BANDS):
+            rows = np.ascontiguousarray(signatures[:, band * self.ROWS:(band + 1) * self.ROWS])
+            keys = rows.view(np.dtype((np.void, rows.dtype.itemsize * self.ROWS))).ravel()
+            buckets[:, band] = np.unique(keys, return_inverse=True)[1]
+        return buckets
+
+    def _clusters(self, signatures, buckets, sets):
+        """ Groups the images whose similarity reaches the threshold. 
+            Within a bucket, every image is only compared to the first one,
+            so the comparisons grow linearly with the size of the buckets.
+            The pairs whose estimated similarity is close enough to the 
+            threshold are compared exactly by their sets.
+
+            OUTPUT:
+                The cluster of every image, i.e. the index of its first
+                image.
+        """
+
+        parent = np.arange(len(signatures))
+        def find(i):
+            while parent[i] != i:
+                parent[i] = parent[parent[i]]
+                i = parent[i]
+            return i
+
+        threshold = self.threshold
+        for band in xrange(self.BANDS):
+            order = np.argsort(buckets[:, band], kind='mergesort')
+            ordered = buckets[order, band]
+            starts = np.flatnonzero(np.r_[True, ordered[1:] != ordered[:-1]])
+            for start, end in zip(starts, np.r_[starts[1:], len(order)]):
+                if end - start < 2:
+                    continue
+                first, others = order[start], order[start + 1:end]
+                candidates = others[(signatures[others] == signatures[first]).mean(axis=1) >= threshold - self.MARGIN]
+                for other in candidates:
+                    common = len(np.intersect1d(sets[first], sets[other], assume_unique=True))
+                    if common / float(len(sets[first]) + len(sets[other]) - common) < threshold:
+                        continue
+                    a, b = find(first), find(other)
+                    if a != b:
+                        parent[max(a, b)] = min(a, b)
+        return np.array([find(i) for i in xrange(len(parent))], dtype=np.int64)
+
+    def similarity(self, id, other):
+        """ The estimated similarity of two images or None if one of them
+            has no signature.
+        """
+
+        rows = dict(self.repository.db_conn.execute('SELECT image_id, signature FROM minhash WHERE image_id IN (?,?)', (id, other)))
+        if id not in rows or other not in rows:
+            return None
+        return (np.frombuffer(rows[id], dtype=np.uint32) == np.frombuffer(rows[other], dtype=np.uint32)).mean()
+
+    def do_count(self, line):
+        """ Shows the number of clusters of near-duplicates. """
+
+        clusters, images = self.repository.db_conn.execute('SELECT COUNT(DISTINCT cluster), COUNT(image_id) FROM duplicate').fetchone()
+        print 'There are %i clusters of near-duplicates with %i images (similarity >= %.2f%s).' % (clusters, images,
+                self.threshold, ', tags and comments' if self.with_comments else '')
+        print '%i images are %s from the TDMs.' % (images - clusters, 'excluded' if self.excluded else 'not excluded')
+
+    def do_list_clusters(self, line):
+        """ Usage: list_clusters [NUMBER]. Lists the largest clusters of
+            near-duplicates with the tags of their first image.
+        """
+
+        max = 10
+        if line:
+            try:
+                max = int(line)
+            except ValueError:
+                pass
+
+        db = self.repository.db_conn
+        clusters = db.execute('SELECT cluster, COUNT(image_id) FROM duplicate GROUP BY cluster ORDER BY COUNT(image_id) DESC, cluster ASC LIMIT ?', (max,)).fetchall()
+        if not clusters:
+            print 'No near-duplicates found.'
+            return
+
+        print '\nThese are the %i largest clusters of near-duplicates:\n' % len(clusters)
+        for i, (cluster, count) in enumerate(clusters, start=1):
+            members = [id for id, in db.execute('SELECT image_id FROM duplicate WHERE cluster = ? ORDER BY image_id', (cluster,))]
+            tags = [name for name, in db.execute('SELECT name FROM image_tag JOIN tag ON tag_id = id WHERE image_id = ? ORDER BY name', (cluster,))]
+            print '%i. %i images: %s' % (i, count, ', '.join(str(id) for id in members))
+            print '   tags: %s' % ', '.join(tags)
+        print ''
+
+    def do_similar(self, line):
+        """ Usage: similar IMAGE_ID. Lists the images that are similar to
+            an image, with their estimated similarity.
+        """
+
+        try:
+            id = int(line)
+        except ValueError:
+            print "**ERROR** Usage: similar IMAGE_ID"
+            return
+
+        # only the images that share a band are compared
+        candidates = [other for other, in self.repository.db_conn.execute(
+                        'SELECT DISTINCT b.image_id FROM lsh_bucket a JOIN lsh_bucket b ON a.band = b.band AND a.bucket = b.bucket '
+                        'WHERE a.image_id = ? AND b.image_id != ?', (id, id))]
+        similar = sorted(((self.similarity(id, other), other) for other in candidates), reverse=True)
+        similar = [(similarity, other) for similarity, other in similar if similarity >= self.threshold]
+        if not similar:
+            print 'No images are similar to image %i.' % id
+        for similarity, other in similar:
+            print '- %i %.2f' % (other, similarity)
+
+    def do_detect(self, line):
+        """ Usage: detect [THRESHOLD] [comments]. Finds the near-duplicates
+            again with another threshold (default: 0.8) and with the
+            comments or only the tags.
+        """
+
+        parts = line.split()
+        threshold = self.THRESHOLD
+        for part in parts:
+            if part != 'comments':
+                try:
+                    threshold = float(part)
+                except ValueError:
+                    print "**ERROR** Usage: detect [THRESHOLD] [comments]"
+                    return
+        self.repository.set_info(self.THRESHOLD_KEY, str(threshold))
+        self.repository.set_info(self.COMMENTS_KEY, '1' if 'comments' in parts else '0')
+        self.detect()
+        self.do_count('')
+
+    def do_exclude(self, line):
+        """ Usage: exclude [on|off]. Whether the near-duplicates are left
+            out of the TDMs (all but the first image of each cluster).
+        """
+
+        line = line.strip()
+        if line in ('on', 'off'):
+            self.repository.set_info(self.EXCLUDE_KEY, '1' if line == 'on' else '0')
+            self.repository.db_conn.commit()
+        elif line:
+            print "**ERROR** Usage: exclude [on|off]"
+            return
+        print 'Near-duplicates are %s the TDMs.' % ('excluded from' if self.excluded else 'included in')
@@ -5,7 +5,22 @@ Created on Jun 6, 2010
 '''
 
 import numpy as np
-import itertools, math
+import itertools, math, array, os, tempfile, zlib
+
+try:
+    import scipy.sparse as sp
+except ImportError: # the sparse backend is not available
+    sp = None
+
+# matrices with more cells use the sparse backend by default (if available)
+SPARSE_THRESHOLD = 10**7
+
+# memory (bytes) out-of-core matrices may use for the documents processed at
+# once
+MEMORY_BUDGET = 256 * 2**20
+# copies of a chunk of documents that exist at the same time while it is
+# processed (the chunk and temporary results)
+CHUNK_COPIES = 4
 
 
 class TDMBuilder(object):
@@ -15,6 +30,20 @@ class TDMBuilder(object):
         INPUT:
             - terms: The terms that are used in the matrix
             - documents: Document IDs
+            - backend: How the matrix is stored:
+                - 'dense': A NumPy matrix of terms x documents.
+                - 'sparse': The terms are collected as coordinates and 
+                  the matrix is a SciPy CSR matrix. Needs scipy.
+                - 'memmap': Out-of-core, the matrix is a NumPy memmap in a
+                  temporary file. Weighting and PCA process it in chunks of
+                  documents that fit into <budget>.
+                - None: Sparse if the matrix has more than SPARSE_THRESHOLD 
+                  cells and scipy is available, memmap if scipy is not 
+                  available and the matrix does not fit into <budget>, 
+                  dense otherwise.
+            - budget: Memory (bytes) for the chunks of out-of-core matrices.
+            - directory: Directory of the temporary files of out-of-core 
+                         matrices (default: the system's temporary directory).
         
         Currently supported weighting schemes:
          
@@ -44,8 +73,12 @@ class TDMBuilder(object):
     GLOBAL_LDF = 3
     GLOBAL_ENTROPY = 4
     
+    BACKEND_DENSE = 'dense'
+    BACKEND_SPARSE = 'sparse'
+    BACKEND_MEMMAP = 'memmap'
+    
     
-    def __init__(self, terms, documents):       
+    def __init__(self, terms, documents, backend=None, budget=MEMORY_BUDGET, directory=None):       
         self.terms = list(terms)
         self.documents = list(documents)
         
@@ -56,7 +89,9 @@ class TDMBuilder(object):
         self.terms_len = len(self.terms)
         self.documents_len = len(self.documents)
         
-        self.TF = np.matrix(np.zeros((self.terms_len, self.documents_len), dtype=np.float64))
+        self.budget = budget
+        self.directory = directory
+        self._create_matrix(backend)
         
         # method lookup table
         self.localm = [self.local_binary, self.local_term_frequency, 
@@ -64,6 +99,51 @@ class TDMBuilder(object):
         
         self.globalm = [self.global_binary, self.global_normal, 
                          self.global_gfldf, self.global_ldf, self.global_entropy]       
+        
+    def _create_matrix(self, backend):
+        """ Chooses the backend (see above) and creates the empty matrix of
+            terms_len x documents_len.
+        """
+        
+        if backend is None:
+            cells = self.terms_len * self.documents_len
+            if sp is not None and cells > SPARSE_THRESHOLD:
+                backend = TDMBuilder.BACKEND_SPARSE
+            elif sp is None and cells * 8 > self.budget:
+                backend = TDMBuilder.BACKEND_MEMMAP
+            else:
+                backend = TDMBuilder.BACKEND_DENSE
+        if backend == TDMBuilder.BACKEND_SPARSE and sp is None:
+            raise ImportError("The sparse backend needs scipy.")
+        self.backend = backend
+        
+        if self.backend == TDMBuilder.BACKEND_SPARSE:
+            # coordinates of the terms added since the matrix was last built
+            # (and their values, once values other than 1 were added)
+            self._rows = array.array('l')
+            self._cols = array.array('l')
+            self._values = None
+            self._TF = sp.csr_matrix((self.terms_len, self.documents_len), dtype=np.float64)
+        elif self.backend == TDMBuilder.BACKEND_MEMMAP:
+            self._TF = _memmap((self.terms_len, self.documents_len), self.directory)
+        else:
+            self._TF = np.matrix(np.zeros((self.terms_len, self.documents_len), dtype=np.float64))
+    
+    @property
+    def TF(self):
+        """ The term frequency matrix. """
+        
+        if self.backend == TDMBuilder.BACKEND_SPARSE and self._rows:
+            # sum up the collected coordinates (duplicates are added)
+            values = np.ones(len(self._rows)) if self._values is None else np.frombuffer(self._values)
+            coo = sp.coo_matrix((values, 
+                                 (np.frombuffer(self._rows, dtype='l'), np.frombuffer(self._cols, dtype='l'))),
+                                shape=(self.terms_len, self.documents_len))
+            self._TF = self._TF + coo.tocsr()
+            self._rows = array.array('l')
+            self._cols = array.array('l')
+            self._values = None
+        return self._TF
     
     def getTF(self):
         """ Returns the current term frequency matrix."""
@@ -73,7 +153,11 @@ class TDMBuilder(object):
         """ Add a term to the document vector. """
         
         if term in self.terms_set: 
-            self.TF[self.terms_set[term],self.documents_set[document]] += 1
+            if self.backend == TDMBuilder.BACKEND_SPARSE:
+                self._rows.append(self.terms_set[term])
+                self._cols.append(self.documents_set[document])
+            else:
+                self._TF[self.terms_set[term],self.documents_set[document]] += 1
         
     def add_document_terms(self, document, terms):
         """ Add multiple terms to the document vector."""
@@ -81,11 +165,49 @@ class TDMBuilder(object):
         d = self.documents_set[document]
         for term in terms:
             if term in self.terms_set: 
-                self.TF[self.terms_set[term],d] += 1
+                if self.backend == TDMBuilder.BACKEND_SPARSE:
+                    self._rows.append(self.terms_set[term])
+                    self._cols.append(d)
+                else:
+                    self._TF[self.terms_set[term],d] += 1
+                
+    def add_indices(self, terms, documents, values=None):
+        """ Adds many terms at once. 
+        
+            INPUT:
+                - terms: Sequence (or NumPy array) of term indices, i.e. 
+                         positions in the list of terms.
+                - documents: Sequence of document indices of the same 
+                             length.
+                - values: Sequence of the values that are added to the 
+                          cells (default: 1 each).
+        """
+        
+        terms = np.asarray(terms, dtype='l')
+        documents = np.asarray(documents, dtype='l')
+        if self.backend == TDMBuilder.BACKEND_SPARSE:
+            if values is not None and self._values is None:
+                self._values = array.array('d', [1.]) * len(self._rows)
+            if self._values is not None:
+                values = np.ones(len(terms)) if values is None else np.asarray(values, dtype=np.float64)
+                self._values.fromstring(values.tostring())
+            self._rows.fromstring(terms.tostring())
+            self._cols.fromstring(documents.tostring())
+        else:
+            # unlike +=, add.at adds repeated indices multiple times
+            np.add.at(np.asarray(self._TF), (terms, documents), 1 if values is None else np.asarray(values))
                 
     def build_matrix(self, matrix=None, localw=None, globalw=None):
         """ Build the matrix using the specified local and global weighting 
             functions (default: binary).
+            
+            All weights are computed with whole-array operations. Terms that
+            do not occur in any document get a global weight of 0 (their 
+            row is empty anyway).
+            
+            Sparse matrices stay sparse, except for the augmented normal 
+            local weight, which is non-zero for every cell. Out-of-core 
+            matrices result in a new out-of-core matrix.
         """
 
         localw = localw if localw is not None else TDMBuilder.LOCAL_BINARY
@@ -93,91 +215,411 @@ class TDMBuilder(object):
         
         A = matrix if matrix is not None else self.TF
         
+        if localw == TDMBuilder.LOCAL_TERM_FREQUENCY and globalw == TDMBuilder.GLOBAL_BINARY:
+            return A
+        
+        if _out_of_core(A):
+            # the global weights need the whole matrix, then the weighted 
+            # matrix is written document chunk by document chunk
+            g = self.globalm[globalw](A)
+            W = _memmap(A.shape, self.directory)
+            for s, chunk in _column_chunks(A, self.budget):
+                W[:, s] = self.localm[localw](chunk) * g[:, np.newaxis]
+            return W
+        
         # increases performance for simple binary term document matrix
         # (no need to traverse the matrix)
         if localw == TDMBuilder.LOCAL_BINARY and globalw == TDMBuilder.GLOBAL_BINARY:
             return A.astype(np.bool)
         
-        if localw == TDMBuilder.LOCAL_TERM_FREQUENCY and globalw == TDMBuilder.GLOBAL_BINARY:
-            return A
+        if _issparse(A):
+            # the matrix may be read-only (a cached TDM is memory-mapped)
+            A = sp.csr_matrix(A, dtype=np.float64, copy=True)
+            A.eliminate_zeros()
+        else:
+            A = np.asarray(A, dtype=np.float64)
+        L = self.localm[localw](A)
+        g = self.globalm[globalw](A)
+        if _issparse(L):
+            return sp.diags(g, 0) * L
+        return np.matrix(L * g[:, np.newaxis])
+    
+    def local_binary(self, matrix):
+        if _issparse(matrix):
+            return _map_data(matrix, lambda data: (data != 0).astype(np.float64))
+        return (matrix != 0).astype(np.float64)
+    
+    def local_term_frequency(self, matrix):
+        return matrix
+    
+    def local_log(self, matrix):
+        if _issparse(matrix):
+            return _map_data(matrix, lambda data: np.log(data + 1))
+        return np.log(matrix + 1)
+    
+    def local_augnorm(self, matrix):
+        if _issparse(matrix): # zeros get a weight of 0.5, the result is dense
+            matrix = matrix.toarray()
+        # empty documents have no maximum and result in NaN, as before
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return ((matrix / matrix.max(axis=0)) + 1) / 2
+    
+    def global_binary(self, matrix):
+        return np.ones(matrix.shape[0])
+    
+    def global_normal(self, matrix):
+        if _issparse(matrix):
+            return np.sqrt(_divide(1., _row_sum(matrix.multiply(matrix))))
+        return np.sqrt(_divide(1., _row_reduce(matrix, lambda chunk: (chunk**2).sum(axis=1), self.budget)))
+    
+    def global_gfldf(self, matrix):
+        return _divide(_row_sum(matrix, self.budget), _row_nnz(matrix, self.budget))
+    
+    def global_ldf(self, matrix):
+        df = _row_nnz(matrix, self.budget)
+        return np.where(df > 0, 1 + np.log2(_divide(float(matrix.shape[1]), df)), 0.)
+    
+    def global_entropy(self, matrix):
+        gf = _row_nnz(matrix, self.budget)
+        if _issparse(matrix):
+            rows = np.repeat(np.arange(matrix.shape[0]), np.diff(matrix.indptr))
+            P = _divide(matrix.data, gf[rows])
+            with np.errstate(divide='ignore', invalid='ignore'):
+                PlogP = np.where(P > 0, P * np.log(P), 0.)
+            PlogP = np.bincount(rows, weights=PlogP, minlength=matrix.shape[0])
+        else:
+            def plogp(chunk):
+                P = _divide(chunk, gf[:, np.newaxis])
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    return np.where(P > 0, P * np.log(P), 0.).sum(axis=1)
+            PlogP = _row_reduce(matrix, plogp, self.budget)
+        return 1 - PlogP / math.log(matrix.shape[1])
+    
+
+class HashingTDMBuilder(TDMBuilder):
+    """ Builds TDMs without a list of terms: every term is hashed (CRC32)
+        to one of <buckets> rows. The matrix has a fixed size, no lexicon 
+        is needed and terms are mapped to rows without a lookup, distinct
+        terms in bulk. Different terms can share a row.
         
-        # store local references to functions for fast access
-        localm = self.localm[localw]
-        globalm = self.globalm[globalw]
+        With <signed>, a term adds 1 or -1 to its row, depending on another
+        bit of its hash. Collisions then cancel out on average instead of 
+        adding up. The weighting functions are applied to the magnitudes
+        of the counts, the weighted cells keep the signs.
         
-        M = np.matrix(np.zeros((self.terms_len, self.documents_len)))
-        for i in xrange(self.terms_len):
-            for j in xrange(self.documents_len):
-                M[i,j] =  localm(i,j, self.TF[i,j], A)
-            M[i] *= globalm(i, A)
-        return M
+        INPUT:
+            - buckets: Number of rows (less than 2**31).
+            - documents: Document IDs
+            - signed: Use the signed hash.
+            - backend, budget, directory: See TDMBuilder.
+    """
     
-    def local_binary(self, i, j, t, matrix):
-        return 0 if not t else 1
+    SIGN_BIT = 2**31
     
-    def local_term_frequency(self, i, j, t, matrix):
-        return t
+    def __init__(self, buckets, documents, signed=False, backend=None, budget=MEMORY_BUDGET, directory=None):
+        if not 0 < buckets < self.SIGN_BIT:
+            raise Exception("The number of buckets must be between 1 and 2**31.")
+        TDMBuilder.__init__(self, (), documents, backend, budget, directory)
+        self.buckets = buckets
+        self.signed = signed
+        # the rows are the buckets (the matrix of no terms is replaced)
+        self.terms_len = buckets
+        self._create_matrix(backend)
+        
+    def hash_terms(self, terms):
+        """ Maps terms (str or unicode) to rows. Every distinct term is 
+            hashed once.
+        
+            OUTPUT:
+                A tuple (rows, signs) of NumPy arrays with an entry per 
+                term. The signs are all 1 if the hash is not signed.
+        """
+        
+        # unicode terms are hashed as UTF-8
+        terms = np.array([t.encode('utf-8') if isinstance(t, unicode) else t for t in terms], dtype=object)
+        if not len(terms):
+            return np.empty(0, dtype='l'), np.empty(0)
+        unique, inverse = np.unique(terms, return_inverse=True)
+        hashes = np.fromiter((zlib.crc32(t) & 0xffffffff for t in unique), dtype=np.int64, count=len(unique))
+        rows = (hashes % self.buckets)[inverse]
+        if self.signed:
+            signs = np.where(hashes & self.SIGN_BIT, -1., 1.)[inverse]
+        else:
+            signs = np.ones(len(terms))
+        return rows, signs
     
-    def local_log(self, i, j, t, matrix):
-        return math.log(t + 1)
+    def add_terms(self, terms, documents):
+        """ Adds many terms at once.
+        
+            INPUT:
+                - terms: Sequence of terms.
+                - documents: Sequence of document indices of the same 
+                             length.
+        """
+        
+        rows, signs = self.hash_terms(terms)
+        self.add_indices(rows, documents, signs if self.signed else None)
     
-    def local_augnorm(self, i, j, t, matrix, d={}): # use d to simulate a static variable
-        m = d.setdefault(j, matrix[:,j].max())
-        return ((t/m) + 1) / 2
+    def add_document_term(self, document, term):
+        """ Add a term to the document vector. """
+        
+        self.add_terms([term], [self.documents_set[document]])
+        
+    def add_document_terms(self, document, terms):
+        """ Add multiple terms to the document vector."""
+        
+        terms = list(terms)
+        self.add_terms(terms, [self.documents_set[document]] * len(terms))
     
-    def global_binary(self, i, j):
-        return 1
+    def build_matrix(self, matrix=None, localw=None, globalw=None):
+        """ See TDMBuilder.build_matrix. Signed counts are weighted by their
+            magnitude.
+        """
+        
+        A = matrix if matrix is not None else self.TF
+        if not self.signed or (localw == TDMBuilder.LOCAL_TERM_FREQUENCY and 
+                               (globalw or TDMBuilder.GLOBAL_BINARY) == TDMBuilder.GLOBAL_BINARY):
+            return TDMBuilder.build_matrix(self, A, localw, globalw)
+        W = TDMBuilder.build_matrix(self, _abs(A, self.directory, self.budget), localw, globalw)
+        return _with_signs(W, A, self.budget)
+    
+
+def _issparse(matrix):
+    return sp is not None and sp.issparse(matrix)
+
+def _out_of_core(matrix):
+    return isinstance(matrix, np.memmap)
+
+def _memmap(shape, directory=None):
+    """ Creates a float64 matrix of zeros in a temporary file. The matrix 
+        is stored column by column, so ranges of documents are contiguous.
+        The file is removed right away, the data stays available until the
+        matrix is released.
+    """
+    
+    if not shape[0] or not shape[1]: # empty files cannot be mapped
+        return np.zeros(shape, order='F')
+    fd, path = tempfile.mkstemp(suffix='.tdm', dir=directory)
+    os.close(fd)
+    try:
+        return np.memmap(path, dtype=np.float64, mode='w+', shape=shape, order='F')
+    finally:
+        os.remove(path)
+
+def _column_chunks(matrix, budget=MEMORY_BUDGET):
+    """ Iterates over ranges of documents (columns) of an out-of-core 
+        matrix, such that about CHUNK_COPIES copies of a range fit into 
+        <budget> bytes. Yields tuples (slice, array). Matrices in memory 
+        are returned as a single chunk.
+    """
+    
+    terms, documents = matrix.shape
+    if not _out_of_core(matrix):
+        yield slice(0, documents), np.asarray(matrix)
+        return
+    step = max(budget // (8 * CHUNK_COPIES * max(terms, 1)), 1)
+    for start in xrange(0, documents, step):
+        s = slice(start, min(start + step, documents))
+        yield s, np.asarray(matrix[:, s], dtype=np.float64)
+
+def _row_reduce(matrix, f, budget=MEMORY_BUDGET):
+    """ Sums up f(chunk), a value per row, over the document chunks. """
+    
+    result = np.zeros(matrix.shape[0])
+    for _, chunk in _column_chunks(matrix, budget):
+        result += np.asarray(f(chunk)).ravel()
+    return result
+
+def _map_data(matrix, f):
+    """ Applies f to the stored values of a sparse matrix. """
     
-    def global_normal(self, i, matrix):
-        sum = 0.
-        for j in xrange(self.documents_len):
-            sum += matrix[i,j]**2
-        return math.sqrt(1/sum)
+    result = matrix.copy()
+    result.data = f(result.data)
+    return result
+
+def _row_sum(matrix, budget=MEMORY_BUDGET):
+    if _out_of_core(matrix):
+        return _row_reduce(matrix, lambda chunk: chunk.sum(axis=1), budget)
+    return np.asarray(matrix.sum(axis=1)).ravel()
+
+def _row_nnz(matrix, budget=MEMORY_BUDGET):
+    """ Number of non-zero entries per row. """
     
-    def global_gfldf(self, i, matrix):
-        r = matrix[i]
-        return float(r.sum())/r.astype(np.bool).sum()
+    if _issparse(matrix):
+        return np.diff(sp.csr_matrix(matrix).indptr)
+    return _row_reduce(matrix, lambda chunk: (chunk != 0).sum(axis=1), budget)
     
-    def global_ldf(self, i, matrix):
-        return 1 + math.log(float(self.documents_len)/matrix[i].astype(np.bool).sum(), 2)
+
+def _abs(matrix, directory=None, budget=MEMORY_BUDGET):
+    """ Magnitudes of the cells, out-of-core matrices result in a new 
+        out-of-core matrix.
+    """
     
-    def global_entropy(self, i, matrix):
-        gf = float(matrix[i].astype(np.bool).sum())
-        sum = 0.
-        logn = math.log(self.documents_len)
-        for j in xrange(self.documents_len):
-            t = matrix[i,j]
-            if t > 0:
-                p = t / gf
-                sum += (p * math.log(p)) / logn
-        return 1 - sum
+    if _issparse(matrix):
+        return abs(matrix)
+    if _out_of_core(matrix):
+        result = _memmap(matrix.shape, directory)
+        for s, chunk in _column_chunks(matrix, budget):
+            result[:, s] = np.abs(chunk)
+        return result
+    return np.abs(np.asarray(matrix))
+
+def _with_signs(W, A, budget=MEMORY_BUDGET):
+    """ Negates the cells of the weighted matrix W where the matrix A is 
+        negative. Out-of-core matrices are changed in place.
+    """
+    
+    if _out_of_core(W):
+        for s, chunk in _column_chunks(A, budget):
+            W[:, s] = np.where(chunk < 0, -W[:, s], W[:, s])
+        return W
+    if _issparse(W):
+        W = sp.csr_matrix(W, dtype=np.float64)
+        return W - 2 * W.multiply(sp.csr_matrix(A) < 0)
+    A = A.toarray() if _issparse(A) else np.asarray(A)
+    W = np.asarray(W, dtype=np.float64)
+    return np.matrix(np.where(A < 0, -W, W))
+    
+
+def _divide(a, b):
+    """ Element-wise division that results in 0 where b is 0. """
+    
+    b = np.asarray(b, dtype=np.float64)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(b != 0, np.true_divide(a, b), 0.)
     
 
-def compute_pca(M, dim=2):
+def compute_pca(M, dim=2, solver=None, budget=MEMORY_BUDGET):
     """ This method computes the PCA. 
     
+        Only the first <dim> principal components are computed. The sign of
+        each component is chosen such that its largest coordinate is 
+        positive.
+        
+        Out-of-core matrices (memmaps) are processed in chunks of documents
+        that fit into <budget>, only the covariance matrix (terms x terms) 
+        and the result are kept in memory.
+    
         INPUT:
-            - M: Term Document Matrix
+            - M: Term Document Matrix (dense or sparse)
             - dim: dimensions of the resulting matrix (default: 2)
+            - solver: How the components are computed:
+                - 'eigh': Symmetric eigensolver on the covariance matrix.
+                - 'svds': Truncated SVD of the centered matrix. The centered
+                  matrix and the covariance matrix are never built. Needs 
+                  scipy.
+                - 'randomized': Randomized SVD of the centered matrix, an
+                  approximation that only needs numpy.
+                - None: 'svds' for sparse matrices, 'eigh' otherwise.
+            - budget: Memory (bytes) for the chunks of out-of-core matrices.
             
         OUPUT:
             - matrix
     """
     
-    m = np.mean(M, axis=1)            # 1. compute the mean          
-    Xs = M - m                        # 2. substract the mean
-    S = np.cov(M)                     # 3. compute the covariance matrix
-    w,V = np.linalg.eig(S)            # 4. compute the eigenvalues,-vectors
-
-    # go through some conversions to sort the vectors by the eigenvalues
-    # QUESTION: matrix.sort does not seem to support custom sort functions     
-    Va = V.transpose().tolist()                # generate a list of columns  
-    Va = map(tuple, Va)                        # need tuples to use them as dict keys
-    dVa = dict(itertools.izip(Va, w))          #associate eigenvectors and eigenvalues
-                 
-    V = sorted(Va, key=dVa.get, reverse=True)      # 5. sort by eigenvalues
-           
-    V2 = np.matrix(V[0:dim]).astype(np.float64)    # eigenvectors contain complex values -> transform to reals
-    U = V2*Xs                                      # 6. compute u_is  
-    return U
-    
\ No newline at end of file
+    if _issparse(M):
+        M = sp.csr_matrix(M, dtype=np.float64)
+    elif not _out_of_core(M):
+        M = np.asarray(M, dtype=np.float64)
+    terms, documents = M.shape
+    
+    if solver is None:
+        solver = 'svds' if _issparse(M) else 'eigh'
+    if solver == 'svds' and (sp is None or dim >= min(terms, documents)):
+        solver = 'eigh'
+    
+    m = (_row_sum(M, budget) / documents).reshape(terms, 1)          # 1. compute the mean
+    if solver == 'eigh':
+        V = _eigh_components(_covariance(M, m, budget), dim)         # 2. top eigenvectors of the covariance matrix
+    elif solver == 'svds':
+        V = _svds_components(M, m, dim, budget)                      # 2. top left singular vectors of M - m
+    elif solver == 'randomized':
+        V = _randomized_components(M, m, dim, budget=budget)
+    else:
+        raise ValueError("Unknown solver %s" % solver)
+    
+    # the sign of eigenvectors is arbitrary, make it deterministic
+    V = V * np.sign(V[np.abs(V).argmax(axis=0), np.arange(V.shape[1])])
+    
+    return np.matrix(_centered_rdot(M, m, V, budget).T)              # 3. compute u_is (V^T * (M - m))
+
+
+def _centered_dot(M, m, Y, budget=MEMORY_BUDGET):
+    """ (M - m) * Y without building M - m. """
+    
+    if _out_of_core(M):
+        MY = sum(np.dot(chunk, Y[s]) for s, chunk in _column_chunks(M, budget))
+    else:
+        MY = np.asarray(M.dot(Y))
+    return MY - m * Y.sum(axis=0)
+
+def _centered_rdot(M, m, Z, budget=MEMORY_BUDGET):
+    """ (M - m)^T * Z without building M - m. """
+    
+    if _out_of_core(M):
+        MtZ = np.vstack([np.dot(chunk.T, Z) for _, chunk in _column_chunks(M, budget)])
+    else:
+        MtZ = np.asarray(M.T.dot(Z))
+    return MtZ - np.dot(m.T, Z)
+
+
+def _covariance(M, m, budget=MEMORY_BUDGET):
+    """ Covariance matrix of the rows of M (same as np.cov(M)). """
+    
+    n = M.shape[1]
+    if _issparse(M):
+        MMt = (M * M.T).toarray()
+    elif _out_of_core(M):
+        MMt = np.zeros((M.shape[0], M.shape[0]))
+        for _, chunk in _column_chunks(M, budget):
+            MMt += np.dot(chunk, chunk.T)
+    else:
+        MMt = np.dot(M, M.T)
+    return (MMt - n * np.dot(m, m.T)) / (n - 1)
+
+
+def _eigh_components(S, dim):
+    """ Eigenvectors of the <dim> largest eigenvalues of the symmetric 
+        matrix S, ordered by decreasing eigenvalue.
+    """
+    
+    n = S.shape[0]
+    dim = min(dim, n)
+    if sp is not None:
+        import scipy.linalg
+        try:
+            w, V = scipy.linalg.eigh(S, subset_by_index=(n - dim, n - 1))
+        except TypeError: # older scipy
+            w, V = scipy.linalg.eigh(S, eigvals=(n - dim, n - 1))
+    else:
+        w, V = np.linalg.eigh(S)
+    return V[:, ::-1][:, :dim]
+
+
+def _svds_components(M, m, dim, budget=MEMORY_BUDGET):
+    """ Left singular vectors of the <dim> largest singular values of M - m. 
+    """
+    
+    from scipy.sparse.linalg import LinearOperator, svds
+    
+    op = LinearOperator(M.shape, dtype=np.float64, 
+                        matvec=lambda v: _centered_dot(M, m, v.reshape(-1, 1), budget).ravel(),
+                        rmatvec=lambda u: _centered_rdot(M, m, u.reshape(-1, 1), budget).ravel())
+    U, s, _ = svds(op, k=dim)
+    return U[:, np.argsort(s)[::-1]]
+
+
+def _randomized_components(M, m, dim, oversampling=10, iterations=4, seed=0, budget=MEMORY_BUDGET):
+    """ Approximates the left singular vectors of the <dim> largest singular
+        values of M - m with a randomized range finder (Halko et al.).
+    """
+    
+    k = min(dim + oversampling, min(M.shape))
+    Q = _centered_dot(M, m, np.random.RandomState(seed).standard_normal((M.shape[1], k)), budget)
+    Q = np.linalg.qr(Q)[0]
+    for _ in xrange(iterations):
+        Q = np.linalg.qr(_centered_rdot(M, m, Q, budget))[0]
+        Q = np.linalg.qr(_centered_dot(M, m, Q, budget))[0]
+    B = _centered_rdot(M, m, Q, budget).T
+    Ub = np.linalg.svd(B, full_matrices=False)[0]
+    return np.dot(Q, Ub)[:, :dim]
@@ -0,0 +1,137 @@
+'''
+Created on Nov 24, 2010
+
+'''
+
+import os, re, shutil
+import numpy as np
+
+try:
+    import scipy.sparse as sp
+except ImportError: # sparse matrices cannot be cached
+    sp = None
+
+
+class MatrixCache(object):
+    """ Stores term document matrices and PCA results as .npy files, so
+        they survive the session.
+
+        The matrices are memory-mapped when they are loaded, they are only
+        read from disk when they are used. All entries belong to the
+        fingerprint of the repository they were computed from. If the cache
+        is opened with another fingerprint, i.e. the data has changed, the
+        entries are removed.
+
+        INPUT:
+            - path: Directory of the cache.
+            - fingerprint: A string that identifies the repository contents.
+
+        Files:
+            tdm-<num_words>-<with_comments>.npy (dense)
+            tdm-<num_words>-<with_comments>/{data,indices,indptr,shape}.npy (sparse)
+            pca-<num_words>-<with_comments>-<localw>-<globalw>.npy
+    """
+
+    FINGERPRINT = 'fingerprint'
+    # the number of words is a number or the buckets of a hashed TDM
+    TDM = re.compile(r'^tdm-(\d+|hs?\d+)-([01])(\.npy)?$')
+    PCA = re.compile(r'^pca-(\d+|hs?\d+)-([01])-(\d+)-(\d+)\.npy$')
+
+    def __init__(self, path, fingerprint):
+        self.path = path
+        self.fingerprint = fingerprint
+        if os.path.isdir(path) and self._stored_fingerprint() != fingerprint:
+            shutil.rmtree(path)
+        if not os.path.isdir(path):
+            os.makedirs(path)
+            with open(os.path.join(path, self.FINGERPRINT), 'w') as f:
+                f.write(fingerprint)
+
+    def _stored_fingerprint(self):
+        try:
+            with open(os.path.join(self.path, self.FINGERPRINT)) as f:
+                return f.read()
+        except IOError:
+            return None
+
+    def _save(self, name, array):
+        """ Writes the array to a temporary file first, so an interrupted
+            write does not leave a broken entry.
+        """
+
+        path = os.path.join(self.path, name)
+        with open(path + '.tmp', 'wb') as f:
+            np.save(f, np.asarray(array))
+        os.rename(path + '.tmp', path)
+
+    def _load(self, *parts):
+        return np.load(os.path.join(self.path, *parts), mmap_mode='r')
+
+    def tdms(self):
+        """ Returns the stored TDMs as list of tuples (num_words,
+            with_comments, TF), sorted by the parameters.
+        """
+
+        result = []
+        for name in sorted(os.listdir(self.path)):
+            match = self.TDM.match(name)
+            if not match:
+                continue
+            num_words, with_comments = _words(match.group(1)), match.group(2) == '1'
+            if match.group(3): # stays a memmap, i.e. it is processed out-of-core
+                TF = self._load(name)
+            elif sp is not None and os.path.exists(os.path.join(self.path, name, 'shape.npy')):
+                data, indices, indptr, shape = [self._load(name, part + '.npy')
+                                                for part in ('data', 'indices', 'indptr', 'shape')]
+                TF = sp.csr_matrix((data, indices, indptr), shape=tuple(shape), copy=False)
+            else:
+                continue
+            result.append((num_words, with_comments, TF))
+        return sorted(result, key=lambda entry: entry[:2])
+
+    def pcas(self):
+        """ Returns the stored PCA results as list of tuples (num_words,
+            with_comments, localw, globalw, U), sorted by the parameters.
+        """
+
+        result = []
+        for name in os.listdir(self.path):
+            match = self.PCA.match(name)
+            if match:
+                num_words, with_comments, localw, globalw = match.groups()
+                result.append((_words(num_words), with_comments == '1', int(localw), int(globalw),
+                               np.asmatrix(self._load(name))))
+        return sorted(result, key=lambda entry: entry[:4])
+
+    def add_tdm(self, num_words, with_comments, TF):
+        """ Stores a TDM (dense or sparse), replacing the one with the same
+            parameters.
+        """
+
+        name = 'tdm-%s-%i' % (num_words, bool(with_comments))
+        directory = os.path.join(self.path, name)
+        if sp is not None and sp.issparse(TF):
+            if os.path.exists(directory + '.npy'):
+                os.remove(directory + '.npy')
+            TF = sp.csr_matrix(TF)
+            if not os.path.isdir(directory):
+                os.mkdir(directory)
+            for part, array in (('data', TF.data), ('indices', TF.indices), ('indptr', TF.indptr),
+                                ('shape', np.array(TF.shape))):
+                self._save(os.path.join(name, part + '.npy'), array)
+        else:
+            if os.path.isdir(directory):
+                shutil.rmtree(directory)
+            self._save(name + '.npy', TF)
+
+    def add_pca(self, num_words, with_comments, localw, globalw, U):
+        """ Stores a PCA result, replacing the one with the same parameters.
+        """
+
+        self._save('pca-%s-%i-%i-%i.npy' % (num_words, bool(with_comments), localw, globalw), U)
+
+
+def _words(name):
+    """ The number of words in a file name, "h<BUCKETS>" stays a string. """
+    
+    return int(name) if name.isdigit() else name
@@ -4,18 +4,34 @@ Created on Jun 7, 2010
 @author: kling
 '''
 
-import itertools, re
+import itertools, re, os, hashlib, sqlite3
 import numpy as np
 from time import time
 
 from flickr_data_miner.analyzer import  Analyzer
-from flickr_data_miner.lexicon import wordlist
+from flickr_data_miner.lexicon import wordlist, signature
 import matplotlib.pyplot as plt
 
-from data_analyzer.lsi import TDMBuilder, compute_pca
+from data_analyzer.lsi import TDMBuilder, HashingTDMBuilder, compute_pca, MEMORY_BUDGET, sp
+from data_analyzer.matrix_cache import MatrixCache
+from data_analyzer.duplicate_analyzer import DuplicateAnalyzer
 
 class PCAAnalyzer(Analyzer):
-    """ Provides various information about tags. """
+    """ Provides various information about tags. 
+    
+        The terms of a TDM are either the most used words of the lexicon or
+        all words, hashed to a fixed number of rows (see HashingTDMBuilder).
+        The number of words is then given as "h<BUCKETS>" or, for the 
+        signed hash, "hs<BUCKETS>", e.g. "h4096". Hashed TDMs need no 
+        lexicon, but keep stop words (the global weights lower them).
+    
+        Built TDMs and PCA results are cached in the repository directory
+        and are available in later sessions, as long as the data and the 
+        lexicon do not change. The lexicon is only loaded for new TDMs.
+        
+        Near-duplicate images are left out of the TDMs if the duplicates 
+        analyzer excludes them.
+    """
     
     TABLES = []
     CREATE_TABLES = []
@@ -24,18 +40,114 @@ class PCAAnalyzer(Analyzer):
     TAGS = 1
     COMMENTS =2
     
+    # number of rows read from the DB at once
+    FETCH_SIZE = 50000
+    
+    # the number of words of hashed TDMs
+    HASHED = re.compile(r'^h(s?)(\d+)$')
+    
+    CACHE_DIR = 'matrices'
+    # describe the data the matrices are built from
+    FINGERPRINT_QUERIES = (
+        'SELECT COUNT(*), SUM(id), MAX(id) FROM images',
+        'SELECT COUNT(*), MAX(id) FROM tag',
+        'SELECT COUNT(*), SUM(tag_id), MAX(rowid) FROM image_tag',
+        'SELECT COUNT(*), MAX(rowid) FROM image_comment',
+        'SELECT COUNT(*), SUM(image_id), SUM(cluster) FROM duplicate',
+        "SELECT value FROM repository_info WHERE key = '%s'" % DuplicateAnalyzer.EXCLUDE_KEY,
+    )
+    
     def init(self):        
-        self.pca = []
-        self.tdm = []
+        self._pca = []
+        self._tdm = []
+        self._cache = None
+        self.backend = None
+        self.budget = MEMORY_BUDGET
+        
+    @property
+    def tdm(self):
+        """ The built TDMs, tuples (num_words, with_comments, TF). """
         
-    def parse_file(self, id, tag, data):
-        pass
+        if self._cache is None:
+            self.load_cache()
+        return self._tdm
     
+    @property
+    def pca(self):
+        """ The PCA results, tuples (num_words, with_comments, localw, 
+            globalw, U).
+        """
+        
+        if self._cache is None:
+            self.load_cache()
+        return self._pca
+    
+    def fingerprint(self):
+        """ Returns a string that changes when the data of the TDMs or 
+            the lexicon changes.
+        """
+        
+        db = self.repository.db_conn
+        parts = [signature()]
+        for query in self.FINGERPRINT_QUERIES:
+            try:
+                parts.append(db.execute(query).fetchone())
+            except sqlite3.OperationalError: # table does not exist
+                parts.append(None)
+        return hashlib.sha1(repr(parts)).hexdigest()
+    
+    def load_cache(self):
+        """ Loads the TDMs and PCA results of the cache. If the data has 
+            changed since they were computed, they are dropped.
+        """
+        
+        fingerprint = self.fingerprint()
+        if self._cache is None or self._cache.fingerprint != fingerprint:
+            self._cache = MatrixCache(os.path.join(self.repository.path, self.CACHE_DIR), fingerprint)
+            self._tdm = self._cache.tdms()
+            self._pca = self._cache.pcas()
+        
     def do_recreate(self):
         print "This analyzer as no setup."
         
     def needs_init(self):
         return False
+    
+    def do_backend(self, line):
+        """ Usage: backend [dense|sparse|memmap|auto]. Selects how new term 
+            document matrices are stored. "auto" uses the sparse backend for
+            large matrices if scipy is installed. "memmap" keeps the matrix
+            on disk, for repositories that do not fit into memory (see 
+            "budget").
+        """
+        
+        line = line.strip()
+        if line == TDMBuilder.BACKEND_SPARSE and sp is None:
+            print "**ERROR** The sparse backend needs scipy"
+            return
+        if line in (TDMBuilder.BACKEND_DENSE, TDMBuilder.BACKEND_SPARSE, TDMBuilder.BACKEND_MEMMAP):
+            self.backend = line
+        elif line == 'auto':
+            self.backend = None
+        elif line:
+            print "**ERROR** Unknown backend %s" % line
+            return
+        print "New TDMs use the %s backend." % (self.backend or 'auto')
+        
+    def do_budget(self, line):
+        """ Usage: budget [MB]. Sets the memory matrices on disk may use 
+            while they are weighted and their PCA is computed (the 
+            covariance matrix of the terms comes on top).
+        """
+        
+        line = line.strip()
+        if line:
+            try:
+                self.budget = int(float(line) * 2**20)
+            except ValueError:
+                print "**ERROR** The budget must be a number of MB."
+                return
+        print "Out-of-core matrices use at most %.0f MB at once." % (self.budget / float(2**20))
      
     def do_build(self, line):
         """ This function creates the term document matrix for the current 
@@ -45,111 +157,252 @@ class PCAAnalyzer(Analyzer):
             language.
             
             Pass "list" as parameter to see a list of already built TDMs.
+            
+            Usage without questions: build WORDS [comments] [LOCAL GLOBAL],
+            e.g. "build 2500 comments 2 4" (see TDMBuilder for the weight
+            function codes). WORDS can be "h<BUCKETS>" or "hs<BUCKETS>" to 
+            hash all words instead (see above).
         """
         
         TF = None
+        self.load_cache()
         
-        if(line.strip() == 'list'):
-            if not self.tdm:
-                print 'No TDMs computed yet.'
-                return
-            else:
-                print '\nSelect a TDM:\n'
-                selected = False
-                while not selected:
-                    print 'Index'.center(15), '#Words'.center(15), 'Comments'.center(15)
-                    for i, (num_words, comments, _) in enumerate(self.tdm):
-                        print str(i).center(15), str(num_words).center(15), \
-                                '{0}'.format('Yes' if comments else 'NO').center(15)
+        parts = line.split()
+        if parts and (parts[0].isdigit() or self.HASHED.match(parts[0])): # no questions, e.g. in batch mode
+            num_words = int(parts[0]) if parts[0].isdigit() else parts[0]
+            with_comments = 'comments' in parts[1:]
+            weights = [int(p) for p in parts[1:] if p.isdigit()] + [TDMBuilder.LOCAL_BINARY, TDMBuilder.GLOBAL_BINARY]
+            localw, globalw = weights[0] % 4, weights[1] % 5
+        else:
+            if(line.strip() == 'list'):
+                if not self.tdm:
+                    print 'No TDMs computed yet.'
+                    return
+                else:
+                    print '\nSelect a TDM:\n'
+                    selected = False
+                    while not selected:
+                        print 'Index'.center(15), '#Words'.center(15), 'Comments'.center(15)
+                        for i, (num_words, comments, _) in enumerate(self.tdm):
+                            print str(i).center(15), str(num_words).center(15), \
+                                    '{0}'.format('Yes' if comments else 'NO').center(15)
                                 
-                    print '\n-1: New'
+                        print '\n-1: New'
                                     
-                    option = raw_input('Select: ')                 
+                        option = raw_input('Select: ')                 
+                        try:
+                            option = int(option)
+                            if option == -1:
+                                selected = True
+                                break
+                            elif 0 <= option <= len(self.tdm):
+                                selected = True
+                                num_words, with_comments, TF = self.tdm[option]
+                        except:
+                            pass 
+        
+            if TF is None: # build new matrix if none selected
+                num_words = raw_input('How many words from the lexicon (default: 2500, h<BUCKETS>: hash all words) ? ')
+                if not self.HASHED.match(num_words.strip()):
                     try:
-                        option = int(option)
-                        if option == -1:
-                            selected = True
-                            break
-                        elif 0 <= option <= len(self.tdm):
-                            selected = True
-                            num_words, with_comments, TF = self.tdm[option]
+                        num_words = int(num_words)
                     except:
-                        pass 
-        
-        if TF is None: # build new matrix if none selected
-            num_words = raw_input('How many words from the lexicon (default: 2500) ? ')
-            try:
-                num_words = int(num_words)
-            except:
-                num_words = 2500       
-            with_comments = raw_input('Include comments? (yes/NO) ')
-            with_comments = with_comments and with_comments.lower() != 'no'
+                        num_words = 2500       
+                else:
+                    num_words = num_words.strip()
+                with_comments = raw_input('Include comments? (yes/NO) ')
+                with_comments = bool(with_comments) and with_comments.lower() != 'no'
             
             
             
-        localw = raw_input('Local weight function (0=bin, 1=tf, 2=log, 3=augnorm; default: bin): ')
-        try:
-            localw = int(localw) % 4
-        except:
-            localw = TDMBuilder.LOCAL_BINARY
+            localw = raw_input('Local weight function (0=bin, 1=tf, 2=log, 3=augnorm; default: bin): ')
+            try:
+                localw = int(localw) % 4
+            except:
+                localw = TDMBuilder.LOCAL_BINARY
             
-        globalw = raw_input('Global weight function (0=bin, 1=norm, 2=gfldf, 3=ldf, 4=entropy; default: bin): ')
-        try:
-            globalw = int(globalw) % 5
-        except:
-            globalw = TDMBuilder.GLOBAL_BINARY
+            globalw = raw_input('Global weight function (0=bin, 1=norm, 2=gfldf, 3=ldf, 4=entropy; default: bin): ')
+            try:
+                globalw = int(globalw) % 5
+            except:
+                globalw = TDMBuilder.GLOBAL_BINARY
         
         
         print 'Computing...'
         now = time()
+        self.build(num_words, with_comments, localw, globalw, TF)
+        print 'Finished. Time elapsed: %f' % (time()-now)
         
-        # Create temporary table for fast access 
-        self.repository.db_conn.execute("""
-            CREATE TEMP TABLE IF NOT EXISTS named_tag_list AS 
-                SELECT image_id, name as tag 
-                FROM image_tag 
-                LEFT JOIN tag 
-                ON tag_id = tag.id""")
-        
-        # get images
-        ordered_images = list(itertools.chain(*self.repository.db_conn.execute('SELECT id FROM images ORDER BY id').fetchall()))
-        
-        # create builder
-        builder = TDMBuilder(wordlist(num_words), ordered_images)
+    def build(self, num_words=2500, with_comments=False, 
+              localw=TDMBuilder.LOCAL_BINARY, globalw=TDMBuilder.GLOBAL_BINARY, TF=None):
+        """ Creates the term document matrix for the current repository and
+            computes the PCA. The TDM and the result are added to the lists
+            of TDMs and PCAs.
+            
+            INPUT:
+                - num_words: Number of words from the lexicon or 
+                             "h<BUCKETS>" / "hs<BUCKETS>" (see above).
+                - with_comments: Add the words of the comments to the TDM.
+                - localw: The local weight function (see TDMBuilder).
+                - globalw: The global weight function (see TDMBuilder).
+                - TF: A TDM built before (if not given, the cached one with
+                      the same parameters is used or a new one is built).
+                
+            OUTPUT:
+                The projected documents (see compute_pca).
+        """
         
+        with_comments = bool(with_comments)
+        self.load_cache()
+        if TF is None:
+            for entry in self._pca:
+                if entry[:-1] == (num_words, with_comments, localw, globalw):
+                    return entry[-1]
+            for entry in self._tdm:
+                if entry[:-1] == (num_words, with_comments):
+                    TF = entry[-1]
+        db = self.repository.db_conn
         
-        if TF is None: # build new matrix if none selected
+        if TF is not None:
+            # the weights only depend on the matrix, no lexicon is needed
+            builder = TDMBuilder([], [], TDMBuilder.BACKEND_DENSE, budget=self.budget, 
+                                 directory=self._cache.path)
+        else: # build new matrix if none selected
+            # get images
+            ordered_images = np.array([id for id, _ in self.images()], dtype=np.int64)
+            
+            # create builder
+            hashed = self.HASHED.match(str(num_words))
+            if hashed:
+                builder = HashingTDMBuilder(int(hashed.group(2)), ordered_images.tolist(), bool(hashed.group(1)), 
+                                            self.backend, budget=self.budget, directory=self._cache.path)
+            else:
+                builder = TDMBuilder(wordlist(num_words), ordered_images.tolist(), self.backend,
+                                     budget=self.budget, directory=self._cache.path)
+            
+            # map the ids of the tags in the lexicon to the terms
+            tags = db.execute('SELECT id, name FROM tag').fetchall()
+            term_of_tag = np.empty(max([id for id, _ in tags] or [0]) + 1, dtype=np.int64)
+            term_of_tag.fill(-1)
+            sign_of_tag = np.ones(len(term_of_tag))
+            if hashed:
+                term_of_tag[[id for id, _ in tags]], sign_of_tag[[id for id, _ in tags]] = \
+                    builder.hash_terms(name for _, name in tags)
+            else:
+                for tag_id, name in tags:
+                    term_of_tag[tag_id] = builder.terms_set.get(name, -1)
+            
             # create document vectors
-            for image_id, tag_name in self.repository.db_conn.execute('SELECT * FROM named_tag_list'):
-                builder.add_document_term(image_id, tag_name)
+            cursor = db.execute('SELECT image_id, tag_id FROM image_tag')
+            while True:
+                rows = cursor.fetchmany(self.FETCH_SIZE)
+                if not rows:
+                    break
+                rows = np.array(rows, dtype=np.int64)
+                terms = term_of_tag[rows[:, 1]]
+                known = terms >= 0
+                self._add_indices(builder, ordered_images, terms[known], rows[known, 0], 
+                                  sign_of_tag[rows[known, 1]] if hashed else None)
                     
             if with_comments:
                 # just traversing the table is much as getting all comments and tags 
                 # for an image beforehand (~ 7 times faster)
-                for image_id, comment in self.repository.db_conn.execute('SELECT image_id, content FROM image_comment'):
-                    # get the substring up to 'Posted' and split it by all non word characters
-                    builder.add_document_terms(image_id, re.split("[^\w']+", comment.lower()[:comment.rfind('Posted')]))
+                cursor = db.execute('SELECT image_id, content FROM image_comment')
+                terms_set = builder.terms_set
+                while True:
+                    rows = cursor.fetchmany(self.FETCH_SIZE)
+                    if not rows:
+                        break
+                    terms, images = [], []
+                    for image_id, comment in rows:
+                        # get the substring up to 'Posted' and split it by all non word characters
+                        words = re.split("[^\w']+", comment.lower()[:comment.rfind('Posted')])
+                        if hashed: # every word is a term
+                            words = [word for word in words if word]
+                            terms.extend(words)
+                            images.extend([image_id] * len(words))
+                            continue
+                        for word in words:
+                            term = terms_set.get(word)
+                            if term is not None:
+                                terms.append(term)
+                                images.append(image_id)
+                    if hashed:
+                        terms, signs = builder.hash_terms(terms)
+                        self._add_indices(builder, ordered_images, terms, images, signs)
+                    else:
+                        self._add_indices(builder, ordered_images, terms, images)
         
-            self.tdm.append((num_words, with_comments, builder.getTF()))  
+            TF = builder.getTF()
+            self._replace(self._tdm, (num_words, with_comments, TF))
+            self._cache.add_tdm(num_words, with_comments, TF)
                                 
         M = builder.build_matrix(localw=localw, globalw=globalw, matrix=TF)
-        U = compute_pca(M)
-        print 'Finished. Time elapsed: %f' % (time()-now)
+        U = compute_pca(M, budget=self.budget)
         
-        self.pca.append((num_words, with_comments, localw, globalw, U))
+        self._replace(self._pca, (num_words, with_comments, localw, globalw, U))
+        self._cache.add_pca(num_words, with_comments, localw, globalw, U)
+        return U
+    
+    def images(self):
+        """ The ids and tags of the images of the TDMs, ordered by id. """
+        
+        if self.repository.get_info(DuplicateAnalyzer.EXCLUDE_KEY) == '1':
+            return self.repository.db_conn.execute('SELECT id, tag FROM images WHERE id NOT IN '
+                                                   '(SELECT image_id FROM duplicate WHERE image_id != cluster) ORDER BY id')
+        return self.repository.db_conn.execute('SELECT id, tag FROM images ORDER BY id')
+    
+    def _replace(self, entries, entry):
+        """ Adds the entry to the list of TDMs or PCAs, replacing the one 
+            with the same parameters.
+        """
+        
+        entries[:] = [e for e in entries if e[:-1] != entry[:-1]]
+        entries.append(entry)
+     
+    def _add_indices(self, builder, ordered_images, terms, images, signs=None):
+        """ Adds the terms of the images to the builder. Images that are 
+            not in <ordered_images> (sorted image ids) are ignored. The 
+            signs are only used by builders with a signed hash.
+        """
+        
+        terms = np.asarray(terms, dtype=np.int64)
+        images = np.asarray(images, dtype=np.int64)
+        if not len(terms) or not len(ordered_images):
+            return
+        documents = np.searchsorted(ordered_images, images)
+        known = ordered_images[np.minimum(documents, len(ordered_images) - 1)] == images
+        if signs is not None and getattr(builder, 'signed', False):
+            builder.add_indices(terms[known], documents[known], np.asarray(signs)[known])
+        else:
+            builder.add_indices(terms[known], documents[known])
      
     def do_plot(self, line):
-        """ Plots the chosen term document matrix."""
+        """ Plots the chosen term document matrix.
         
+            Usage without questions: plot INDEX [TAG ...]
+        """
+        
+        self.load_cache()
         if not self.pca:
             print "Create a term document matrix with 'build_tdm' first."
             return
         
-        print "\nSelect one of the matricies to plot:\n"
-        
-        option = self.print_matrix_select_list()
-        
-        tags_to_plot = raw_input('Which tags to plot (default: all) ? ')
+        parts = line.split()
+        if parts:
+            try:
+                option = int(parts[0])
+                self.pca[option]
+            except (ValueError, IndexError):
+                print "**ERROR** No PCA with index %s" % parts[0]
+                return
+            tags_to_plot = ' '.join(parts[1:])
+        else:
+            print "\nSelect one of the matricies to plot:\n"
+            
+            option = self.print_matrix_select_list()
+            
+            tags_to_plot = raw_input('Which tags to plot (default: all) ? ')
         
         # get tags for grouping and coloring the plot
         tags = self.repository.db_conn.execute('SELECT DISTINCT tag FROM images ORDER BY tag').fetchall()
@@ -161,7 +414,7 @@ class PCAAnalyzer(Analyzer):
         # image documents is of form
         # [((image_id, tag), u_i), ...]
         # i.e. image_id with corresponding tag and document vector
-        image_documents = itertools.izip(self.repository.db_conn.execute('SELECT id, tag FROM images ORDER BY id'), Us)
+        image_documents = itertools.izip(self.images(), Us)
               
         if tags_to_plot: # only keep elements to plot
             tags_to_plot = tags_to_plot.split()
@@ -5,10 +5,10 @@ Created on May 9, 2010
 
 import string
 
-from lxml import etree
 from lxml.cssselect import CSSSelector
 
 from flickr_data_miner.analyzer import  Analyzer
+from flickr_data_miner import extractor
 
 
 class RatingAnalyzer(Analyzer):
@@ -19,28 +19,47 @@ class RatingAnalyzer(Analyzer):
                     "CREATE TABLE IF NOT EXISTS image_rating (image_id integer REFERENCES images(id) ON DELETE CASCADE, rating integer)", 
                     )
     NAME = 'ratings'
+    FIELDS = (extractor.RATING,)
     
     def init(self):
         self._tags = dict()
         self._temp_initialized = False
         self.sel = CSSSelector("#fave_countSpan");
     
-    def parse_file(self, id, tag, data):
-        doc = etree.HTML(data)
+    def extract(self, id, tag, doc):
+        return self._rating([el.text for el in self.sel(doc)])
+    
+    def extract_fields(self, id, tag, fields):
+        return self._rating(fields[extractor.RATING])
+    
+    def _rating(self, texts):
         try:
-            counts = int(string.replace(self.sel(doc)[0].text.split()[0], ',', ''))
+            return int(string.replace(texts[0].split()[0], ',', ''))
         except IndexError:
-            counts = 0
-        self.repository.db_conn.execute('INSERT INTO image_rating (image_id, rating) VALUES (?,?)', (id, counts))
+            return 0
+        
+    def store(self, id, tag, counts):
+        self.repository.writer.insert('image_rating', ('image_id', 'rating'), (id, counts))
         
     def do_average_rating(self, line):
-        number = self.repository.db_conn.execute('SELECT AVG(rating) FROM image_rating').fetchone()
-        print "In average, %i people call each photo as their favorite." % number
+        print "In average, %i people call each photo as their favorite." % self.average_rating()
         
     def do_total_rating(self, line):
-        number = self.repository.db_conn.execute('SELECT SUM(rating) FROM image_rating').fetchone()
-        print "In total, all images are marked as favorite %i times." % number
+        print "In total, all images are marked as favorite %i times." % self.total_rating()
     
     def do_max_rating(self, line):
-        number = self.repository.db_conn.execute('SELECT rating, image_id FROM image_rating WHERE rating = (SELECT MAX(rating) FROM image_rating)').fetchone()
-        print "The most liked image is liked by %i people (image %i)." % number
+        print "The most liked image is liked by %i people (image %i)." % self.max_rating()
+        
+    # The queries of the commands. They are overridden to answer the
+    # commands for several repositories (see federation).
+        
+    def average_rating(self):
+        return self.repository.db_conn.execute('SELECT AVG(rating) FROM image_rating').fetchone()[0]
+    
+    def total_rating(self):
+        return self.repository.db_conn.execute('SELECT SUM(rating) FROM image_rating').fetchone()[0]
+    
+    def max_rating(self):
+        """ Tuple (rating, image id) of the most liked image. """
+        
+        return self.repository.db_conn.execute('SELECT rating, image_id FROM image_rating WHERE rating = (SELECT MAX(rating) FROM image_rating)').fetchone()
@@ -13,60 +13,142 @@ from lxml import etree
 from lxml.cssselect import CSSSelector
 
 from flickr_data_miner.analyzer import  Analyzer
+from flickr_data_miner import extractor
 import matplotlib.pyplot as plt
 
 class TagAnalyzer(Analyzer):
-    """ Provides various information about tags. """
+    """ Provides various information about tags. 
+    
+        The number of images per tag (tag_count) and of tags per image 
+        (tags_per_image) are kept in aggregate tables, which are updated
+        whenever pages are added.
+    """
     
     TABLES = ("image_tag", "tag")
     CREATE_TABLES = (
                     "CREATE TABLE tag (id integer PRIMARY KEY, name text UNIQUE)",
                     "CREATE TABLE image_tag (image_id integer REFERENCES images(id) ON DELETE CASCADE, tag_id integer REFERENCES tag(id) ON DELETE CASCADE, PRIMARY KEY (image_id, tag_id))"
                     )
+    CREATE_INDEXES = (
+                    "CREATE INDEX IF NOT EXISTS image_tag_tag_id ON image_tag (tag_id)",
+                    "CREATE INDEX IF NOT EXISTS tag_count_count ON tag_count (count)",
+                    "CREATE INDEX IF NOT EXISTS tags_per_image_count ON tags_per_image (count)",
+                    )
+    
+    # not part of TABLES, so repositories initialized before these tables
+    # existed need no new initialization (see ensure_aggregates)
+    AGGREGATE_TABLES = ("tag_count", "tags_per_image")
+    CREATE_AGGREGATE_TABLES = (
+                    "CREATE TABLE IF NOT EXISTS tag_count (tag_id integer PRIMARY KEY, name text, count integer)",
+                    "CREATE TABLE IF NOT EXISTS tags_per_image (image_id integer PRIMARY KEY, count integer)",
+                    )
     NAME = 'tags'
+    FIELDS = (extractor.TAGS,)
     
     TAGS = 1
     COMMENTS =2
     
     def init(self):
         self._tags = dict()
-        self._temp_initialized = False
+        self._next_id = 1
+        self._tag_counts = dict()
+        self._aggregates_checked = False
         self.sel = CSSSelector("#thetags > div > a.Plain")
         
         self.pca = []
         self.tdm = []
         
-    def parse_file(self, id, tag, data):
-        doc = etree.HTML(data)
-        tags = set(tagel.text.strip().lower() for tagel in self.sel(doc))
+    def create_tables(self):
+        super(TagAnalyzer, self).create_tables()
+        for create in self.CREATE_AGGREGATE_TABLES:
+            self.repository.db_conn.execute(create)
+        self._aggregates_checked = True
+        
+    def remove(self):
+        super(TagAnalyzer, self).remove()
+        for table in self.AGGREGATE_TABLES:
+            self.repository.db_conn.execute('DROP TABLE IF EXISTS ' + table)
+        self._aggregates_checked = False
+        
+    def prepare(self):
+        self.ensure_aggregates()
+        # tags of pages processed in an earlier session
+        self._tags = dict((name, id) for id, name in self.repository.db_conn.execute('SELECT id, name FROM tag'))
+        self._next_id = max(self._tags.itervalues()) + 1 if self._tags else 1
+        self._tag_counts = dict()
+        
+    def extract(self, id, tag, doc):
+        return self._normalize(tagel.text for tagel in self.sel(doc))
+    
+    def extract_fields(self, id, tag, fields):
+        return self._normalize(fields[extractor.TAGS])
+    
+    def _normalize(self, names):
+        return sorted(set(name.strip().lower() for name in names))
+        
+    def store(self, id, tag, tags):
         values = list()
         for tagname in tags:
             if tagname not in self._tags:
-                tagid = self.repository.db_conn.execute('INSERT INTO tag (name) VALUES (?)', (tagname, )).lastrowid
+                # assign the ids here, so the tags can be inserted in batches
+                tagid = self._next_id
+                self._next_id += 1
                 self._tags[tagname] = tagid
+                self.repository.writer.insert('tag', ('id', 'name'), (tagid, tagname))
             else:
                 tagid = self._tags[tagname]
             values.append((tagid, id))
+            self._tag_counts[tagid] = self._tag_counts.get(tagid, 0) + 1
+        
+        self.repository.writer.insert_many('image_tag', ('tag_id', 'image_id'), values)
+        if values:
+            self.repository.writer.insert('tags_per_image', ('image_id', 'count'), (id, len(values)), 'INSERT OR REPLACE')
+            
+    def finish(self):
+        """ Adds the tags counted while storing the pages to tag_count. """
+        
+        db = self.repository.db_conn
+        names = dict((tagid, name) for name, tagid in self._tags.iteritems() if tagid in self._tag_counts)
+        db.executemany('INSERT OR IGNORE INTO tag_count (tag_id, name, count) VALUES (?,?,0)', 
+                       ((tagid, names[tagid]) for tagid in self._tag_counts))
+        db.executemany('UPDATE tag_count SET count = count + ? WHERE tag_id = ?', 
+                       ((count, tagid) for tagid, count in self._tag_counts.iteritems()))
+        self._tag_counts = dict()
+        
+    def ensure_aggregates(self):
+        """ Creates the aggregate tables from the existing data if they 
+            do not exist yet.
+        """
         
-        self.repository.db_conn.executemany('INSERT INTO image_tag (tag_id, image_id) VALUES (?,?)', values)
+        if self._aggregates_checked:
+            return
+        db = self.repository.db_conn
+        existing = db.execute("SELECT name FROM sqlite_master WHERE type='table' AND name IN ('tag_count', 'tags_per_image')").fetchall()
+        if len(existing) != len(self.AGGREGATE_TABLES):
+            for table in self.AGGREGATE_TABLES:
+                db.execute('DROP TABLE IF EXISTS ' + table)
+            for create in self.CREATE_AGGREGATE_TABLES:
+                db.execute(create)
+            db.execute("INSERT INTO tags_per_image (image_id, count) SELECT image_id, COUNT(tag_id) FROM image_tag GROUP BY image_id")
+            db.execute("INSERT INTO tag_count (tag_id, name, count) SELECT tag_id, name, COUNT(image_id) FROM image_tag LEFT JOIN tag on tag_id = id GROUP BY tag_id, name")
+            self.create_indexes()
+            db.commit()
+        self._aggregates_checked = True
             
     def do_count_unique_tags(self, line):
         """ Returns the number of unique tags. """
         
-        number = self.repository.db_conn.execute('SELECT COUNT(id) FROM tag').fetchone()
-        print 'There are %i unique tags assigned to images.' % number
+        print 'There are %i unique tags assigned to images.' % self.unique_tag_count()
         
     def do_count_tags(self, line):
         """ Returns the number of all assigned tags. """
         
-        number = self.repository.db_conn.execute('SELECT COUNT(tag_id) FROM image_tag').fetchone()
-        print 'There are %i tags assigned to images.' % number
+        print 'There are %i tags assigned to images.' % self.assigned_tag_count()
         
     def do_list_unique_tags(self, line):
         """ Lists all unique tags. """
         
-        tags = self.repository.db_conn.execute('SELECT name FROM tag ORDER BY name').fetchall()
-        print ', '.join(tag[0] for tag in tags)
+        print ', '.join(self.unique_tags())
         
     def do_list_most_used(self, line):
         """ List the most used tags. """
@@ -78,8 +160,7 @@ class TagAnalyzer(Analyzer):
             except ValueError:
                 pass
         
-        self.create_temporary_tables()
-        tags = self.repository.db_conn.execute('SELECT name, count FROM tag_count ORDER BY count DESC, name ASC')
+        tags = self.ranked_tags(max)
         
         print '\nThese are the %i most used tags:\n' % max
         for ((name, count),i) in zip(tags, xrange(1,max+1)):
@@ -96,8 +177,7 @@ class TagAnalyzer(Analyzer):
             except ValueError:
                 pass
         
-        self.create_temporary_tables()
-        tags = self.repository.db_conn.execute('SELECT name, count FROM tag_count ORDER BY count ASC')
+        tags = self.ranked_tags(max, ascending=True)
         
         print '\nThese are the %i less used tags:\n' % max
         for ((name, count),i) in zip(tags, xrange(1,max+1)):
@@ -107,11 +187,9 @@ class TagAnalyzer(Analyzer):
     def do_count_less_used(self, line):
         """ Count tags that are most used. """
         
-        self.create_temporary_tables()
-        min = self.repository.db_conn.execute('SELECT MIN(count) FROM tag_count').fetchone()
-        number = self.repository.db_conn.execute('SELECT COUNT(tag_id) FROM tag_count WHERE count = ?', min).fetchone()[0]
+        min, number = self.rarest_tags()
         
-        print 'Number of unique tags used only %i time(s): %i' % (min[0], number)
+        print 'Number of unique tags used only %i time(s): %i' % (min, number)
         
     def do_list_most_tagged(self, line):
         """ List images with the most tags. """
@@ -123,8 +201,7 @@ class TagAnalyzer(Analyzer):
             except ValueError:
                 pass
         
-        self.create_temporary_tables()
-        images = self.repository.db_conn.execute('SELECT image_id, count FROM tags_per_image ORDER BY count DESC, image_id ASC')
+        images = self.most_tagged_images(max)
         
         print '\nThese are the %i most tagged images:\n' % max
         for ((id, count),i) in zip(images, xrange(1,max+1)):
@@ -134,17 +211,13 @@ class TagAnalyzer(Analyzer):
     def do_list_searched_tags(self, line):
         """ List the count of the searched tags. """
         
-        self.create_temporary_tables()
-        tags = self.repository.db_conn.execute('SELECT name, count FROM tag_count WHERE name in (SELECT DISTINCT tag FROM images) ORDER BY count DESC, name ASC')
-        
-        for el in tags:
+        for el in self.searched_tag_counts():
             print '- %s %i' % el
     
     def do_plot_ranked_list(self, list):
         """ Plots the ranked list of all tags. """
         
-        self.create_temporary_tables()
-        tags = self.repository.db_conn.execute('SELECT name, count FROM tag_count ORDER BY count DESC')
+        tags = self.ranked_tags()
         
         print '\nRanked list:\n'
         
@@ -172,8 +245,44 @@ class TagAnalyzer(Analyzer):
         #plt.xlim(0,100)
         #plt.xticks(range(0,100,10))
         plt.show()
+        
+    # The queries of the commands. They are overridden to answer the
+    # commands for several repositories (see federation).
+        
+    def unique_tag_count(self):
+        return self.repository.db_conn.execute('SELECT COUNT(id) FROM tag').fetchone()[0]
+    
+    def assigned_tag_count(self):
+        return self.repository.db_conn.execute('SELECT COUNT(tag_id) FROM image_tag').fetchone()[0]
+    
+    def unique_tags(self):
+        return [name for name, in self.repository.db_conn.execute('SELECT name FROM tag ORDER BY name')]
+    
+    def ranked_tags(self, limit=None, ascending=False):
+        """ List of tuples (name, count) of the most used tags (or the least
+            used ones).
+        """
+        
+        self.ensure_aggregates()
+        return self.repository.db_conn.execute('SELECT name, count FROM tag_count ORDER BY count %s, name ASC LIMIT ?' 
+                                               % ('ASC' if ascending else 'DESC'), (-1 if limit is None else limit,)).fetchall()
+    
+    def rarest_tags(self):
+        """ Tuple (count, number of tags) of the tags used least often. """
+        
+        self.ensure_aggregates()
+        min = self.repository.db_conn.execute('SELECT MIN(count) FROM tag_count').fetchone()
+        return min[0], self.repository.db_conn.execute('SELECT COUNT(tag_id) FROM tag_count WHERE count = ?', min).fetchone()[0]
     
-    def create_temporary_tables(self):
-        if not self._temp_initialized:
-            self.repository.db_conn.execute("CREATE TEMP TABLE IF NOT EXISTS tags_per_image AS SELECT image_id, COUNT(tag_id) as count FROM image_tag GROUP BY image_id")
-            self.repository.db_conn.execute("CREATE TEMP TABLE IF NOT EXISTS tag_count AS SELECT tag_id, name, COUNT(image_id) as count FROM image_tag LEFT JOIN tag on tag_id = id GROUP BY tag_id, name")
\ No newline at end of file
+    def most_tagged_images(self, limit):
+        """ List of tuples (image id, number of tags). """
+        
+        self.ensure_aggregates()
+        return self.repository.db_conn.execute('SELECT image_id, count FROM tags_per_image ORDER BY count DESC, image_id ASC LIMIT ?', (limit,)).fetchall()
+    
+    def searched_tag_counts(self):
+        """ List of tuples (name, count) of the tags that were searched for.
+        """
+        
+        self.ensure_aggregates()
+        return self.repository.db_conn.execute('SELECT name, count FROM tag_count WHERE name in (SELECT DISTINCT tag FROM images) ORDER BY count DESC, name ASC').fetchall()
\ No newline at end of file
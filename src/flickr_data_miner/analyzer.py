@@ -2,11 +2,14 @@
 Created on Apr 19, 2010
 
 '''
-import cmd, sys, datetime, lxml
+import cmd, sys, datetime, time, itertools, lxml, collections, multiprocessing
 
 from lxml import etree
 from lxml.cssselect import CSSSelector
 
+from extractor import Extractor, DATE
+from profiling import Profile
+
 class Analyzer(cmd.Cmd, object):
     """ This is the base class for analyzer classes.
         
@@ -32,8 +35,30 @@ class Analyzer(cmd.Cmd, object):
                EXAMPLE:
                    TABLES = ('tags',)
                    
-            4. Override the "parse_file" method in order to extract data from
-               the HTML pages upon initialization.
+               Indexes can be specified in the class attribute CREATE_INDEXES.
+               They are created after the pages are loaded.
+                   
+            4. Override the "extract" method in order to extract data from
+               the parsed HTML pages upon initialization and the "store"
+               method to write the extracted data to the DB. Every page is
+               parsed only once and the resulting document is shared by all
+               analyzers. 
+               Analyzers that need the raw HTML can still override 
+               "parse_file" instead.
+               Rows should be inserted with "self.repository.writer" (see
+               writer.BatchWriter), which inserts them in batches.
+               
+               To support the streaming mode, list the fields of the page the
+               analyzer needs in the class attribute FIELDS and override
+               "extract_fields" too (see extractor.Extractor).
+               EXAMPLE:
+                   FIELDS = (extractor.TAGS,)
+                   
+               Analyzers that only compute their tables from the tables of 
+               other analyzers in "finish" set NEEDS_PAGES to False. The pages
+               are then not read for them.
+               EXAMPLE:
+                   NEEDS_PAGES = False
                    
             5. For every function the analyzer should provide, define a instance
                method "do_functionname". This method is then accessible via the 
@@ -51,10 +76,17 @@ class Analyzer(cmd.Cmd, object):
                
             6. Add the full path to the class to "settings.py". Make sure that
                the analyzer comes after all other analyzer it is depending on.
+               
+        The ids of the pages an analyzer has processed are recorded in the
+        table "analyzer_manifest". Pages added to the repository later can
+        therefore be processed incrementally (see "update").
     """
     
     CREATE_TABLES = tuple()
+    CREATE_INDEXES = tuple()
     TABLES = tuple()
+    FIELDS = tuple()
+    NEEDS_PAGES = True
     NAME = 'Unnamed analyzer'
     
     def __init__(self, repository):
@@ -74,30 +106,113 @@ class Analyzer(cmd.Cmd, object):
         
         for create in self.CREATE_TABLES:
             self.repository.db_conn.execute(create)
+            
+    def create_indexes(self):
+        """ Executes the CREATE INDEX statements."""
+        
+        for create in self.CREATE_INDEXES:
+            self.repository.db_conn.execute(create)
+            
+    def prepare(self):
+        """ Can be implemented to load state from the DB before pages are 
+            processed, e.g. when new pages are added to existing tables.
+        """
+        
+        pass
     
-    def parse_file(self, id, tag, data):
+    def finish(self):
+        """ Can be implemented to update the DB after all pages are stored,
+            e.g. to maintain aggregate tables.
+        """
+        
+        pass
+    
+    def processed_ids(self):
+        """ Returns the set of image ids the analyzer has already processed.
+        """
+        
+        if self.needs_init():
+            return set()
+        db = self.repository.db_conn
+        if not self.repository.get_info('manifest:' + self.NAME):
+            # initialized before the manifest existed, assume that every 
+            # image known to the basic analyzer was processed
+            if db.execute("SELECT name FROM sqlite_master WHERE type='table' AND name = 'images'").fetchone():
+                db.execute('INSERT OR IGNORE INTO analyzer_manifest (analyzer, image_id) SELECT ?, id FROM images', (self.NAME,))
+            self.repository.set_info('manifest:' + self.NAME, '1')
+            db.commit()
+        return set(id for id, in db.execute('SELECT image_id FROM analyzer_manifest WHERE analyzer = ?', (self.NAME,)))
+    
+    def extract(self, id, tag, doc):
         """ Should be implemented by the analyzer to extract data from the
-            HTML pages.
+            parsed HTML pages.
             
             INPUT:
                 - id: The image id.
                 - tag: The tag, the image was fetched for.
-                - data: The HTML page.    
+                - doc: The parsed HTML page (lxml element tree).
+                
+            OUTPUT:
+                The extracted data, passed to "store".
+        """
+        
+        return None
+    
+    def extract_fields(self, id, tag, fields):
+        """ Can be implemented in addition to "extract" to support the 
+            streaming mode. Gets the fields listed in FIELDS instead of the
+            parsed document.
+            
+            INPUT:
+                - id: The image id.
+                - tag: The tag, the image was fetched for.
+                - fields: The fields of the page (see extractor.Extractor).
+                
+            OUTPUT:
+                The same data "extract" returns.
+        """
+        
+        return None
+    
+    def store(self, id, tag, values):
+        """ Should be implemented by the analyzer to write the data returned
+            by "extract" to the DB.
         """
         
         pass
     
-    def initialize(self):
-        self.create_tables()
-        total = self.repository.total_images
-        self.repository.begin_transaction()
-        for i, (id, tag, data) in enumerate(self.repository.get_sites(), start=1):
-            self.parse_file(id, tag, data)
-            if i % 100 == 0 or i == total:
-                sys.stdout.write("%i of %i images processed \r" % (i, total))
-                sys.stdout.flush()
-        self.repository.commit()
-        print '\nDone.'
+    def parse_file(self, id, tag, data):
+        """ Extracts and stores the data of a raw HTML page. 
+        
+            Analyzers that need the raw HTML instead of the parsed document
+            can override this method.
+            
+            INPUT:
+                - id: The image id.
+                - tag: The tag, the image was fetched for.
+                - data: The HTML page.    
+        """
+        
+        self.store(id, tag, self.extract(id, tag, etree.HTML(data)))
+        
+    def wants_raw_html(self):
+        """ Checks whether the analyzer overrides "parse_file" and therefore
+            has to be fed with the raw HTML.
+        """
+        
+        return _overrides(self, 'parse_file')
+    
+    def wants_document(self):
+        """ Checks whether the analyzer implements "extract" but not 
+            "extract_fields" and therefore needs the parsed document in 
+            streaming mode too.
+        """
+        
+        return _overrides(self, 'extract') and not _overrides(self, 'extract_fields')
+    
+    def initialize(self, processes=1, incremental=False, streaming=False, profile=None):
+        return initialize_analyzers(self.repository, [self], processes, incremental=incremental, 
+                                    streaming=streaming, profile=profile)
 
             
     def remove(self):
@@ -105,6 +220,8 @@ class Analyzer(cmd.Cmd, object):
         
         for table in self.TABLES:
             self.repository.db_conn.execute('DROP TABLE ' + table) 
+        self.repository.db_conn.execute('DELETE FROM analyzer_manifest WHERE analyzer = ?', (self.NAME,))
+        self.repository.db_conn.execute('DELETE FROM repository_info WHERE key = ?', ('manifest:' + self.NAME,))
             
     def recreate(self):
         self.remove()
@@ -122,6 +239,13 @@ class Analyzer(cmd.Cmd, object):
         
         self.recreate()
         
+    def do_update(self, line):
+        """ Process the pages added to the repository since the analyzer 
+            was initialized.
+        """
+        
+        self.initialize(incremental=True)
+        
     def do_help(self, line):
         """ Prints the help. """
         
@@ -130,6 +254,239 @@ class Analyzer(cmd.Cmd, object):
         super(Analyzer, self).do_help(line)
         
 
+def _overrides(analyzer, name):
+    """ Checks whether the class of <analyzer> overrides the method <name> of
+        Analyzer. The classes are compared by name, because this module is
+        imported twice (as "analyzer" and "flickr_data_miner.analyzer") if
+        miner.py is run as script.
+    """
+    
+    for cls in type(analyzer).__mro__:
+        if name in cls.__dict__:
+            return cls.__name__ != 'Analyzer'
+    return False
+
+
+def initialize_analyzers(repository, analyzers, processes=1, batch_size=100, 
+                         incremental=False, write_batch_size=None, 
+                         deferred_indexes=True, streaming=False, profile=None):
+    """ Creates the tables of the analyzers and feeds every page of the 
+        repository to them. 
+        
+        In incremental mode, the pages an analyzer has already processed 
+        are skipped and pages processed by all analyzers are not even read.
+        Analyzers that do not need the pages (see Analyzer.NEEDS_PAGES) are
+        only finished. If no analyzer needs them, no page is read at all.
+        
+        Each page is parsed only once and the document is shared by all
+        analyzers. Analyzers that want the raw HTML (see 
+        Analyzer.wants_raw_html) get the unparsed page. In streaming mode, 
+        only the fields the analyzers need are extracted from the page (see 
+        extractor.Extractor) and the document is only parsed if an analyzer
+        does not support this (see Analyzer.wants_document).
+        
+        If more than one process is used, the pages are parsed and the data
+        extracted in a pool of worker processes. The extracted values are 
+        sent back in batches and stored by this process, which is the only
+        one writing to the DB.
+        
+        The time of every phase is recorded in a profile (see 
+        profiling.Profile): reading the pages ("read"), parsing them 
+        ("parse" or "stream" in streaming mode), extracting ("extract:<NAME>")
+        and storing ("store:<NAME>") the data of each analyzer, as well as 
+        the final steps. If worker processes are used, parsing and 
+        extracting are measured in the workers.
+        
+        INPUT:
+            - repository: The repository to read the pages from.
+            - analyzers: A sequence of analyzers to initialize.
+            - processes: Number of worker processes (default: 1, i.e. 
+                         everything is done in this process).
+            - batch_size: Number of pages sent to a worker at once.
+            - incremental: Only process pages the analyzers have not 
+                           processed yet.
+            - write_batch_size: Number of rows per table that are inserted
+                                at once (default: keep the repository's 
+                                setting).
+            - deferred_indexes: Create the indexes of the analyzers after 
+                                the pages are loaded instead of before.
+            - streaming: Use the streaming mode.
+            - profile: The profile to add the times to (default: a new 
+                       one).
+                       
+        OUTPUT:
+            The profile.
+    """
+    
+    readers = [a for a in analyzers if a.NEEDS_PAGES]
+    raw = [a for a in readers if a.wants_raw_html()]
+    parsed = [a for a in readers if not a.wants_raw_html()]
+    
+    if incremental:
+        done = dict((a, a.processed_ids()) for a in readers)
+        skip = set.intersection(*done.values()) if done else set()
+    else:
+        done = dict((a, frozenset()) for a in readers)
+        skip = frozenset()
+    
+    if write_batch_size:
+        repository.writer.batch_size = write_batch_size
+    
+    if profile is None:
+        profile = Profile()
+    clock, add = time.time, profile.add
+    
+    total = max(repository.total_images - len(skip), 0) if readers else 0
+    for a in analyzers:
+        if a.needs_init():
+            a.create_tables()
+        if not deferred_indexes:
+            a.create_indexes()
+        a.prepare()
+    repository.begin_transaction()
+    start = time.time()
+    sites = profile.iterate('read', repository.get_sites(skip) if readers else iter(()))
+    if processes > 1 and parsed:
+        pages = _extract_parallel(sites, parsed, bool(raw), processes, batch_size, streaming, profile)
+    else:
+        pages = _extract_serial(sites, parsed, streaming, profile)
+    i = 0
+    write = repository.writer.insert
+    stores = [(a, 'store:' + a.NAME) for a in parsed]
+    parse_files = [(a, 'parse_file:' + a.NAME) for a in raw]
+    for i, (id, tag, data, values) in enumerate(pages, start=1):
+        for (a, phase), value in itertools.izip(stores, values):
+            if id not in done[a]:
+                t = clock()
+                a.store(id, tag, value)
+                add(phase, clock() - t)
+                write('analyzer_manifest', ('analyzer', 'image_id'), (a.NAME, id), 'INSERT OR IGNORE')
+        for a, phase in parse_files:
+            if id not in done[a]:
+                t = clock()
+                a.parse_file(id, tag, data)
+                add(phase, clock() - t)
+                write('analyzer_manifest', ('analyzer', 'image_id'), (a.NAME, id), 'INSERT OR IGNORE')
+        if i % 100 == 0 or i == total:
+            sys.stdout.write("%i of %i images processed \r" % (i, total))
+            sys.stdout.flush()
+    for a in analyzers:
+        t = clock()
+        a.finish()
+        add('finish:' + a.NAME, clock() - t)
+    t = clock()
+    repository.writer.flush()
+    add('flush', clock() - t)
+    if deferred_indexes:
+        for a in analyzers:
+            t = clock()
+            a.create_indexes()
+            add('indexes:' + a.NAME, clock() - t)
+    for a in analyzers:
+        repository.set_info('manifest:' + a.NAME, '1')
+    t = clock()
+    repository.commit()
+    add('commit', clock() - t)
+    elapsed = time.time() - start
+    add('total', elapsed)
+    print '\nDone. %i pages in %.1f s (%.1f pages/s).' % (i, elapsed, i / max(elapsed, 1e-6))
+    return profile
+    
+    
+def _extract_serial(sites, analyzers, streaming=False, profile=None):
+    """ Parses the pages and extracts the data in this process. """
+    
+    if profile is None:
+        profile = Profile()
+    clock, add = time.time, profile.add
+    extracts = [(a, 'extract:' + a.NAME) for a in analyzers]
+    
+    if not streaming:
+        for id, tag, data in sites:
+            t = clock()
+            doc = etree.HTML(data)
+            add('parse', clock() - t)
+            values = []
+            for a, phase in extracts:
+                t = clock()
+                values.append(a.extract(id, tag, doc))
+                add(phase, clock() - t)
+            yield (id, tag, data, values)
+        return
+    
+    extractor = Extractor(set(field for a in analyzers for field in a.FIELDS))
+    documents = [a.wants_document() for a in analyzers]
+    for id, tag, data in sites:
+        t = clock()
+        fields = extractor.extract(data)
+        add('stream', clock() - t)
+        doc = None
+        if any(documents):
+            t = clock()
+            doc = etree.HTML(data)
+            add('parse', clock() - t)
+        values = []
+        for (a, phase), document in itertools.izip(extracts, documents):
+            t = clock()
+            values.append(a.extract(id, tag, doc) if document else a.extract_fields(id, tag, fields))
+            add(phase, clock() - t)
+        yield (id, tag, data, values)
+
+
+def _extract_parallel(sites, analyzers, keep_data, processes, batch_size, streaming=False, profile=None):
+    """ Parses the pages and extracts the data in a pool of worker processes.
+    
+        The pages are sent to the workers in batches of <batch_size> pages. 
+        At most two batches per worker are pending at any time, so the 
+        repository is never read much further ahead than it is stored.
+        The results are returned in the order of the pages.
+    """
+    
+    pool = multiprocessing.Pool(processes, _init_worker, 
+                                ([type(a) for a in analyzers],))
+    pending = collections.deque()
+    try:
+        sites = iter(sites)
+        while True:
+            while len(pending) < 2 * processes:
+                batch = list(itertools.islice(sites, batch_size))
+                if not batch:
+                    break
+                pending.append(pool.apply_async(_extract_batch, (batch, keep_data, streaming)))
+            if not pending:
+                break
+            results, samples = pending.popleft().get()
+            if profile is not None:
+                profile.add_samples(samples)
+            for result in results:
+                yield result
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+# analyzer instances of a worker process
+_worker_analyzers = []
+
+def _init_worker(classes):
+    global _worker_analyzers
+    _worker_analyzers = [cls(None) for cls in classes]
+
+def _extract_batch(batch, keep_data, streaming):
+    """ Extracts the data of a batch of pages. Runs in a worker process. 
+    
+        OUTPUT:
+            The extracted data and the times of the phases (see 
+            Profile.samples).
+    """
+    
+    profile = Profile()
+    results = [(id, tag, data if keep_data else None, values) 
+               for id, tag, data, values in _extract_serial(batch, _worker_analyzers, streaming, profile)]
+    return results, profile.samples()
+    
+
 class BasicImageAnalyzer(Analyzer):
     """ Provides information about basic data (id, search tag, date). 
     
@@ -145,55 +502,86 @@ class BasicImageAnalyzer(Analyzer):
     TABLES = ("images",)
     CREATE_TABLES = ("CREATE TABLE images (id integer PRIMARY KEY, tag text, uploaded date)",)
     NAME = 'basic'
+    FIELDS = (DATE,)
     
     def init(self):
         self._count = 0
         self.sel = CSSSelector("#Photo .Widget a[property='dc:date']")
+        
+    def prepare(self):
+        self._count = 0
     
-    def parse_file(self, id, tag, data):
-        doc = etree.HTML(data)
+    def extract(self, id, tag, doc):
+        return self._uploaded([el.text for el in self.sel(doc)])
+    
+    def extract_fields(self, id, tag, fields):
+        return self._uploaded(fields[DATE])
+    
+    def _uploaded(self, dates):
         try:
-            date = self.sel(doc)[0].text
-            date = datetime.datetime.strptime(date, '%B %d, %Y')
+            return datetime.datetime.strptime(dates[0], '%B %d, %Y')
         except IndexError:
-            date = ''
+            return ''
         
-        self.repository.db_conn.execute('INSERT INTO images (id, tag, uploaded) VALUES (?,?,?)', (id, tag, date))
+    def store(self, id, tag, date):
+        self.repository.writer.insert('images', ('id', 'tag', 'uploaded'), (id, tag, date))
         
     def do_imagecount(self, line):
         """ Get number of images in the database."""
         
         if not self._count:
-            self._count = self.repository.db_conn.execute('SELECT COUNT(id) FROM images').fetchone()[0]
+            self._count = self.image_count()
         print "There are %i images in the database." % self._count
         
     def do_oldest(self, line):
         """ Get ID and date of oldest uploaded photo."""
         
-        info = self.repository.db_conn.execute('SELECT id, uploaded FROM images WHERE uploaded <> "" ORDER BY uploaded ASC').fetchone()      
-        print "Image %s was uploaded on %s" % info
+        print "Image %s was uploaded on %s" % self.uploaded(oldest=True)
     
     def do_newest(self, line):
         """ Get ID and date of newest uploaded photo."""
         
-        info = self.repository.db_conn.execute('SELECT id, uploaded FROM images WHERE uploaded <> "" ORDER BY uploaded DESC').fetchone()      
-        print "Image %s was uploaded on %s" % info
+        print "Image %s was uploaded on %s" % self.uploaded(oldest=False)
     
     def do_list_tags(self, line):
         """ Get a list of the tags that have been looked for."""
         
-        for tag in self.repository.db_conn.execute('SELECT DISTINCT tag FROM images ORDER BY tag ASC'):
-            print '-', tag[0]
+        for tag in self.searched_tags():
+            print '-', tag
+            
+    # The queries of the commands. They are overridden to answer the
+    # commands for several repositories (see federation).
+            
+    def image_count(self):
+        return self.repository.db_conn.execute('SELECT COUNT(id) FROM images').fetchone()[0]
+    
+    def uploaded(self, oldest=True):
+        """ Tuple (id, upload date) of the oldest or newest image. """
+        
+        return self.repository.db_conn.execute('SELECT id, uploaded FROM images WHERE uploaded <> "" ORDER BY uploaded %s' 
+                                               % ('ASC' if oldest else 'DESC')).fetchone()
+    
+    def searched_tags(self):
+        return [tag for tag, in self.repository.db_conn.execute('SELECT DISTINCT tag FROM images ORDER BY tag ASC')]
             
             
 
 class AnalyzerCmd(cmd.Cmd, object):
     """ This class provides the interface to the analyzers. It works as a 
         command line interface.
+        
+        If <interactive> is False, the commands do not ask questions, e.g. 
+        analyzers are initialized when they are selected.
     """
     
-    def __init__(self, repository, analyzers, completekey='Tab'):
+    def __init__(self, repository, analyzers, completekey='Tab', processes=1, streaming=False,
+                 stats_file=None, interactive=True):
         self._a = analyzers
+        self.processes = processes
+        self.streaming = streaming
+        self.stats_file = stats_file
+        self.interactive = interactive
+        self.profile = Profile()
         self.analyzers = dict((a.NAME, a) for a in analyzers)
         self.context = None
         cmd.Cmd.__init__(self, completekey)
@@ -211,17 +599,16 @@ class AnalyzerCmd(cmd.Cmd, object):
             while init.lower() != 'no' and init.lower() != 'yes':
                 init = raw_input("%i analyzers are not yet initialized\nInitialize now? (yes [recommended]/no): " % len(not_init))
             if init.lower() == 'yes':
-                total = self.rep.total_images
-                for a in not_init:
-                    a.create_tables()
-                    self.rep.begin_transaction()
-                for i, (id, tag, content) in enumerate(self.rep.get_sites(), start=1):
-                    for a in not_init:
-                        a.parse_file(id, tag, content)
-                        sys.stdout.write("%i of %i images processed \r" % (i, total))
-                        sys.stdout.flush()
-                print '\nDone.'
-                self.rep.commit()
+                self.do_initialize('')
+    
+    def do_initialize(self, line):
+        """ Initializes all analyzers that are not initialized yet. """
+        
+        not_init = [a for a in self._a if a.needs_init()]
+        if not_init:
+            initialize_analyzers(self.rep, not_init, self.processes, streaming=self.streaming,
+                                 profile=self.profile)
+            self.save_stats()
     
     def precmd(self, line):
         """ If the command is the name of an analyzer, select this one. """
@@ -240,6 +627,40 @@ class AnalyzerCmd(cmd.Cmd, object):
             print "**ERROR** no such command"
     
     
+    def do_update(self, line):
+        """ Process the pages added to the repository since the analyzers 
+            were initialized.
+        """
+        
+        initialized = [a for a in self._a if a.TABLES and not a.needs_init()]
+        if initialized:
+            initialize_analyzers(self.rep, initialized, self.processes, incremental=True,
+                                 streaming=self.streaming, profile=self.profile)
+            self.save_stats()
+    
+    def do_stats(self, line):
+        """ Usage: stats [reset|save <file>]. Shows how long each phase of 
+            the initializations in this session took (reading the pages, 
+            parsing them, extracting and storing the data of each analyzer).
+            "reset" clears the statistics, "save" writes them as JSON.
+        """
+        
+        parts = line.split()
+        if not parts:
+            self.profile.report()
+        elif parts[0] == 'reset':
+            self.profile.reset()
+        elif parts[0] == 'save' and len(parts) == 2:
+            self.profile.save(parts[1])
+        else:
+            print "**ERROR** Usage: stats [reset|save <file>]"
+            
+    def save_stats(self):
+        """ Writes the statistics to the stats file, if one is set. """
+        
+        if self.stats_file:
+            self.profile.save(self.stats_file)
+    
     def do_exit(self, line):
         """ Exits the programm."""
         
@@ -253,11 +674,13 @@ class AnalyzerCmd(cmd.Cmd, object):
         if line in self.analyzers:
             self.context = self.analyzers[line]
             if self.context.needs_init():
-                init = ''
+                init = '' if self.interactive else 'yes'
                 while init.lower() != 'no' and init.lower() != 'yes':
                     init = raw_input("The analyzer %s is not yet initialized\nInitialize now? (yes/no): " % line)
                 if init.lower() == 'yes':
-                    self.context.initialize()
+                    self.context.initialize(self.processes, streaming=self.streaming, 
+                                            profile=self.profile)
+                    self.save_stats()
                     self.prompt = ('(a:%s)> ' % self.context.NAME)
                 else:
                     self.context = None
@@ -0,0 +1,394 @@
+#!/usr/bin/env python
+'''
+Created on Nov 8, 2010
+
+Benchmarks for the performance critical parts of the application.
+
+    python benchmark.py fetch [-n IMAGES] [-t THREADS]
+    python benchmark.py compression [-n PAGES] [--packed] REPOSITORY
+    python benchmark.py extract [-n PAGES] REPOSITORY
+    python benchmark.py suite [-s SIZES] [-j PROCESSES] [-o FILE]
+
+'''
+
+import threading, multiprocessing, itertools, os, sys, time, random, tempfile, shutil, json, platform
+from contextlib import contextmanager
+from Queue import Queue
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+
+from lxml import etree
+
+import settings, synthetic
+# the analyzers use the lexicon of the package
+from flickr_data_miner import lexicon
+from net import FileGetter, Fetcher
+from storage import Repository, COMPRESSION
+from util import get_class
+from analyzer import initialize_analyzers, _extract_serial
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    """ Answers every GET request with a page (or an image if the path starts
+        with /img) of fixed size. Keeps the connection alive.
+    """
+
+    protocol_version = 'HTTP/1.1'
+    # buffer the response, otherwise every header line is sent separately
+    wbufsize = -1
+
+    def do_GET(self):
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        body = self.server.image if self.path.startswith('/img') else self.server.page
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StandInServer(ThreadingMixIn, HTTPServer):
+    """ Local HTTP server that stands in for flickr in the fetch benchmark.
+
+        INPUT:
+            - page_size: Size of the HTML pages in bytes.
+            - image_size: Size of the thumbnails in bytes.
+            - latency: Seconds to wait before each response.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, page_size=40000, image_size=5000, latency=0.):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), StandInHandler)
+        self.page = 'x' * page_size
+        self.image = ''.join(chr(random.randint(0, 255)) for _ in xrange(image_size))
+        self.latency = latency
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%i' % self.server_address[1]
+
+    def start(self):
+        """ Serves in a separate process, so the server does not compete 
+            with the fetcher for the GIL.
+        """
+        
+        self._process = multiprocessing.Process(target=self.serve_forever)
+        self._process.daemon = True
+        self._process.start()
+        
+    def stop(self):
+        self._process.terminate()
+        self._process.join()
+        self.server_close()
+
+
+def fetch_thread_per_url(jobs, threads):
+    """ Fetches the jobs the way fetch_data did before the Fetcher existed:
+        one FileGetter thread per image, at most <threads> at a time.
+    """
+
+    queue = Queue(threads)
+    def producer():
+        for id, page, image in jobs:
+            thread = FileGetter(id, '', page, image)
+            thread.start()
+            queue.put(thread)
+    prod = threading.Thread(target=producer)
+    prod.start()
+    fetched = 0
+    for _ in jobs:
+        thread = queue.get()
+        thread.join()
+        fetched += thread.has_result
+    prod.join()
+    return fetched
+
+
+def fetch_pool(jobs, threads):
+    """ Fetches the jobs with a Fetcher of <threads> workers. """
+
+    fetcher = Fetcher(threads, per_host=threads)
+    fetched = sum(1 for _, contents in fetcher.fetch((id, (page, image)) for id, page, image in jobs) if contents)
+    fetcher.close()
+    return fetched
+
+
+def benchmark_fetch(images=2000, threads=50, latency=0.):
+    """ Compares the thread-per-URL fetching with the Fetcher against a local
+        stand-in server.
+
+        OUTPUT:
+            A dictionary that maps the name of each method to the images
+            fetched per second.
+    """
+
+    server = StandInServer(latency=latency)
+    server.start()
+    jobs = [(id, '%s/photos/user/%i/' % (server.url, id), '%s/img/%i.jpg' % (server.url, id))
+            for id in xrange(images)]
+    result = dict()
+    for name, method in (('thread-per-url', fetch_thread_per_url), ('pool', fetch_pool)):
+        start = time.time()
+        fetched = method(jobs, threads)
+        elapsed = time.time() - start
+        result[name] = fetched / elapsed
+        print "%s: %i images in %.2f s (%.1f images/s)" % (name.ljust(15), fetched, elapsed, fetched / elapsed)
+    server.stop()
+    return result
+
+
+def _disk_usage(path, exclude=('data.sqlite',)):
+    """ Size of all files below <path> in bytes. """
+
+    return sum(os.path.getsize(os.path.join(root, file))
+               for root, dirs, files in os.walk(path) for file in files if file not in exclude)
+
+
+def _drop_caches():
+    """ Drops the page cache of the OS (Linux, root only) to measure cold
+        reads. Returns whether it worked.
+    """
+
+    try:
+        os.system('sync')
+        with open('/proc/sys/vm/drop_caches', 'w') as f:
+            f.write('3\n')
+        return True
+    except IOError:
+        return False
+
+
+def benchmark_compression(path, pages=None, packed=False, cold=False):
+    """ Copies the pages of the repository at <path> into a temporary
+        repository for every compression method and measures the disk
+        footprint of the pages and the throughput of reading and parsing
+        them.
+
+        INPUT:
+            - path: The repository to take the pages from.
+            - pages: Maximum number of pages to use (default: all).
+            - packed: Use the packed format for the temporary repositories.
+            - cold: Drop the OS page cache before reading (needs root).
+
+        OUTPUT:
+            A dictionary that maps each method to a dictionary with the
+            keys 'bytes' and 'pages_per_second'.
+    """
+
+    source = Repository(path)
+    result = dict()
+    for method in [None] + sorted(COMPRESSION):
+        tmp = tempfile.mkdtemp()
+        try:
+            rep = Repository(tmp, new=True, packed=packed, compression=method)
+            for id, tag, content in itertools.islice(source.get_sites(), pages):
+                rep.add_site(tag, id, content)
+            rep.close()
+            size = _disk_usage(tmp)
+
+            if cold and not _drop_caches():
+                print "Could not drop the page cache, reads are warm."
+                cold = False
+            rep = Repository(tmp)
+            start = time.time()
+            count = 0
+            for id, tag, content in rep.get_sites():
+                etree.HTML(content)
+                count += 1
+            elapsed = time.time() - start
+            rep.close()
+        finally:
+            shutil.rmtree(tmp)
+        name = method or 'raw'
+        result[name] = {'bytes': size, 'pages_per_second': count / elapsed}
+        print "%s: %i pages, %.1f MB, read+parse %.1f pages/s" % (name.ljust(6), count, size / 2.**20, count / elapsed)
+    source.close()
+    return result
+
+
+def benchmark_extract(path, pages=None):
+    """ Extracts the data of the analyzers in settings.py from the pages of
+        the repository at <path> with the selectors and in streaming mode.
+        Verifies that both modes return the same data and measures their
+        throughput.
+
+        INPUT:
+            - path: The repository to take the pages from.
+            - pages: Maximum number of pages to use (default: all).
+
+        OUTPUT:
+            A dictionary that maps each mode to the pages per second and
+            'mismatches' to a dictionary that maps the name of each analyzer
+            to the number of pages both modes differ on.
+    """
+
+    analyzers = [get_class(m)(None) for m in settings.ANALYZERS]
+    analyzers = [a for a in analyzers if a.NEEDS_PAGES and not a.wants_raw_html()]
+    rep = Repository(path)
+    sites = list(itertools.islice(rep.get_sites(), pages))
+    rep.close()
+
+    values = dict()
+    result = dict()
+    for mode, streaming in (('selectors', False), ('streaming', True)):
+        start = time.time()
+        values[mode] = [v for _, _, _, v in _extract_serial(sites, analyzers, streaming)]
+        elapsed = time.time() - start
+        result[mode] = len(sites) / elapsed
+        print "%s: %i pages in %.2f s (%.1f pages/s)" % (mode.ljust(10), len(sites), elapsed, len(sites) / elapsed)
+
+    mismatches = dict((a.NAME, 0) for a in analyzers)
+    for (id, _, _), expected, streamed in itertools.izip(sites, values['selectors'], values['streaming']):
+        for a, e, s in itertools.izip(analyzers, expected, streamed):
+            if e != s:
+                if not mismatches[a.NAME]:
+                    print "%s differs on image %s: %r != %r" % (a.NAME, id, e, s)
+                mismatches[a.NAME] += 1
+    for name, count in sorted(mismatches.iteritems()):
+        print "%s: %i of %i pages differ" % (name.ljust(10), count, len(sites))
+    result['mismatches'] = mismatches
+    return result
+
+
+# commands of the TagAnalyzer that are timed by the suite
+TAG_QUERIES = ('count_unique_tags', 'count_tags', 'list_unique_tags', 'list_most_used 50',
+               'list_less_used 50', 'count_less_used', 'list_most_tagged 50', 'list_searched_tags')
+
+# arguments of PCAAnalyzer.build that are timed by the suite
+PCA_BUILDS = (
+    ('tags', dict(num_words=2500)),
+    ('tags+comments', dict(num_words=2500, with_comments=True)),
+    ('tags+comments log/entropy', dict(num_words=2500, with_comments=True, localw=2, globalw=4)),
+)
+
+
+@contextmanager
+def _quiet():
+    """ Discards everything printed in the block. """
+
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        yield
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+
+def _timed(function, *args, **kwargs):
+    """ Calls the function without output and returns the elapsed time. """
+
+    with _quiet():
+        start = time.time()
+        function(*args, **kwargs)
+        return time.time() - start
+
+
+def benchmark_suite(sizes=(500, 2000, 5000), processes=1, seed=0, repeat=3):
+    """ Runs the analyzers in settings.py on synthetic repositories (see
+        synthetic.py) of different sizes and measures:
+
+        - initialize: Analyzer.initialize of every analyzer on its own.
+        - bulk_initialize: Initializing all analyzers at once, as
+                           AnalyzerCmd.preloop does (also in streaming mode).
+        - tag_queries: The commands in TAG_QUERIES (best of <repeat> runs).
+        - pca_build: PCAAnalyzer.build with the arguments in PCA_BUILDS.
+
+        INPUT:
+            - sizes: The numbers of pages of the repositories.
+            - processes: Number of processes used to initialize the
+                         analyzers.
+            - seed: Seed of the page generator.
+            - repeat: How often each query is run.
+
+        OUTPUT:
+            A dictionary with the times in seconds, which can be written as
+            JSON.
+    """
+
+    tmp = tempfile.mkdtemp()
+    lexicon.set_lexicon(synthetic.write_lexicon(os.path.join(tmp, 'lexicon')))
+    result = {'created': time.strftime('%Y-%m-%dT%H:%M:%S'), 'python': platform.python_version(),
+              'processes': processes, 'seed': seed, 'runs': []}
+    try:
+        for size in sizes:
+            path = os.path.join(tmp, str(size))
+            start = time.time()
+            synthetic.generate(path, size, seed=seed)
+            run = {'pages': size, 'generate': time.time() - start}
+            rep = Repository(path)
+            analyzers = [get_class(m)(rep) for m in settings.ANALYZERS]
+            stored = [a for a in analyzers if a.TABLES]
+
+            run['initialize'] = dict((a.NAME, _timed(a.initialize, processes)) for a in stored)
+            for streaming in (False, True):
+                for a in stored:
+                    a.remove()
+                rep.commit()
+                key = 'bulk_initialize_streaming' if streaming else 'bulk_initialize'
+                run[key] = _timed(initialize_analyzers, rep, stored, processes, streaming=streaming)
+
+            named = dict((a.NAME, a) for a in analyzers)
+            run['tag_queries'] = dict((query, min(_timed(named['tags'].onecmd, query) for _ in xrange(repeat)))
+                                      for query in TAG_QUERIES)
+            run['pca_build'] = dict((name, _timed(named['pca'].build, **kwargs)) for name, kwargs in PCA_BUILDS)
+            rep.close()
+            shutil.rmtree(path)
+
+            print "%i pages: initialize %.2f s, bulk %.2f s (streaming %.2f s), tag queries %.3f s, pca %.2f s" % (
+                size, sum(run['initialize'].values()), run['bulk_initialize'], run['bulk_initialize_streaming'],
+                sum(run['tag_queries'].values()), sum(run['pca_build'].values()))
+            result['runs'].append(run)
+    finally:
+        lexicon.set_lexicon(None)
+        shutil.rmtree(tmp)
+    return result
+
+
+def main():
+    from optparse import OptionParser
+
+    parser = OptionParser(usage="""usage: %prog fetch [options]
+   or: %prog compression [options] REPOSITORY
+   or: %prog extract [options] REPOSITORY
+   or: %prog suite [options]""")
+    parser.add_option('-n', '--number', type='int', dest='number',
+                      help='number of images to fetch [default: 2000] or pages to read [default: all]')
+    parser.add_option('-t', '--threads', type='int', dest='threads', default=50,
+                      help='number of threads [default: %default]')
+    parser.add_option('-l', '--latency', type='float', dest='latency', default=0.,
+                      help='server latency in seconds [default: %default]')
+    parser.add_option('--packed', action='store_true', dest='packed', default=False,
+                      help='use packed repositories')
+    parser.add_option('--cold', action='store_true', dest='cold', default=False,
+                      help='drop the page cache before reading (Linux, needs root)')
+    parser.add_option('-s', '--sizes', dest='sizes', default='500,2000,5000',
+                      help='comma separated sizes of the synthetic repositories [default: %default]')
+    parser.add_option('-j', '--jobs', type='int', dest='jobs', default=1,
+                      help='number of processes used to initialize the analyzers [default: %default]')
+    parser.add_option('-o', '--output', dest='output',
+                      help='write the results of the suite as JSON to FILE', metavar='FILE')
+    (options, args) = parser.parse_args()
+
+    if args == ['fetch']:
+        benchmark_fetch(options.number or 2000, options.threads, options.latency)
+    elif len(args) == 2 and args[0] == 'compression':
+        benchmark_compression(args[1], options.number, options.packed, options.cold)
+    elif len(args) == 2 and args[0] == 'extract':
+        benchmark_extract(args[1], options.number)
+    elif args == ['suite']:
+        result = benchmark_suite([int(size) for size in options.sizes.split(',')], options.jobs)
+        if options.output:
+            with open(options.output, 'w') as f:
+                json.dump(result, f, indent=2, sort_keys=True)
+        else:
+            print json.dumps(result, indent=2, sort_keys=True)
+    else:
+        parser.error("See usage...")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,254 @@
+'''
+Created on Nov 17, 2010
+
+'''
+
+import re
+from lxml import etree
+
+# the fields that can be extracted, with the selector they correspond to
+DATE = 'date'           # #Photo .Widget a[property='dc:date']
+TAGS = 'tags'           # #thetags > div > a.Plain
+RATING = 'rating'       # #fave_countSpan
+COMMENTS = 'comments'   # #DiscussPhoto .comment-block
+
+FIELDS = (DATE, TAGS, RATING, COMMENTS)
+
+# id of the element that contains all matches of a field
+REGIONS = {
+    DATE: 'Photo',
+    TAGS: 'thetags',
+    RATING: 'fave_countSpan',
+    COMMENTS: 'DiscussPhoto',
+}
+
+CHARSET = re.compile(r'<meta[^>]+charset\s*=\s*["\']?([-\w]+)', re.I)
+
+
+class _Done(Exception):
+    """ Raised by the parser target to stop parsing. """
+
+
+class _Block(object):
+    """ A comment block that is currently parsed. """
+
+    def __init__(self, depth):
+        self.depth = depth
+        self.commenters = []
+        self.comments = []
+        self.dates = []
+
+
+class _PageTarget(object):
+    """ Parser target that collects the fields while lxml parses a page.
+
+        The parser reports the elements in document order, the path to the
+        current element is kept on a stack, so the selectors can be checked
+        without building the tree. Parsing is stopped once the regions of
+        all wanted fields are closed.
+    """
+
+    def __init__(self, fields):
+        self.wanted = frozenset(fields)
+        self.regions = frozenset(REGIONS[field] for field in self.wanted)
+        self.reset()
+
+    def reset(self):
+        self.fields = dict((field, []) for field in self.wanted)
+        self._stack = []
+        self._text = []
+        # values that get the text of the last started element
+        self._pending = []
+        # values that get all text until the element they belong to ends
+        self._collecting = []
+        self._blocks = []
+        self._closed = set()
+
+    def _flush(self):
+        """ Hands the text read since the last event to the values that
+            wait for it.
+        """
+
+        text = ''.join(self._text) if self._text else None
+        del self._text[:]
+        for values, i in self._pending:
+            values[i] = text
+        del self._pending[:]
+        if text:
+            for depth, parts in self._collecting:
+                parts.append(text)
+
+    def _wait_for_text(self, values):
+        values.append(None)
+        self._pending.append((values, len(values) - 1))
+
+    def _collect_text(self, values):
+        parts = []
+        values.append(parts)
+        self._collecting.append((len(self._stack) - 1, parts))
+
+    def _has_ancestor(self, depth, id=None, cls=None):
+        """ Checks whether an element above <depth> in the stack has the
+            given id or class.
+        """
+
+        for tag, el_id, classes in self._stack[:depth]:
+            if (id is None or el_id == id) and (cls is None or cls in classes):
+                return True
+        return False
+
+    def start(self, tag, attrib):
+        self._flush()
+        el = (tag, attrib.get('id'), attrib.get('class', '').split())
+        self._stack.append(el)
+        depth = len(self._stack) - 1
+        parent = self._stack[-2] if depth > 0 else (None, None, ())
+        fields = self.fields
+
+        if tag == 'a':
+            if (DATE in self.wanted and not fields[DATE]
+                and attrib.get('property') == 'dc:date'):
+                # a Widget below Photo
+                for i, (_, _, classes) in enumerate(self._stack[:-1]):
+                    if 'Widget' in classes and self._has_ancestor(i, id='Photo'):
+                        self._wait_for_text(fields[DATE])
+                        break
+            if (TAGS in self.wanted and 'Plain' in el[2] and parent[0] == 'div'
+                and depth > 1 and self._stack[-3][1] == 'thetags'):
+                self._wait_for_text(fields[TAGS])
+        if RATING in self.wanted and el[1] == 'fave_countSpan' and not fields[RATING]:
+            self._wait_for_text(fields[RATING])
+
+        if COMMENTS in self.wanted:
+            for block in self._blocks:
+                # the selectors of the block are "h4 > a", ".comment-content > p"
+                # and ".comment-content > p > small", the block itself can match
+                if tag == 'a' and parent[0] == 'h4' and depth - 1 >= block.depth and not block.commenters:
+                    self._wait_for_text(block.commenters)
+                elif tag == 'p' and 'comment-content' in parent[2] and depth - 1 >= block.depth and not block.comments:
+                    self._collect_text(block.comments)
+                elif (tag == 'small' and parent[0] == 'p' and depth > 1 and 'comment-content' in self._stack[-3][2]
+                      and depth - 2 >= block.depth and not block.dates):
+                    self._collect_text(block.dates)
+            if 'comment-block' in el[2] and self._has_ancestor(depth, id='DiscussPhoto'):
+                block = _Block(depth)
+                self._blocks.append(block)
+                fields[COMMENTS].append(block)
+
+    def end(self, tag):
+        self._flush()
+        depth = len(self._stack) - 1
+        tag, id, classes = self._stack.pop()
+        while self._collecting and self._collecting[-1][0] == depth:
+            self._collecting.pop()
+        while self._blocks and self._blocks[-1].depth == depth:
+            self._blocks.pop()
+        if id in self.regions:
+            self._closed.add(id)
+        if self._done():
+            raise _Done()
+
+    def data(self, text):
+        self._text.append(text)
+
+    def comment(self, text):
+        # the text around a comment are two separate nodes
+        self._flush()
+
+    def pi(self, target, data):
+        self._flush()
+
+    def close(self):
+        self._flush()
+        return self.fields
+
+    def _done(self):
+        """ Checks whether all wanted fields are complete. The ids are
+            assumed to be unique, so a field is complete once its region is
+            closed (or its first match is found, if only that is needed).
+        """
+
+        if self._pending:
+            return False
+        fields, closed = self.fields, self._closed
+        for field in self.wanted:
+            if REGIONS[field] not in closed and not (field in (DATE, RATING) and fields[field]):
+                return False
+        return True
+
+
+class Extractor(object):
+    """ Extracts fields of a page without building the document tree.
+
+        The start of the region of each field (the element with the id the
+        selector starts with, see REGIONS) is located in the raw HTML. Only
+        this region is parsed, by lxml's event driven parser, and parsing
+        stops as soon as the region is closed. The ids are assumed to be 
+        unique. The result contains the same values the corresponding 
+        selectors return on the parsed document:
+
+        - DATE, RATING: A list with the text of the first matching element
+                        (empty if there is none).
+        - TAGS: A list with the text of every matching element.
+        - COMMENTS: A list of comment blocks. Each block is a tuple of
+                    three lists, containing the text of the first commenter
+                    link, the text ("itertext") of the first comment
+                    paragraph and the text of the first date of the block
+                    (each list is empty if there is no such element).
+
+        INPUT:
+            - fields: The fields to extract (default: all).
+
+        EXAMPLE:
+            extractor = Extractor((TAGS, RATING))
+            fields = extractor.extract(html)
+            print fields[TAGS]
+    """
+
+    def __init__(self, fields=FIELDS):
+        self.fields = tuple(fields)
+        self._starts = dict((field, re.compile(r'<\w+[^<>]*\s[iI][dD]\s*=\s*["\']?%s["\'\s/>]' % REGIONS[field]))
+                            for field in self.fields)
+        self._targets = dict((field, _PageTarget((field,))) for field in self.fields)
+        # parsers per field and encoding
+        self._parsers = dict()
+
+    def _parse(self, field, data, encoding):
+        key = (field, encoding)
+        if key not in self._parsers:
+            self._parsers[key] = etree.HTMLParser(target=self._targets[field], encoding=encoding)
+        target = self._targets[field]
+        target.reset()
+        try:
+            etree.HTML(data, self._parsers[key])
+        except _Done:
+            pass
+        return target.fields[field]
+
+    def extract(self, data):
+        """ Extracts the fields of the HTML page <data>.
+
+            OUTPUT:
+                A dictionary that maps each field to its values.
+        """
+
+        # the regions are parsed without the head of the page
+        match = CHARSET.search(data, 0, 4096)
+        encoding = match.group(1).lower() if match else None
+        fields = dict()
+        for field in self.fields:
+            region = REGIONS[field]
+            if region not in data:
+                fields[field] = []
+                continue
+            start = self._starts[field].search(data)
+            if start is None:
+                # unusual markup, parse the whole page
+                fields[field] = self._parse(field, data, None)
+            else:
+                fields[field] = self._parse(field, data[start.start():], encoding)
+        if COMMENTS in fields:
+            fields[COMMENTS] = [(b.commenters,
+                                 [' '.join(parts) for parts in b.comments],
+                                 [' '.join(parts) for parts in b.dates]) for b in fields[COMMENTS]]
+        return fields
@@ -0,0 +1,256 @@
+'''
+Created on Nov 26, 2010
+
+Answers the analyzer commands over several repositories at once.
+
+'''
+
+import heapq, collections, itertools
+from multiprocessing.pool import ThreadPool
+
+from storage import Repository
+from analyzer import BasicImageAnalyzer
+from data_analyzer.tag_analyzer import TagAnalyzer
+from data_analyzer.comment_analyzer import CommentAnalyzer
+from data_analyzer.rating_analyzer import RatingAnalyzer
+
+
+class FederatedRepository(object):
+    """ A read-only view of the union of several repositories, e.g. of
+        several fetch runs.
+
+        Every repository keeps its own DB connection. Queries are run on
+        all of them concurrently (SQLite does not hold the GIL while it
+        executes a statement), the analyzers merge the results. The DBs are
+        not attached to a single connection: SQLite allows only a few
+        attached DBs and runs the statements of one connection one after
+        another.
+
+        Images fetched into several repositories are counted once per
+        repository.
+
+        INPUT:
+            - dirs: The directories of the repositories.
+            - threads: Number of repositories queried at the same time
+                       (default: all).
+    """
+
+    def __init__(self, dirs, threads=None):
+        self.repositories = [Repository(dir) for dir in dirs]
+        self.path = ', '.join(rep.path for rep in self.repositories)
+        self._pool = ThreadPool(threads or len(self.repositories))
+
+    def map(self, function, items=None):
+        """ Calls function(item) for every item concurrently, by default for
+            every repository.
+
+            OUTPUT:
+                The results, in the order of the items.
+        """
+
+        return self._pool.map(function, self.repositories if items is None else items, chunksize=1)
+
+    def query(self, sql, parameters=()):
+        """ Runs the query on every repository.
+
+            OUTPUT:
+                A list with the rows of each repository.
+        """
+
+        return self.map(lambda rep: rep.db_conn.execute(sql, parameters).fetchall())
+
+    def query_value(self, sql, parameters=()):
+        """ Runs a query that returns a single value on every repository.
+
+            OUTPUT:
+                A list with the value of each repository.
+        """
+
+        return [rows[0][0] if rows else None for rows in self.query(sql, parameters)]
+
+    @property
+    def total_images(self):
+        return sum(rep.total_images for rep in self.repositories)
+
+    def close(self):
+        self._pool.close()
+        self._pool.join()
+        for rep in self.repositories:
+            rep.close()
+
+
+class FederatedAnalyzer(object):
+    """ Mixin for analyzers that answer their commands for a
+        FederatedRepository. The commands of the analyzer are run on each
+        repository by an instance of ANALYZER and the results are merged.
+
+        The repositories are initialized separately, the federated 
+        analyzers only query them.
+    """
+
+    ANALYZER = None
+    # no tables of its own, so AnalyzerCmd never initializes it
+    TABLES = tuple()
+
+    def init(self):
+        super(FederatedAnalyzer, self).init()
+        self._analyzers = None
+
+    def each(self, function):
+        """ Calls function(analyzer) for the analyzer of every repository
+            concurrently.
+
+            OUTPUT:
+                The results, in the order of the repositories.
+        """
+
+        if self._analyzers is None:
+            self._analyzers = [self.ANALYZER(rep) for rep in self.repository.repositories]
+        return self.repository.map(function, self._analyzers)
+
+    def needs_init(self):
+        return False
+
+    def initialize(self, *args, **kwargs):
+        raise Exception("Federated repositories cannot be initialized, initialize each repository instead.")
+
+    def create_indexes(self):
+        self.each(lambda analyzer: analyzer.create_indexes())
+
+    def do_recreate(self, line):
+        """ Not available for federated repositories. """
+
+        print "**ERROR** Recreate the analyzer in each repository instead."
+
+    def do_update(self, line):
+        """ Not available for federated repositories. """
+
+        print "**ERROR** Update the analyzer in each repository instead."
+
+
+def _sum(values):
+    """ Sum of the values that are not None (None if there are none). """
+
+    values = [value for value in values if value is not None]
+    return sum(values) if values else None
+
+def _union(lists):
+    return sorted(set(item for items in lists for item in items))
+
+
+class FederatedBasicImageAnalyzer(FederatedAnalyzer, BasicImageAnalyzer):
+    """ Provides information about basic data (id, search tag, date) of all repositories. """
+
+    ANALYZER = BasicImageAnalyzer
+
+    def image_count(self):
+        return _sum(self.each(lambda analyzer: analyzer.image_count()))
+
+    def uploaded(self, oldest=True):
+        images = [image for image in self.each(lambda analyzer: analyzer.uploaded(oldest)) if image is not None]
+        if not images:
+            return None
+        return (min if oldest else max)(images, key=lambda image: image[1])
+
+    def searched_tags(self):
+        return _union(self.each(lambda analyzer: analyzer.searched_tags()))
+
+
+class FederatedTagAnalyzer(FederatedAnalyzer, TagAnalyzer):
+    """ Provides various information about the tags of all repositories. """
+
+    ANALYZER = TagAnalyzer
+
+    def ensure_aggregates(self):
+        self.each(lambda analyzer: analyzer.ensure_aggregates())
+
+    def unique_tag_count(self):
+        return len(self.unique_tags())
+
+    def assigned_tag_count(self):
+        return _sum(self.each(lambda analyzer: analyzer.assigned_tag_count()))
+
+    def unique_tags(self):
+        return _union(self.each(lambda analyzer: analyzer.unique_tags()))
+
+    def ranked_tags(self, limit=None, ascending=False):
+        # the counts of a tag are spread over the repositories, so all 
+        # counts are needed
+        counts = collections.defaultdict(int)
+        for tags in self.each(lambda analyzer: analyzer.ranked_tags()):
+            for name, count in tags:
+                counts[name] += count
+        sign = 1 if ascending else -1
+        tags = sorted(counts.iteritems(), key=lambda (name, count): (sign * count, name))
+        return tags if limit is None else tags[:limit]
+
+    def rarest_tags(self):
+        counts = [count for _, count in self.ranked_tags()]
+        if not counts:
+            return None, 0
+        return counts[-1], counts.count(counts[-1])
+
+    def most_tagged_images(self, limit):
+        # the most tagged images of every repository are enough
+        images = heapq.merge(*[[(-count, id) for id, count in images] for images in 
+                               self.each(lambda analyzer: analyzer.most_tagged_images(limit))])
+        return [(id, -count) for count, id in itertools.islice(images, limit)]
+
+    def searched_tag_counts(self):
+        searched = set(tag for tags in self.repository.query('SELECT DISTINCT tag FROM images') for tag, in tags)
+        return [(name, count) for name, count in self.ranked_tags() if name in searched]
+
+
+class FederatedCommentAnalyzer(FederatedAnalyzer, CommentAnalyzer):
+    """ Provides various information about the comments of all repositories. """
+
+    ANALYZER = CommentAnalyzer
+
+    def comment_count(self, image_id=None):
+        return _sum(self.each(lambda analyzer: analyzer.comment_count(image_id)))
+
+    def comments(self, image_id=None):
+        if image_id is not None:
+            return itertools.chain(*self.each(lambda analyzer: list(analyzer.comments(image_id))))
+        # merge the comments, ordered by image
+        rows = heapq.merge(*self.repository.query('SELECT image_id, content FROM image_comment ORDER BY image_id'))
+        return (comment for _, comment in rows)
+
+
+class FederatedRatingAnalyzer(FederatedAnalyzer, RatingAnalyzer):
+    """ Provides various information about the ratings of all repositories. """
+
+    ANALYZER = RatingAnalyzer
+
+    def average_rating(self):
+        rows = [rows[0] for rows in self.repository.query('SELECT SUM(rating), COUNT(rating) FROM image_rating')]
+        total, count = _sum(total for total, _ in rows), _sum(count for _, count in rows)
+        return float(total) / count if count else None
+
+    def total_rating(self):
+        return _sum(self.each(lambda analyzer: analyzer.total_rating()))
+
+    def max_rating(self):
+        ratings = [rating for rating in self.each(lambda analyzer: analyzer.max_rating()) if rating is not None]
+        return max(ratings, key=lambda rating: rating[0]) if ratings else None
+
+
+# the federated version of each analyzer in settings.ANALYZERS
+FEDERATED_ANALYZERS = {
+    'BasicImageAnalyzer': FederatedBasicImageAnalyzer,
+    'TagAnalyzer': FederatedTagAnalyzer,
+    'CommentAnalyzer': FederatedCommentAnalyzer,
+    'RatingAnalyzer': FederatedRatingAnalyzer,
+}
+
+def federated_analyzers(repository, names):
+    """ Creates the federated analyzers for a FederatedRepository.
+
+        INPUT:
+            - repository: The FederatedRepository.
+            - names: Full paths of the analyzer classes (see settings.py).
+                     Analyzers without a federated version are left out.
+    """
+
+    return [FEDERATED_ANALYZERS[name.split('.')[-1]](repository) for name in names
+            if name.split('.')[-1] in FEDERATED_ANALYZERS]
@@ -4,51 +4,194 @@ Created on Jun 2, 2010
 @author: kling
 '''
 
-import os, urllib2
+import os, marshal, hashlib
 from lxml import etree
 
+import settings
+from net import Fetcher
+
 WORDLIST_URL = 'http://www.insightin.com/esl/%d.php'
 STOPLIST_URL = 'http://ir.dcs.gla.ac.uk/resources/linguistic_utils/stop_words'
 
 PATH = os.path.expanduser('~/.wordlist-lexicon')
 WORDLIST = 'wordlist.txt'
 STOPLIST = 'stoplist.txt'
+CACHE = 'lexicon.marshal'
+
+MAX_WORDS = 6000
+# the word list is spread over these pages, the number is the rank of the
+# last word on the page
+PAGES = [1000, 2000] + range(2100, 6100, 100)
+
+
+class Lexicon(object):
+    """ Provides the most used words in the English language.
+
+        The words are downloaded once and kept in a cache file in <path>. If
+        a word list (and stop list) is given, nothing is downloaded at all.
+        Results are memoized, so repeated calls with the same arguments are
+        cheap.
 
-def wordlist(amount, remove_stop_words=True):
-    """ Gets the most used words in the English language.
-    
         INPUT:
-            - amount: Number of words to fetch (max: 6000)
-            - remove_stop_words: Don't return stop words (default: True)
-        
-        OUTPUT:
-            A list of words.
+            - path: Directory of the cache.
+            - wordlist_file: Text file with one word per line, most used
+                             first (optional).
+            - stoplist_file: Text file with one stop word per line
+                             (optional).
+            - threads: Number of pages that are downloaded concurrently.
     """
-    
-    amount = amount % 6001;
-    fetch_data = True
-    words = list()   
-    if not os.path.exists(PATH):
-        os.mkdir(PATH)
-    
-    if os.path.exists(os.path.join(PATH, WORDLIST)):
-        with open(os.path.join(PATH, WORDLIST), 'r') as f:
-            contained_words = int(f.readline())
-            if contained_words >= amount: 
-                fetch_data = False
-                words.extend([w.strip().lower() for w in f])
-        
-    if fetch_data:
-        l = [1000,2000] + range(2100, 6100, 100)
-        
-
-        fetched = 0
-        for i in l:
-            if i - amount >= 100:
-                break
-            data = urllib2.urlopen(WORDLIST_URL % i).read()
-            html = etree.HTML(data)
-            fetched = i
+
+    def __init__(self, path=PATH, wordlist_file=None, stoplist_file=None, threads=8):
+        self.path = path
+        self.wordlist_file = wordlist_file
+        self.stoplist_file = stoplist_file
+        self.threads = threads
+        self._words = None
+        self._fetched = 0
+        self._stops = None
+        self._loaded = False
+        self._memo = dict()
+
+    def wordlist(self, amount, remove_stop_words=True):
+        """ Gets the most used words in the English language.
+
+            INPUT:
+                - amount: Number of words to fetch (max: 6000)
+                - remove_stop_words: Don't return stop words (default: True)
+
+            OUTPUT:
+                A list of words.
+        """
+
+        amount = amount % (MAX_WORDS + 1)
+        key = (amount, remove_stop_words)
+        if key not in self._memo:
+            words = self.words(amount)
+            if remove_stop_words:
+                stops = self.stop_words()
+                words = [w for w in words if w not in stops]
+            self._memo[key] = tuple(words[:amount])
+        return list(self._memo[key])
+
+    def words(self, amount):
+        """ Returns at least the <amount> most used words (if available),
+            including stop words.
+        """
+
+        if not self._loaded:
+            self._load()
+        if self._fetched < amount and not self.wordlist_file:
+            self._download_words(amount)
+            self._save()
+        return self._words
+
+    def stop_words(self):
+        """ Returns the set of stop words. """
+
+        if not self._loaded:
+            self._load()
+        if self._stops is None:
+            self._stops = frozenset(self._download(STOPLIST_URL).split())
+            self._save()
+        return self._stops
+
+    def signature(self):
+        """ Returns a string that changes when the word list or the stop
+            list changes, without loading the lexicon. The downloaded lists
+            do not change.
+        """
+
+        parts = []
+        for path in (self.wordlist_file, self.stoplist_file):
+            if path and os.path.exists(path):
+                with open(path, 'rb') as f:
+                    path = hashlib.sha1(f.read()).hexdigest()
+            parts.append(path)
+        return repr(parts)
+
+    def _load(self):
+        """ Reads the word list and the stop words from the given files or
+            the cache. Called only once.
+        """
+
+        self._loaded = True
+        self._words = []
+        if self.wordlist_file:
+            self._words = self._read_lines(self.wordlist_file)
+            self._fetched = len(self._words)
+            if self._words and self._words[0].isdigit():
+                self._fetched = int(self._words.pop(0))
+            self._words = [w.lower() for w in self._words]
+        if self.stoplist_file:
+            self._stops = frozenset(self._read_lines(self.stoplist_file))
+            if self.wordlist_file:
+                return
+
+        cache = os.path.join(self.path, CACHE)
+        if os.path.exists(cache):
+            try:
+                with open(cache, 'rb') as f:
+                    fetched, words, stops = marshal.load(f)
+            except (EOFError, ValueError, TypeError):
+                pass
+            else:
+                if not self.wordlist_file:
+                    self._fetched, self._words = fetched, list(words)
+                if not self.stoplist_file and stops is not None:
+                    self._stops = frozenset(stops)
+                return
+
+        # plain text cache of earlier versions
+        if not self.wordlist_file and os.path.exists(os.path.join(self.path, WORDLIST)):
+            lines = self._read_lines(os.path.join(self.path, WORDLIST))
+            self._fetched = int(lines[0])
+            self._words = [w.lower() for w in lines[1:]]
+        if not self.stoplist_file and os.path.exists(os.path.join(self.path, STOPLIST)):
+            self._stops = frozenset(self._read_lines(os.path.join(self.path, STOPLIST)))
+        if self._words or self._stops is not None:
+            self._save()
+
+    def _save(self):
+        """ Writes the words and stop words to the cache. """
+
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+        stops = tuple(sorted(self._stops)) if self._stops is not None else None
+        words = tuple(self._words) if not self.wordlist_file else ()
+        fetched = self._fetched if not self.wordlist_file else 0
+        with open(os.path.join(self.path, CACHE), 'wb') as f:
+            marshal.dump((fetched, words, stops), f)
+
+    def _read_lines(self, path):
+        with open(path, 'r') as f:
+            return [w for w in (line.strip() for line in f) if w]
+
+    def _download(self, url):
+        fetcher = Fetcher(1)
+        try:
+            return fetcher.get(url)
+        except IOError as e:
+            raise Exception(self._unavailable(url, e))
+        finally:
+            fetcher.close()
+
+    def _download_words(self, amount):
+        """ Downloads all pages that are needed for <amount> words. """
+
+        pages = PAGES[:1] + [i for i in PAGES[1:] if i - amount < 100]
+        fetcher = Fetcher(min(self.threads, len(pages)), per_host=self.threads)
+        contents = dict()
+        try:
+            for i, result in fetcher.fetch((i, (WORDLIST_URL % i,)) for i in pages):
+                if result is None:
+                    raise Exception(self._unavailable(WORDLIST_URL % i))
+                contents[i] = result[0]
+        finally:
+            fetcher.close()
+
+        words = list()
+        for i in pages:
+            html = etree.HTML(contents[i])
             if i > 2000:
                 # words are contained in links
                 # NOTE: lxml creates valid XHTML therefore the XPath differs from what might be expected
@@ -56,29 +199,45 @@ def wordlist(amount, remove_stop_words=True):
             else:
                 # splits the text into parts and takes out the words
                 words.extend(html.xpath("//pre/text()")[0].split()[1::2])
-                
-        words = map(str.lower, words)
-        
-        f = open(os.path.join(PATH, WORDLIST), 'w')
-        f.write('%d\n' % fetched)
-        f.write('\n'.join(words))
-        f.close()
-    
-    #words = words[:amount]
-    
-    if remove_stop_words:
-        stops = []
-        if not os.path.exists(os.path.join(PATH, STOPLIST)):
-            data = urllib2.urlopen(STOPLIST_URL).read()
-            with open(os.path.join(PATH, STOPLIST), 'w') as f:
-                f.write(data)
-            stops = data.split()
-        else:
-            with open(os.path.join(PATH, STOPLIST), 'r') as f:
-                stops = [w.strip() for w in f]
-        return filter(lambda x: x not in stops, words)[:amount]
-    
-    return words[:amount]
-                
+        self._words = map(str.lower, words)
+        self._fetched = pages[-1]
+
+    def _unavailable(self, url, error=None):
+        return ("The lexicon is not cached and %s could not be downloaded%s. "
+                "Set LEXICON_WORDLIST and LEXICON_STOPLIST in settings.py to "
+                "local files to work offline." % (url, ' (%s)' % error if error else ''))
+
+
+_lexicon = None
+
+def get_lexicon():
+    """ Returns the lexicon configured in settings.py. """
+
+    global _lexicon
+    if _lexicon is None:
+        _lexicon = Lexicon(wordlist_file=settings.LEXICON_WORDLIST,
+                           stoplist_file=settings.LEXICON_STOPLIST)
+    return _lexicon
+
+def set_lexicon(lexicon):
+    """ Replaces the lexicon returned by get_lexicon, e.g. by one that uses
+        a local word list.
+    """
+
+    global _lexicon
+    _lexicon = lexicon
+
+def wordlist(amount, remove_stop_words=True):
+    """ Gets the most used words in the English language (see
+        Lexicon.wordlist).
+    """
+
+    return get_lexicon().wordlist(amount, remove_stop_words)
+
+def signature():
+    """ Identifies the words of the lexicon (see Lexicon.signature). """
+
+    return get_lexicon().signature()
+
 if __name__ == '__main__':
-    print len(wordlist(100))
\ No newline at end of file
+    print len(wordlist(100))
@@ -3,21 +3,76 @@
 Created on Apr 16, 2010
 
 '''
-import threading, os, sys, urllib2, lxml.html
+import os, sys, time, json, multiprocessing, lxml.html
 from datetime import datetime
-from Queue import Queue
+from StringIO import StringIO
 from lxml import etree
 from lxml.cssselect import CSSSelector
 
 
 import settings
-from storage import Repository
-from net import FileGetter
+from storage import Repository, COMPRESSION
+from net import Fetcher
+from plan import FetchPlan
 from util import ProgressBar, get_class
 from analyzer import AnalyzerCmd
 
+# the fetch state is committed after this many images
+CHECKPOINT_INTERVAL = 100
 
 
+def iter_urls(tags=None, pages=1, threads=4):
+    """ Fetches the URLs of the thumbnails and HTML pages of flickr images.
+    
+        The search pages of all tags are fetched concurrently, but the 
+        results are generated in the order of the tags and pages. An image 
+        found for several tags therefore always belongs to the first of 
+        them, just as if the pages were fetched one after another.
+    
+        INPUT:
+            - tags: A sequence of tags to search for.
+            - pages: The number of pages to examine per tag
+            - threads: The number of search pages fetched concurrently.
+            
+        OUTPUT:
+            An iterator over tuples of the form 
+            (tag, image-id, page_url, thumbnail_url)
+    """
+    
+    if not tags:
+        return
+    
+    search_pages = [(tag, page) for tag in tags for page in range(1,pages+1)]
+    jobs = ((i, (settings.SEARCH_URL.format(tags=tag, page=page),)) 
+            for i, (tag, page) in enumerate(search_pages))
+    
+    ids = set()
+    finished = dict()
+    next_page = 0
+    fetcher = Fetcher(threads)
+    try:
+        for i, contents in fetcher.fetch(jobs):
+            finished[i] = contents
+            # generate the results of all pages whose predecessors are done
+            while next_page in finished:
+                contents = finished.pop(next_page)
+                tag = search_pages[next_page][0]
+                next_page += 1
+                if not contents:
+                    continue
+                dom = lxml.html.document_fromstring(contents[0])
+                for link in dom.cssselect(settings.THUMBNAIL_LINK_SELECTOR):
+                    # get and fetch page_url
+                    page_link = settings.BASE_URL + link.get('href')
+                    id = long(page_link.split('/')[-2])
+                    if id not in ids:
+                        ids.add(id)
+                        image_link = link.find('img').get('src')
+                        yield (tag, id, page_link, image_link)
+    finally:
+        fetcher.close()
+        
+
 def get_urls(tags=None, pages=1):
     """ Fetches the URLs of the thumbnails and HTML pages of flickr images.
     
@@ -31,107 +86,257 @@ def get_urls(tags=None, pages=1):
             
     """
     
-    if not tags:
-        return dict()
-    
-    ids = set()
-    result = dict()
-    for tag in tags:
-        l = list()
-        for page in range(1,pages+1):
-            source = urllib2.urlopen(settings.SEARCH_URL.format(tags=tag, page=page)).read()
-            dom = lxml.html.document_fromstring(source)
-            for link in dom.cssselect(settings.THUMBNAIL_LINK_SELECTOR):
-                # get and fetch page_url
-                page_link = settings.BASE_URL + link.get('href')
-                id = long(page_link.split('/')[-2])
-                if id not in ids:
-                    ids.add(id)
-                    image_link = link.find('img').get('src')
-                    l.append((id, page_link, image_link))
-        result[tag] = l
+    result = dict((tag, list()) for tag in tags or ())
+    for tag, id, page_link, image_link in iter_urls(tags, pages):
+        result[tag].append((id, page_link, image_link))
     return result
                 
 
 
-def fetch_data(dir, tags=None, print_progress=False, threads=50):
+def fetch_data(dir, tags=None, print_progress=False, threads=50, packed=False,
+               per_host=8, rate=None, retries=3, compression=None, resume=False):
     """ Fetches the content of the URLs provided via tags into the directory
         specified by dir.
         
+        The URLs are fetched by a fixed pool of worker threads (see 
+        net.Fetcher) and every image is stored as soon as its page and 
+        thumbnail are fetched.
+        
+        The URLs and the state of every image are kept in the repository 
+        (see FetchPlan) and committed every CHECKPOINT_INTERVAL images. A 
+        resumed run only fetches the images that were not fetched yet or 
+        failed, and examines the search pages only if the interrupted run 
+        did not finish them.
+        
         INPUT:
             - dir: The directory to store the data
-            - tags: A dictionary of tags, each containing a list of tuples.
-                    See 'get_urls'.
+            - tags: A dictionary of tags, each containing a list of tuples
+                    (see 'get_urls'), or an iterator over tuples 
+                    (see 'iter_urls'). An iterator is consumed while the
+                    data is fetched.
             - print_progress: Show a progress bar
-            - threads: The maximum amount of threads that are started to fetch
-                       the data.
+            - threads: The number of worker threads that fetch the data.
+            - packed: Store the data in the packed format (see Repository).
+            - per_host: The maximum number of concurrent requests per host.
+            - rate: The maximum number of requests per second and host 
+                    (default: unlimited).
+            - retries: How often a failed request is retried.
+            - compression: Compression method for the pages (see 
+                           storage.COMPRESSION).
+            - resume: Continue an interrupted run in the existing repository
+                      <dir> (packed and compression are taken from it).
         OUTPUT:
-            None
+            A dictionary with the number of fetched images per tag.
     """
     
-    if not tags:
-        return
+    if not tags and not resume:
+        return dict()
     
-    repository = Repository(dir, new=True)
+    if resume and os.path.exists(os.path.join(dir, 'data.sqlite')):
+        repository = Repository(dir)
+    else:
+        repository = Repository(dir, new=True, packed=packed, compression=compression)
     repository.set_last()
+    plan = FetchPlan(repository)
     
-    # Function to be executed by the producer thread. Creates a new thread
-    # for each URL and puts it into a queue
-    def producer(queue, tags):
-        try:
+    if isinstance(tags, dict):
+        if not plan.complete:
             for tag in tags:
                 for id, page_url, image_url in tags[tag]:
-                    thread = FileGetter(id, tag, page_url, image_url)
-                    thread.start()
-                    queue.put(thread, True)
-        except KeyboardInterrupt:
-            raise
-    
-    # Function to be executed by the consumer thread. Gets every thread in the
-    # queue, joins it to terminate it properly and stores the data in a repository.
-    def consumer(queue, rep, total_files, print_progress):
-        if print_progress:
-            bar = ProgressBar(total_files, width=50)
-                
-        counter = 0
-        try:
-            while counter < total_files: # run until all images are fetched
-                thread = queue.get(True)
-                thread.join()
-                if thread.has_result:
-                    rep.add_site(thread.tag, thread.id, thread.page)
-                    rep.add_image(thread.tag, thread.id, thread.image)
-                    counter += 1
-                    if print_progress:
-                        bar.add()
-                else:
+                    plan.add(tag, id, page_url, image_url)
+            plan.set_complete()
+        tags = None
+    # the search pages are examined while the images are fetched
+    search = not plan.complete and tags is not None
+    
+    pending = list()
+    for tag, id, page_url, image_url in plan.unfinished():
+        if repository.has_site(tag, id) and repository.has_image(tag, id):
+            # stored right before the last run was interrupted
+            plan.done(id)
+        else:
+            pending.append((tag, id, page_url, image_url))
+    total_files = None if search else len(pending) # not known while the URLs are streamed
+    discovered = [0]
+    
+    def jobs():
+        for tag, id, page_url, image_url in pending:
+            discovered[0] += 1
+            yield ((tag, id), (page_url, image_url))
+        if search:
+            for tag, id, page_url, image_url in tags:
+                if plan.add(tag, id, page_url, image_url):
+                    discovered[0] += 1
+                    yield ((tag, id), (page_url, image_url))
+            plan.set_complete()
+    
+    if print_progress and total_files:
+        bar = ProgressBar(total_files, width=50)
+    
+    fetcher = Fetcher(threads, per_host=per_host, rate=rate, retries=retries)
+    counter = 0
+    processed = 0
+    fetched = dict()
+    try:
+        for (tag, id), contents in fetcher.fetch(jobs()):
+            if contents:
+                page, image = contents
+                repository.add_site(tag, id, page)
+                repository.add_image(tag, id, image)
+                plan.done(id)
+                fetched[tag] = fetched.get(tag, 0) + 1
+                counter += 1
+                if print_progress and total_files:
+                    bar.add()
+            else:
+                plan.failed(id)
+                if total_files is not None:
                     total_files -= 1
-                    if print_progress:
+                    if print_progress and total_files:
                         bar = ProgressBar(total_files, width=50)
                         bar.add(counter)
+            processed += 1
+            if processed % CHECKPOINT_INTERVAL == 0:
+                plan.checkpoint()
     
-                if print_progress:
-                    sys.stdout.write("%i%% %r fetched %i of %i \r" %( counter*100/total_files, bar, counter, total_files))
-                    sys.stdout.flush()
-        except KeyboardInterrupt:
-            raise
+            if print_progress and total_files:
+                sys.stdout.write("%i%% %r fetched %i of %i \r" %( counter*100/total_files, bar, counter, total_files))
+                sys.stdout.flush()
+            elif print_progress and total_files is None:
+                sys.stdout.write("fetched %i of %i images found so far \r" %(counter, discovered[0]))
+                sys.stdout.flush()
+        
+        failed = plan.count(FetchPlan.FAILED)
+        if print_progress and failed:
+            print "\n%i images could not be fetched, use --resume to retry them." % failed
+    finally:
+        fetcher.close()
+        repository.close()
+    return fetched
     
+
+class _Output(object):
+    """ Collects what a command prints. """
     
-    q = Queue(threads)
-    prod_thread = threading.Thread(target=producer, args=(q, tags))
-    total = reduce(lambda x,y: x+y, [len(tags[tag]) for tag in tags])
-    cons_thread = threading.Thread(target=consumer, args=(q, repository, total, print_progress))
-    prod_thread.start()
-    cons_thread.start()
-    prod_thread.join()
-    cons_thread.join()
+    def __init__(self):
+        self.parts = []
+        
+    def write(self, text):
+        if isinstance(text, str):
+            text = text.decode('utf-8', 'replace')
+        self.parts.append(text)
+        
+    def flush(self):
+        pass
+    
+    def getvalue(self):
+        return u''.join(self.parts)
+    
+    def error(self):
+        """ The first error message that was printed ("**ERROR** ..." or 
+            "*** ..." of cmd.Cmd, e.g. for unknown commands) or None.
+        """
+        
+        for line in self.getvalue().splitlines():
+            if line.startswith('**ERROR**') or line.startswith('*** '):
+                return line
+        return None
+
+
+def run_script(path, commands, streaming=False):
+    """ Runs analyzer commands on a repository without asking questions. 
+        Analyzers that are not initialized yet are initialized first.
+        
+        INPUT:
+            - path: The directory of the repository.
+            - commands: A list of commands as they are typed in the analyzer
+                        mode, with all parameters, e.g. 
+                        "tags list_most_used 20" or "pca build 2500 comments".
+            - streaming: Use the streaming mode to initialize the analyzers.
+            
+        OUTPUT:
+            A dictionary with the keys 'repository', 'error' (if the 
+            repository could not be opened) and 'results', a list with a 
+            dictionary for every command (including the initialization): 
+            'command', 'output' (the printed text), 'error' and 'seconds'.
+            Error messages the command printed, e.g. for an unknown 
+            command, are reported as error, too.
+    """
+    
+    result = {'repository': path, 'error': None, 'results': []}
+    try:
+        rep = Repository(path)
+    except Exception as e:
+        result['error'] = '%s: %s' % (e.__class__.__name__, e)
+        return result
+    
+    try:
+        analyzers = [get_class(m)(rep) for m in settings.ANALYZERS]
+        _cmd = AnalyzerCmd(rep, analyzers, streaming=streaming, interactive=False)
+        # cmd.Cmd writes the help and unknown commands to its own stdout
+        cmds = [_cmd] + analyzers
+        for line in ['initialize'] + list(commands):
+            output, stdout, stdin = _Output(), sys.stdout, sys.stdin
+            error = None
+            start = time.time()
+            # questions must fail instead of waiting for an answer
+            sys.stdout, sys.stdin = output, StringIO('')
+            for c in cmds:
+                c.stdout = output
+            try:
+                _cmd.onecmd(_cmd.precmd(line))
+            except EOFError:
+                error = 'The command asks for input, all parameters have to be given.'
+            except Exception as e:
+                error = '%s: %s' % (e.__class__.__name__, e)
+            finally:
+                sys.stdout, sys.stdin = stdout, stdin
+                for c in cmds:
+                    c.stdout = stdout
+            result['results'].append({'command': line, 'output': output.getvalue(), 
+                                      'error': error or output.error(), 'seconds': time.time() - start})
+    finally:
+        rep.close()
+    return result
+
+def _run_script(args):
+    return run_script(*args)
+
+def run_batch(repositories, commands, processes=1, streaming=False):
+    """ Runs the same analyzer commands on several repositories (see 
+        run_script), each repository in its own worker process.
+        
+        INPUT:
+            - repositories: A list of repository directories.
+            - commands: A list of commands.
+            - processes: Number of worker processes.
+            - streaming: Use the streaming mode to initialize the analyzers.
+            
+        OUTPUT:
+            The results of run_script, in the order of the repositories.
+    """
+    
+    jobs = [(path, commands, streaming) for path in repositories]
+    if processes < 2 or len(jobs) < 2:
+        return map(_run_script, jobs)
+    pool = multiprocessing.Pool(min(processes, len(jobs)))
+    try:
+        return pool.map(_run_script, jobs, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
     
 
 def parse_options():
     """ Encapsulate option parsing. Only used if this file is run as script. """
     
     usage = """usage: %prog -f [-d DIR] [-p PAGES] tag1 [tag2 ...]    fetch images for tag1, tag2,...
-   or: %prog -a REPOSITORY                             enter analyzer mode for repository"""
+   or: %prog -f -r -d DIR [-p PAGES] [tag1 ...]         resume an interrupted fetch into DIR
+   or: %prog -a REPOSITORY                             enter analyzer mode for repository
+   or: %prog -a REPOSITORY REPOSITORY [...]            enter analyzer mode for the union of the repositories
+   or: %prog --pack REPOSITORY                         convert repository to the packed format
+   or: %prog --dedup REPOSITORY                        store each distinct thumbnail of repository only once
+   or: %prog -b SCRIPT REPOSITORY [REPOSITORY ...]     run the analyzer commands of SCRIPT on each repository"""
 
     parser = OptionParser(usage=usage)
     
@@ -139,7 +344,19 @@ def parse_options():
                       , help='mine images corresponding to the tags')
     
     parser.add_option('-a', '--analyze', action='store_true', dest='analyze', 
-                      help='analyze the data in specified repository')
+                      help='analyze the data in specified repository (or in several repositories at once)')
+    
+    parser.add_option('--pack', action='store_true', dest='pack', 
+                      help='convert the specified repository to the packed format')
+    
+    parser.add_option('--dedup', action='store_true', dest='dedup', 
+                      help='convert the thumbnails of the specified repository to content-addressed storage '
+                           'and report the space reclaimed')
+    
+    parser.add_option('-b', '--batch', action='store', dest='batch', metavar='SCRIPT',
+                      help='run the analyzer commands of SCRIPT (a JSON list of commands with all their '
+                           'parameters, e.g. ["tags list_most_used 20"]) on the repositories without '
+                           'asking questions and print the results as JSON')
     
     group = OptionGroup(parser, 'Fetch options', 'These options are valid in combination with the fetch option:')
     group.add_option('-p','--pages', action='store', type='int', dest='pages',
@@ -149,6 +366,43 @@ def parse_options():
     group.add_option('-d', '--dir', dest='directory',
                       default=os.path.join(os.path.expanduser('~'), 'flickr-analysis', now.strftime('%Y-%m-%d_%H-%M')), metavar='DIR',
                       help='the destination directory [default: %default]')
+    group.add_option('--packed', action='store_true', dest='packed',
+                      default=False,
+                      help='store pages and images in a few segment files instead of one file per image')
+    group.add_option('-z', '--compress', action='store', dest='compression',
+                      choices=sorted(COMPRESSION),
+                      help='compress the pages (%s) [default: no compression]' % ', '.join(sorted(COMPRESSION)))
+    group.add_option('-t', '--threads', action='store', type='int', dest='threads',
+                      default=50,
+                      help='number of threads fetching the data [default: %default]')
+    group.add_option('--per-host', action='store', type='int', dest='per_host',
+                      default=8,
+                      help='maximum number of concurrent requests per host [default: %default]')
+    group.add_option('--rate', action='store', type='float', dest='rate',
+                      help='maximum number of requests per second and host [default: unlimited]')
+    group.add_option('--retries', action='store', type='int', dest='retries',
+                      default=3,
+                      help='how often a failed request is retried [default: %default]')
+    group.add_option('-r', '--resume', action='store_true', dest='resume',
+                      default=False,
+                      help='continue an interrupted fetch into DIR, the tags are only needed if the search '
+                           'pages were not examined completely')
+    
+    parser.add_option_group(group)
+    
+    group = OptionGroup(parser, 'Analyze options', 'These options are valid in combination with the analyze option:')
+    group.add_option('-j', '--jobs', action='store', type='int', dest='jobs',
+                      default=1,
+                      help='number of processes used to initialize the analyzers, in batch mode the number '
+                           'of repositories processed at the same time [default: %default]')
+    group.add_option('-s', '--streaming', action='store_true', dest='streaming',
+                      default=False,
+                      help='extract only the needed parts of the pages instead of parsing them completely')
+    group.add_option('--stats', action='store', dest='stats', metavar='FILE',
+                      help='write the time of each phase of the initialization as JSON to FILE')
+    
+    group.add_option('-o', '--output', action='store', dest='output', metavar='FILE',
+                      help='write the results of the batch mode to FILE [default: standard output]')
     
     parser.add_option_group(group)
     
@@ -156,13 +410,16 @@ def parse_options():
     (options, args) = parser.parse_args()
     
     
-    if not options.fetch and not options.analyze:
+    if not options.fetch and not options.analyze and not options.pack and not options.dedup and not options.batch:
         parser.error("See usage...")
     
     
-    if options.fetch and not args:
+    if options.fetch and not args and not options.resume:
         parser.error("At least one tag is required")
         
+    if (options.pack or options.dedup or options.batch) and not args:
+        parser.error("A repository is required")
+        
     
     return (options, args)
 
@@ -174,37 +431,96 @@ def main():
     if options.fetch: # get URLs and data
         directory = os.path.abspath(options.directory)
         
-        if os.path.exists(directory) and os.listdir(directory):
-            sys.exit("The target directory must be empty.")
+        if options.resume and not os.path.exists(os.path.join(directory, 'data.sqlite')):
+            sys.exit("There is no fetch to resume in %s." % directory)
+        if not options.resume and os.path.exists(directory) and os.listdir(directory):
+            sys.exit("The target directory must be empty (use --resume to continue an interrupted fetch).")
             
-        print "Determine number of images to fetch..."
+        print "Fetching images into %s..." % directory
         
-        urls = get_urls(args, options.pages)
-        number_of_images = [(tag, len(urls[tag])) for tag in urls]
-        total = reduce(lambda x,y: x+y, [t[1] for t in number_of_images])
+        # the images are fetched while the search pages are still examined
+        urls = iter_urls(args, options.pages) if args else None
+        fetched = fetch_data(directory, urls, True, options.threads,
+                             packed=options.packed, per_host=options.per_host, 
+                             rate=options.rate, retries=options.retries,
+                             compression=options.compression, resume=options.resume)
         
-        print "Fetching %i images (%s) into %s..." % (total, 
-                                                      ', '.join(["%s: %i" % (tag, number) for tag, number in number_of_images]), 
-                                                      directory)
-        fetch_data(os.path.abspath(options.directory), urls, True)
+        print "\nAll images fetched (%s)." % ', '.join(["%s: %i" % (tag, count) for tag, count in [(tag, fetched.get(tag, 0)) for tag in args or sorted(fetched)]])
         
-        print "\nAll images fetched."
+    elif options.pack: # convert repository
+        rep = Repository(os.path.abspath(args[0]))
+        if rep.packed:
+            sys.exit("The repository is already packed.")
+        print "Packing %i images..." % rep.total_images
+        rep.pack()
+        rep.close()
+        print "Done."
         
-    elif options.analyze: # go to analyzer mode
-        if not args:
-            path = Repository.get_last() # open last fetched data
+    elif options.dedup: # convert the thumbnails
+        rep = Repository(os.path.abspath(args[0]))
+        if rep.deduplicated:
+            sys.exit("The thumbnails are already de-duplicated.")
+        print "De-duplicating the thumbnails of %i images..." % rep.total_images
+        report = rep.deduplicate_images()
+        rep.close()
+        print "%i thumbnails, %i distinct ones." % (report['images'], report['contents'])
+        print "%.1f MB before, %.1f MB after, %.1f MB (%.0f%%) reclaimed." % (report['before'] / 2.**20, 
+                report['after'] / 2.**20, report['reclaimed'] / 2.**20, 
+                100. * report['reclaimed'] / report['before'] if report['before'] else 0)
+        
+    elif options.batch: # run the script without interaction
+        with open(options.batch) as f:
+            commands = json.load(f)
+        if not isinstance(commands, list):
+            sys.exit("The script must be a JSON list of commands.")
+        # plots cannot be shown
+        import matplotlib
+        matplotlib.use('Agg')
+        
+        results = run_batch([os.path.abspath(path) for path in args], commands, options.jobs, 
+                            options.streaming)
+        if options.output:
+            with open(options.output, 'w') as f:
+                json.dump(results, f, indent=2)
         else:
-            path = args[0]
-        directory = os.path.abspath(path)
-        if not os.path.exists(directory):
-            sys.exit("The target directoy must exist.")
-        rep = Repository(directory)
+            print json.dumps(results, indent=2)
         
-        # load analyzer
-        analyser = [get_class(m)(rep) for m in settings.ANALYZERS]
+    elif options.analyze: # go to analyzer mode
+        if len(args) > 1: # the union of several repositories
+            # needs the analyzers, like settings.ANALYZERS
+            from federation import FederatedRepository, FEDERATED_ANALYZERS, federated_analyzers
+            directories = [os.path.abspath(path) for path in args]
+            for directory in directories:
+                if not os.path.exists(directory):
+                    sys.exit("The repository %s does not exist." % directory)
+                rep = Repository(directory)
+                analyzers = [get_class(m)(rep) for m in settings.ANALYZERS if m.split('.')[-1] in FEDERATED_ANALYZERS]
+                not_init = [a.NAME for a in analyzers if a.needs_init()]
+                rep.close()
+                if not_init:
+                    sys.exit("The analyzers %s are not initialized in %s. Initialize every repository first, "
+                             "e.g. with an empty batch script ([])." % (', '.join(not_init), directory))
+            rep = FederatedRepository(directories)
+            analyser = federated_analyzers(rep, settings.ANALYZERS)
+        else:
+            if not args:
+                path = Repository.get_last() # open last fetched data
+            else:
+                path = args[0]
+            directory = os.path.abspath(path)
+            if not os.path.exists(directory):
+                sys.exit("The target directoy must exist.")
+            rep = Repository(directory)
+            
+            # load analyzer
+            analyser = [get_class(m)(rep) for m in settings.ANALYZERS]
         
-        _cmd = AnalyzerCmd(rep, analyser)
-        _cmd.cmdloop("here we go...")
+        _cmd = AnalyzerCmd(rep, analyser, processes=options.jobs, streaming=options.streaming,
+                           stats_file=options.stats)
+        try:
+            _cmd.cmdloop("here we go...")
+        finally:
+            rep.close()
 
 if __name__ == '__main__':
     from optparse import OptionParser, OptionGroup
@@ -3,8 +3,9 @@ Created on Apr 26, 2010
 
 '''
 
-import threading, urllib2
+import threading, urllib2, httplib, urlparse, time, sys
 from contextlib import closing
+from Queue import Queue
 
 class FileGetter(threading.Thread):
     """ This class fetches the images and HTML pages. """
@@ -31,3 +32,227 @@ class FileGetter(threading.Thread):
             self.has_result = True
         except IOError:
             print "Could not open URL: %s" % self.page_url
+
+
+class HTTPError(IOError):
+    """ Raised if the server answers with a client error (4xx) or a 
+        redirect without location. Requests failing with this error are not
+        retried. 
+    """
+    pass
+
+
+class HostPool(object):
+    """ Manages the connections to a single host. 
+    
+        Idle connections are kept open and reused (HTTP keep-alive). The 
+        number of concurrent requests and the request rate can be limited.
+        
+        INPUT:
+            - scheme: 'http' or 'https'
+            - netloc: Host (and port) to connect to.
+            - concurrency: Maximum number of concurrent requests.
+            - rate: Maximum number of requests per second (None: unlimited).
+            - timeout: Socket timeout in seconds.
+    """
+    
+    def __init__(self, scheme, netloc, concurrency, rate=None, timeout=30):
+        self.connection_class = httplib.HTTPSConnection if scheme == 'https' else httplib.HTTPConnection
+        self.netloc = netloc
+        self.timeout = timeout
+        self.interval = 1. / rate if rate else 0
+        self._next_request = 0
+        self._slots = threading.BoundedSemaphore(concurrency)
+        self._idle = list()
+        self._lock = threading.Lock()
+        
+    def acquire(self):
+        """ Waits for a free slot and returns a connection to the host. """
+        
+        self._slots.acquire()
+        with self._lock:
+            now = time.time()
+            wait = self._next_request - now
+            self._next_request = max(now, self._next_request) + self.interval
+            conn = self._idle.pop() if self._idle else None
+        if wait > 0:
+            time.sleep(wait)
+        return conn or self.connection_class(self.netloc, timeout=self.timeout)
+    
+    def release(self, conn, reuse=True):
+        """ Gives back a connection acquired with "acquire". """
+        
+        if reuse:
+            with self._lock:
+                self._idle.append(conn)
+        else:
+            conn.close()
+        self._slots.release()
+        
+    def close(self):
+        with self._lock:
+            for conn in self._idle:
+                conn.close()
+            self._idle = list()
+
+
+class Fetcher(object):
+    """ Fetches URLs with a fixed pool of worker threads.
+    
+        Connections are reused per host, failed requests are retried with 
+        exponential backoff. 
+        
+        INPUT:
+            - workers: Number of worker threads.
+            - per_host: Maximum number of concurrent requests per host.
+            - rate: Maximum number of requests per second and host 
+                    (None: unlimited).
+            - retries: How often a failed request is retried.
+            - backoff: Seconds to wait before the first retry, the time is 
+                       doubled for every further retry.
+            - timeout: Socket timeout in seconds.
+            
+        EXAMPLE:
+            fetcher = Fetcher(workers=20)
+            for key, (page, image) in fetcher.fetch(jobs):
+                ...
+            fetcher.close()
+    """
+    
+    REDIRECTS = (301, 302, 303, 307)
+    MAX_REDIRECTS = 5
+    
+    def __init__(self, workers=10, per_host=4, rate=None, retries=3, backoff=0.5, timeout=30):
+        self.per_host = per_host
+        self.rate = rate
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self._hosts = dict()
+        self._hosts_lock = threading.Lock()
+        self._tasks = Queue(workers * 2)
+        self._workers = [threading.Thread(target=self._work) for _ in xrange(workers)]
+        for worker in self._workers:
+            worker.daemon = True
+            worker.start()
+            
+    def _host(self, scheme, netloc):
+        with self._hosts_lock:
+            if (scheme, netloc) not in self._hosts:
+                self._hosts[(scheme, netloc)] = HostPool(scheme, netloc, self.per_host, self.rate, self.timeout)
+            return self._hosts[(scheme, netloc)]
+            
+    def _request(self, url, redirects=MAX_REDIRECTS):
+        """ Performs a single GET request and follows redirects. """
+        
+        parts = urlparse.urlsplit(url)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+        host = self._host(parts.scheme, parts.netloc)
+        conn = host.acquire()
+        reuse = False
+        try:
+            conn.request('GET', path, headers={'Connection': 'keep-alive'})
+            response = conn.getresponse()
+            body = response.read()
+            reuse = not response.will_close
+        finally:
+            host.release(conn, reuse)
+            
+        if response.status in self.REDIRECTS and redirects:
+            location = response.getheader('location')
+            if not location: # requesting the same URL again would not help
+                raise HTTPError("HTTP error %i without location" % response.status)
+            return self._request(urlparse.urljoin(url, location), redirects - 1)
+        if 400 <= response.status < 500:
+            raise HTTPError("HTTP error %i" % response.status)
+        if response.status >= 300:
+            raise IOError("HTTP error %i" % response.status)
+        return body
+            
+    def get(self, url):
+        """ Fetches a single URL, retrying on errors. 
+        
+            OUTPUT:
+                The content of the URL. Raises IOError if it cannot be 
+                fetched.
+        """
+        
+        for attempt in xrange(self.retries + 1):
+            try:
+                return self._request(url)
+            except HTTPError:
+                raise
+            except (IOError, httplib.HTTPException) as e:
+                if attempt == self.retries:
+                    raise IOError(str(e) or e.__class__.__name__)
+                time.sleep(self.backoff * 2**attempt)
+    
+    def _work(self):
+        while True:
+            task = self._tasks.get()
+            if task is None:
+                return
+            key, urls, results = task
+            try:
+                contents = [self.get(url) for url in urls]
+            except IOError:
+                print "Could not open URL: %s" % urls[0]
+                contents = None
+            results.put((key, contents))
+            
+    def fetch(self, jobs):
+        """ Fetches the URLs of all jobs. The jobs are consumed lazily, so
+            they can be generated while fetching.
+            
+            INPUT:
+                - jobs: An iterable of tuples (key, urls) where urls is a 
+                        sequence of URLs that belong together.
+            
+            OUTPUT:
+                An iterator over tuples (key, contents) in the order the jobs
+                finish. contents is a list with the content of each URL or 
+                None if any of them could not be fetched.
+        """
+        
+        results = Queue()
+        feeder_state = {'submitted': 0, 'error': None}
+        done = object()
+        
+        def feed():
+            try:
+                for key, urls in jobs:
+                    self._tasks.put((key, urls, results))
+                    feeder_state['submitted'] += 1
+            except Exception:
+                feeder_state['error'] = sys.exc_info()
+            finally:
+                results.put(done)
+        
+        feeder = threading.Thread(target=feed)
+        feeder.daemon = True
+        feeder.start()
+        
+        feeding = True
+        received = 0
+        while feeding or received < feeder_state['submitted']:
+            result = results.get()
+            if result is done:
+                feeding = False
+                continue
+            received += 1
+            yield result
+            
+        if feeder_state['error']:
+            raise feeder_state['error'][0], feeder_state['error'][1], feeder_state['error'][2]
+        
+    def close(self):
+        """ Stops the workers and closes all connections. """
+        
+        for _ in self._workers:
+            self._tasks.put(None)
+        for worker in self._workers:
+            worker.join()
+        for host in self._hosts.itervalues():
+            host.close()
@@ -0,0 +1,91 @@
+'''
+Created on Nov 25, 2010
+
+'''
+
+import threading
+
+class FetchPlan(object):
+    """ Keeps the URLs of a fetch run and which of them are fetched in the
+        DB of the repository, so an interrupted run can be resumed.
+
+        Every image found by the search is added once (the first tag it is
+        found for wins, like in iter_urls). The plan is complete once all
+        search pages are examined.
+
+        The plan is used from the thread that generates the jobs and the
+        thread that stores the results, all statements are serialized.
+
+        INPUT:
+            - repository: The repository the images are fetched into.
+    """
+
+    PENDING = 0
+    DONE = 1
+    FAILED = 2
+
+    CREATE_TABLES = (
+                    "CREATE TABLE IF NOT EXISTS fetch_plan (id integer PRIMARY KEY, tag text, page_url text, image_url text, state integer, attempts integer)",
+                    "CREATE INDEX IF NOT EXISTS fetch_plan_state ON fetch_plan (state)",
+                    )
+
+    def __init__(self, repository):
+        self.repository = repository
+        self.db_conn = repository.db_conn
+        self.lock = threading.Lock()
+        with self.lock:
+            for create in self.CREATE_TABLES:
+                self.db_conn.execute(create)
+
+    @property
+    def complete(self):
+        """ Whether all search pages were examined. """
+
+        with self.lock:
+            return self.repository.get_info('plan_complete') == '1'
+
+    def set_complete(self):
+        with self.lock:
+            self.repository.set_info('plan_complete', '1')
+
+    def add(self, tag, id, page_url, image_url):
+        """ Adds an image to the plan.
+
+            OUTPUT:
+                True if the image was not in the plan yet.
+        """
+
+        with self.lock:
+            cursor = self.db_conn.execute('INSERT OR IGNORE INTO fetch_plan (id, tag, page_url, image_url, state, attempts) VALUES (?,?,?,?,?,0)',
+                                          (id, tag, page_url, image_url, self.PENDING))
+            return cursor.rowcount == 1
+
+    def unfinished(self):
+        """ Returns the images that are not fetched yet, including the ones
+            that failed before, as list of tuples
+            (tag, image-id, page_url, thumbnail_url).
+        """
+
+        with self.lock:
+            return self.db_conn.execute('SELECT tag, id, page_url, image_url FROM fetch_plan WHERE state != ? ORDER BY rowid',
+                                        (self.DONE,)).fetchall()
+
+    def done(self, id):
+        with self.lock:
+            self.db_conn.execute('UPDATE fetch_plan SET state = ?, attempts = attempts + 1 WHERE id = ?', (self.DONE, id))
+
+    def failed(self, id):
+        with self.lock:
+            self.db_conn.execute('UPDATE fetch_plan SET state = ?, attempts = attempts + 1 WHERE id = ?', (self.FAILED, id))
+
+    def count(self, state):
+        """ Number of images in <state>. """
+
+        with self.lock:
+            return self.db_conn.execute('SELECT COUNT(*) FROM fetch_plan WHERE state = ?', (state,)).fetchone()[0]
+
+    def checkpoint(self):
+        """ Makes the state of the plan and the stored images durable. """
+
+        with self.lock:
+            self.repository.commit()
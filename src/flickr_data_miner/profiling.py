@@ -0,0 +1,115 @@
+'''
+Created on Nov 22, 2010
+
+'''
+
+import time, json
+from array import array
+
+
+class Profile(object):
+    """ Collects the durations of the phases of a run, e.g. reading the
+        pages or storing the data of an analyzer, and summarizes them.
+
+        Phases are named "<phase>" or "<phase>:<analyzer>", e.g. "read" or
+        "store:tags".
+
+        EXAMPLE:
+            profile = Profile()
+            start = time.time()
+            ...
+            profile.add('store:tags', time.time() - start)
+            profile.report()
+    """
+
+    PERCENTILES = (50, 90, 99)
+
+    def __init__(self):
+        self._samples = dict()
+
+    def add(self, phase, seconds):
+        """ Records one duration of <phase>. """
+
+        samples = self._samples.get(phase)
+        if samples is None:
+            samples = self._samples[phase] = array('d')
+        samples.append(seconds)
+
+    def add_samples(self, samples):
+        """ Records the durations of a dictionary that maps phases to lists
+            of durations (see "samples").
+        """
+
+        for phase, seconds in samples.iteritems():
+            if phase not in self._samples:
+                self._samples[phase] = array('d')
+            self._samples[phase].extend(seconds)
+
+    def samples(self):
+        """ Returns a dictionary that maps each phase to the list of its
+            durations.
+        """
+
+        return dict((phase, list(seconds)) for phase, seconds in self._samples.iteritems())
+
+    def iterate(self, phase, iterable):
+        """ Iterates over <iterable> and records the time every item takes
+            as <phase>.
+        """
+
+        clock, add = time.time, self.add
+        iterator = iter(iterable)
+        while True:
+            start = clock()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            add(phase, clock() - start)
+            yield item
+
+    def reset(self):
+        self._samples.clear()
+
+    def summary(self):
+        """ Summarizes the durations of each phase.
+
+            OUTPUT:
+                A dictionary that maps each phase to a dictionary with the
+                keys 'count', 'total', 'mean', 'max' and 'p50', 'p90', 'p99'
+                (percentiles), all in seconds.
+        """
+
+        result = dict()
+        for phase, seconds in self._samples.iteritems():
+            if not seconds:
+                continue
+            ordered = sorted(seconds)
+            total = sum(ordered)
+            stats = {'count': len(ordered), 'total': total, 'mean': total / len(ordered),
+                     'max': ordered[-1]}
+            for p in self.PERCENTILES:
+                # nearest rank
+                stats['p%i' % p] = ordered[max(int(round(p / 100. * len(ordered))) - 1, 0)]
+            result[phase] = stats
+        return result
+
+    def report(self):
+        """ Prints the summary, the phase that takes the most time first. """
+
+        summary = self.summary()
+        if not summary:
+            print 'No statistics collected yet.'
+            return
+        print '%s %10s %10s %10s %10s %10s %10s %10s' % ('Phase'.ljust(25), 'Count', 'Total (s)',
+                                                          'Mean (ms)', 'p50 (ms)', 'p90 (ms)', 'p99 (ms)', 'Max (ms)')
+        for phase, s in sorted(summary.iteritems(), key=lambda item: -item[1]['total']):
+            print '%s %10i %10.3f %10.3f %10.3f %10.3f %10.3f %10.3f' % (phase.ljust(25), s['count'], s['total'],
+                    1000 * s['mean'], 1000 * s['p50'], 1000 * s['p90'], 1000 * s['p99'], 1000 * s['max'])
+
+    def save(self, path):
+        """ Writes the summary as JSON to the file <path>. """
+
+        with open(path, 'w') as f:
+            json.dump({'created': time.strftime('%Y-%m-%dT%H:%M:%S'), 'phases': self.summary()},
+                      f, indent=2, sort_keys=True)
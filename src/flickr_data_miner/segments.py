@@ -0,0 +1,168 @@
+'''
+Created on Nov 3, 2010
+
+'''
+
+import os, mmap
+
+class SegmentStore(object):
+    """ Stores many small records (HTML pages, images) in a few large,
+        append-only segment files.
+
+        The position of every record is kept in the table "segment_index" of
+        the given DB. Records are read through memory maps of the segment
+        files, so reading a record does not need an open() call.
+
+        INPUT:
+            - path: Directory of the segment files.
+            - db_conn: Connection to the DB that holds the index.
+    """
+
+    PAGE = 0
+    IMAGE = 1
+    # the distinct thumbnails of a repository with de-duplicated images,
+    # the id is the id of the content (see Repository)
+    BLOB = 2
+
+    KIND_NAMES = ('pages', 'images', 'blobs')
+
+    # a new segment is started if the current one is larger than this
+    SEGMENT_SIZE = 64 * 2**20
+
+    CREATE_TABLES = (
+                    "CREATE TABLE IF NOT EXISTS segment_index (kind integer, id integer, tag text, segment integer, offset integer, length integer, PRIMARY KEY (kind, id))",
+                    )
+
+    def __init__(self, path, db_conn):
+        self.path = path
+        self.db_conn = db_conn
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        for create in self.CREATE_TABLES:
+            self.db_conn.execute(create)
+        self._writers = dict()
+        self._maps = dict()
+
+    def _segment_path(self, kind, segment):
+        return os.path.join(self.path, '%s-%05d.seg' % (self.KIND_NAMES[kind], segment))
+
+    def _writer(self, kind):
+        """ Returns the segment number and the file object of the segment
+            records of <kind> are appended to.
+        """
+
+        if kind not in self._writers:
+            segment = self.db_conn.execute('SELECT MAX(segment) FROM segment_index WHERE kind = ?', (kind,)).fetchone()[0] or 0
+            self._writers[kind] = (segment, open(self._segment_path(kind, segment), 'ab'))
+        segment, f = self._writers[kind]
+        f.seek(0, os.SEEK_END)
+        if f.tell() >= self.SEGMENT_SIZE:
+            f.close()
+            segment += 1
+            self._writers[kind] = (segment, open(self._segment_path(kind, segment), 'ab'))
+        return self._writers[kind]
+
+    def add(self, kind, tag, id, data):
+        """ Appends a record to the current segment and indexes it.
+
+            INPUT:
+                - kind: SegmentStore.PAGE, SegmentStore.IMAGE or 
+                        SegmentStore.BLOB
+                - tag: The tag the record was fetched for.
+                - id: The image id.
+                - data: The content.
+        """
+
+        segment, f = self._writer(kind)
+        f.seek(0, os.SEEK_END)
+        offset = f.tell()
+        f.write(data)
+        self.db_conn.execute('INSERT OR REPLACE INTO segment_index (kind, id, tag, segment, offset, length) VALUES (?,?,?,?,?,?)',
+                             (kind, id, tag, segment, offset, len(data)))
+
+    def _read(self, kind, segment, offset, length):
+        """ Reads a record from the memory map of its segment. """
+
+        if not length:
+            return ''
+        key = (kind, segment)
+        mm = self._maps.get(key)
+        if mm is None or offset + length > len(mm):
+            if kind in self._writers:
+                self._writers[kind][1].flush()
+            if mm is not None:
+                mm.close()
+            with open(self._segment_path(kind, segment), 'rb') as f:
+                mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self._maps[key] = mm
+        return mm[offset:offset + length]
+
+    def get(self, kind, id):
+        """ Returns the content of a single record or None if it does not
+            exist.
+        """
+
+        row = self.db_conn.execute('SELECT segment, offset, length FROM segment_index WHERE kind = ? AND id = ?', (kind, id)).fetchone()
+        if row is None:
+            return None
+        return self._read(kind, *row)
+
+    def iterate(self, kind, skip=()):
+        """ Iterator over all records of <kind> in the order they are stored.
+            Records whose id is in <skip> are not read.
+
+            OUTPUT:
+                Tuples of format (id, tag, content).
+        """
+
+        # fetch the index up front, the connection might be used for writing
+        # while the records are processed
+        index = self.db_conn.execute('SELECT id, tag, segment, offset, length FROM segment_index WHERE kind = ? ORDER BY segment, offset', (kind,)).fetchall()
+        for id, tag, segment, offset, length in index:
+            if id in skip:
+                continue
+            yield (id, tag, self._read(kind, segment, offset, length))
+
+    def contains(self, kind, id):
+        """ Whether a record of <kind> with <id> exists. """
+
+        return self.db_conn.execute('SELECT 1 FROM segment_index WHERE kind = ? AND id = ?', (kind, id)).fetchone() is not None
+
+    def flush(self):
+        """ Writes the buffered data of the segments to disk, so the index
+            does not point beyond the end of a segment once it is committed.
+        """
+
+        for _, f in self._writers.itervalues():
+            f.flush()
+            os.fsync(f.fileno())
+
+    def remove_kind(self, kind):
+        """ Removes all records of <kind> and their segment files. """
+
+        if kind in self._writers:
+            self._writers.pop(kind)[1].close()
+        for key in [key for key in self._maps if key[0] == kind]:
+            self._maps.pop(key).close()
+        segments = [segment for segment, in self.db_conn.execute('SELECT DISTINCT segment FROM segment_index WHERE kind = ?', (kind,))]
+        self.db_conn.execute('DELETE FROM segment_index WHERE kind = ?', (kind,))
+        self.db_conn.commit()
+        for segment in segments:
+            path = self._segment_path(kind, segment)
+            if os.path.exists(path):
+                os.remove(path)
+
+    def count(self, kind):
+        """ Number of records of <kind>. """
+
+        return self.db_conn.execute('SELECT COUNT(id) FROM segment_index WHERE kind = ?', (kind,)).fetchone()[0]
+
+    def close(self):
+        """ Closes all segment files and memory maps. """
+
+        for _, f in self._writers.itervalues():
+            f.close()
+        for mm in self._maps.itervalues():
+            mm.close()
+        self._writers.clear()
+        self._maps.clear()
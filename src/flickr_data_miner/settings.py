@@ -13,5 +13,11 @@ ANALYZERS = (
 "data_analyzer.tag_analyzer.TagAnalyzer",
 "data_analyzer.comment_analyzer.CommentAnalyzer",
 "data_analyzer.rating_analyzer.RatingAnalyzer",
+"data_analyzer.duplicate_analyzer.DuplicateAnalyzer",
 "data_analyzer.pca_analyzer.PCAAnalyzer",
 )
+
+# Local lexicon files (one word per line, most used words first). If set, the
+# lexicon is not downloaded, e.g. to run the analysis offline.
+LEXICON_WORDLIST = None
+LEXICON_STOPLIST = None
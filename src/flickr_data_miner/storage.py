@@ -3,20 +3,64 @@ Created on Apr 17, 2010
 
 '''
 
-import os, sqlite3, itertools
+import os, sqlite3, itertools, zlib, bz2, hashlib
+
+from segments import SegmentStore
+from writer import BatchWriter
+
+# available compression methods for HTML pages: (compress, decompress)
+COMPRESSION = {
+    'zlib': (zlib.compress, zlib.decompress),
+    'bz2': (bz2.compress, bz2.decompress),
+}
+try:
+    import lzma
+    COMPRESSION['lzma'] = (lzma.compress, lzma.decompress)
+except ImportError:
+    pass
 
 class Repository(object):
     """ This class represents a collection of images and HTML pages. 
     
+        The pages and images are either stored as single files in one 
+        directory per tag or, in the packed format, appended to a few 
+        segment files (see SegmentStore).
+        
+        The HTML pages can be stored compressed (see COMPRESSION). They are
+        decompressed transparently when they are read.
+        
+        The thumbnails of new repositories are content-addressed: every
+        distinct content is stored once (named by its SHA-1 in the 
+        directory THUMBNAILS_DIR, or in the segments) and the images 
+        reference it. Placeholders like "image unavailable" are therefore
+        stored only once. Older repositories can be converted with 
+        "deduplicate_images".
+    
         INPUT:
             - dir: Directory to load.
             - new: Indicate whether a new repository should be created.
+            - packed: Use the packed format for a new repository.
+            - compression: Compression method for the pages of a new 
+                           repository (default: None, uncompressed).
     """
     
     
     LAST_FILE = os.path.expanduser("~/.flickr_analyzer_last_rep")
     
-    def __init__(self, dir, new=False):
+    CREATE_TABLES = (
+                    "CREATE TABLE IF NOT EXISTS repository_info (key text PRIMARY KEY, value text)",
+                    "CREATE TABLE IF NOT EXISTS analyzer_manifest (analyzer text, image_id integer, PRIMARY KEY (analyzer, image_id))",
+                    )
+    
+    CREATE_IMAGE_TABLES = (
+                    "CREATE TABLE IF NOT EXISTS image_content (id integer PRIMARY KEY, tag text, content integer)",
+                    "CREATE TABLE IF NOT EXISTS content (id integer PRIMARY KEY, sha1 text UNIQUE, length integer)",
+                    )
+    
+    SEGMENTS_DIR = 'segments'
+    THUMBNAILS_DIR = 'thumbnails'
+    
+    def __init__(self, dir, new=False, packed=False, compression=None):
         
         self.path = os.path.abspath(dir)
         db_path = os.path.join(self.path, 'data.sqlite')
@@ -25,8 +69,68 @@ class Repository(object):
                 os.makedirs(self.path)        
         if not new and not os.listdir(self.path):
             raise Exception("Repository is empty!")
-        self.db_conn = sqlite3.connect(db_path)
+        # the fetcher writes from another thread than the one that opened 
+        # the repository
+        self.db_conn = sqlite3.connect(db_path, check_same_thread=False)
+        for create in self.CREATE_TABLES:
+            self.db_conn.execute(create)
+        if new and packed:
+            self.set_info('format', 'packed')
+            self.db_conn.commit()
+        if new:
+            self._create_image_tables()
+        self._deduplicated = self.get_info('images') == 'content'
+        if new and compression:
+            if compression not in COMPRESSION:
+                raise Exception("Unknown compression method %s!" % compression)
+            self.set_info('compression', compression)
+            self.db_conn.commit()
+        self._compress = self._decompress = None
+        if self.compression:
+            if self.compression not in COMPRESSION:
+                raise Exception("Compression method %s is not available!" % self.compression)
+            self._compress, self._decompress = COMPRESSION[self.compression]
+        self._segments = None
+        if self.packed:
+            self._segments = SegmentStore(os.path.join(self.path, self.SEGMENTS_DIR), self.db_conn)
         self._total_images = 0
+        # buffers the inserts of the analyzers
+        self.writer = BatchWriter(self.db_conn)
+        
+    def get_info(self, key, default=None):
+        """ Get a setting of the repository. """
+        
+        row = self.db_conn.execute('SELECT value FROM repository_info WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else default
+    
+    def set_info(self, key, value):
+        """ Set a setting of the repository. """
+        
+        self.db_conn.execute('INSERT OR REPLACE INTO repository_info (key, value) VALUES (?,?)', (key, value))
+        
+    @property
+    def packed(self):
+        """ Whether the repository uses the packed format. """
+        
+        return self.get_info('format') == 'packed'
+    
+    @property
+    def deduplicated(self):
+        """ Whether the thumbnails are content-addressed. """
+        
+        return self._deduplicated
+    
+    def _create_image_tables(self):
+        for create in self.CREATE_IMAGE_TABLES:
+            self.db_conn.execute(create)
+        self.set_info('images', 'content')
+        self.db_conn.commit()
+        
+    @property
+    def compression(self):
+        """ The compression method of the pages or None. """
+        
+        return self.get_info('compression')
         
     def set_last(self):
         """ Set the current repository as last accessed repository. """
@@ -52,11 +156,29 @@ class Repository(object):
                 - data: Image data.       
         """
         
-        tag_dir = os.path.join(self.path, tag)
-        if not os.path.isdir(tag_dir):
-            os.mkdir(tag_dir)
-        with open(os.path.join(tag_dir, str(id) + '.jpg'), 'wb') as file:
-            file.write(data)
+        if self.deduplicated:
+            self._add_content(tag, id, data)
+        elif self._segments:
+            self._segments.add(SegmentStore.IMAGE, tag, id, data)
+        else:
+            self._write_file(tag, str(id) + '.jpg', data)
+        
+    def _add_content(self, tag, id, data):
+        """ Stores the content of an image unless the same content is 
+            already stored, and references it.
+        """
+        
+        sha1 = hashlib.sha1(data).hexdigest()
+        row = self.db_conn.execute('SELECT id FROM content WHERE sha1 = ?', (sha1,)).fetchone()
+        if row is None:
+            content = self.db_conn.execute('INSERT INTO content (sha1, length) VALUES (?,?)', (sha1, len(data))).lastrowid
+            if self._segments:
+                self._segments.add(SegmentStore.BLOB, None, content, data)
+            else:
+                self._write_file(os.path.join(self.THUMBNAILS_DIR, sha1[:2]), sha1 + '.jpg', data)
+        else:
+            content = row[0]
+        self.db_conn.execute('INSERT OR REPLACE INTO image_content (id, tag, content) VALUES (?,?,?)', (id, tag, content))
         
     def add_site(self, tag, id, data):
         """ Add a HTML page to the repository.
@@ -67,15 +189,69 @@ class Repository(object):
                 - data: HTML data.       
         """
         
+        if self._compress:
+            data = self._compress(data)
+        if self._segments:
+            self._segments.add(SegmentStore.PAGE, tag, id, data)
+            return
+        self._write_file(tag, str(id) + '.html', data)
+        
+    def _write_file(self, tag, name, data):
+        """ Writes a file to the directory of <tag>. The file is written 
+            under a temporary name first, so it either exists completely or
+            not at all.
+        """
+        
         tag_dir = os.path.join(self.path, tag)
         if not os.path.isdir(tag_dir):
-            os.mkdir(tag_dir)
-        file = open(os.path.join(tag_dir, str(id) + '.html'), 'w')
-        file.write(data)
-        file.close()
+            os.makedirs(tag_dir)
+        path = os.path.join(tag_dir, name)
+        with open(path + '.part', 'wb') as file:
+            file.write(data)
+        os.rename(path + '.part', path)
+        
+    def has_image(self, tag, id):
+        """ Whether the thumbnail of the image is stored. """
+        
+        if self.deduplicated:
+            return self.db_conn.execute('SELECT 1 FROM image_content WHERE id = ?', (id,)).fetchone() is not None
+        if self._segments:
+            return self._segments.contains(SegmentStore.IMAGE, id)
+        return os.path.exists(os.path.join(self.path, tag, str(id) + '.jpg'))
+    
+    def get_image(self, tag, id):
+        """ Returns the thumbnail of the image or None if it is not stored.
+        """
+        
+        if self.deduplicated:
+            row = self.db_conn.execute('SELECT content.id, sha1 FROM image_content JOIN content ON content = content.id '
+                                       'WHERE image_content.id = ?', (id,)).fetchone()
+            if row is None:
+                return None
+            if self._segments:
+                return self._segments.get(SegmentStore.BLOB, row[0])
+            path = os.path.join(self.path, self.THUMBNAILS_DIR, row[1][:2], row[1] + '.jpg')
+        elif self._segments:
+            return self._segments.get(SegmentStore.IMAGE, id)
+        else:
+            path = os.path.join(self.path, tag, str(id) + '.jpg')
+        if not os.path.exists(path):
+            return None
+        with open(path, 'rb') as f:
+            return f.read()
+    
+    def has_site(self, tag, id):
+        """ Whether the HTML page of the image is stored. """
         
-    def get_sites(self):
+        if self._segments:
+            return self._segments.contains(SegmentStore.PAGE, id)
+        return os.path.exists(os.path.join(self.path, tag, str(id) + '.html'))
+        
+    def get_sites(self, skip=()):
         """ Iterator over all HTML pages in the repository.
+        
+            INPUT:
+                - skip: A set of ids of pages that are not read.
                
             OUPUT:
                 A tuple of format (id, tag, content) where id is the id of
@@ -84,14 +260,23 @@ class Repository(object):
 
         """
         
+        if self._segments:
+            for id, tag, content in self._segments.iterate(SegmentStore.PAGE, skip):
+                yield (id, tag, self._decompress(content) if self._decompress else content)
+            return
+        
         l = lambda x: x.endswith('.html')
         # traverse through the tag folders
         for root, dirs, files in itertools.ifilterfalse(lambda x: x[1], os.walk(self.path)):
             tag = root.split('/')[-1]
             for file in itertools.ifilter(l,  files):
                 id = file[:-5]
-                with open(os.path.join(root, file)) as f:
+                if long(id) in skip:
+                    continue
+                with open(os.path.join(root, file), 'rb') as f:
                     content = f.read()
+                if self._decompress:
+                    content = self._decompress(content)
 
                 yield (long(id), tag, content)
         
@@ -99,9 +284,12 @@ class Repository(object):
     def total_images(self):
         """ Total amount of images (and therefore HTML pages too). """
         
-        if not self._total_images:
-            self._total_images = (reduce(lambda x,y: x+y, 
-                                         [len(files)/2 for root, dir, files in itertools.ifilterfalse(lambda x: x[1], os.walk(self.path))]))
+        if not self._total_images and self._segments:
+            self._total_images = self._segments.count(SegmentStore.PAGE)
+        elif not self._total_images:
+            # other directories (e.g. caches) contain no HTML files
+            self._total_images = sum(len([f for f in files if f.endswith('.html')]) for root, dir, files
+                                     in itertools.ifilterfalse(lambda x: x[1], os.walk(self.path)))
         return self._total_images
     
     def begin_transaction(self):
@@ -117,13 +305,134 @@ class Repository(object):
     def commit(self):
         """ Commits the current DB transaction. """
         
+        if self._segments:
+            self._segments.flush()
+        self.writer.flush()
         self.db_conn.commit()
         self.db_conn.execute('PRAGMA synchronous = FULL')
         self.db_conn.execute('PRAGMA journal_mode = 0')
     
+    def pack(self):
+        """ Converts a repository of the directory format to the packed 
+            format. The single files are removed once all of them are 
+            stored in the segments.
+        """
+        
+        if self.packed:
+            return
+        segments = SegmentStore(os.path.join(self.path, self.SEGMENTS_DIR), self.db_conn)
+        packed_files = list()
+        if self.deduplicated:
+            for content, sha1 in self.db_conn.execute('SELECT id, sha1 FROM content').fetchall():
+                path = os.path.join(self.path, self.THUMBNAILS_DIR, sha1[:2], sha1 + '.jpg')
+                with open(path, 'rb') as f:
+                    segments.add(SegmentStore.BLOB, None, content, f.read())
+                packed_files.append(path)
+        for root, dirs, files in self._tag_dirs():
+            tag = root.split('/')[-1]
+            for file in files:
+                name, ext = os.path.splitext(file)
+                if ext == '.html':
+                    kind = SegmentStore.PAGE
+                elif ext == '.jpg':
+                    kind = SegmentStore.IMAGE
+                else:
+                    continue
+                path = os.path.join(root, file)
+                with open(path, 'rb') as f:
+                    segments.add(kind, tag, long(name), f.read())
+                packed_files.append(path)
+        segments.close()
+        self.set_info('format', 'packed')
+        self.db_conn.commit()
+        
+        for path in packed_files:
+            os.remove(path)
+        self._remove_empty_dirs(packed_files)
+        self._segments = segments
+        self._total_images = 0
+        
+    def _tag_dirs(self):
+        """ The directories of the tags (and their files) of the directory 
+            format, i.e. the leaf directories except the ones of the 
+            segments and the thumbnails.
+        """
+        
+        skip = (self.path, os.path.join(self.path, self.SEGMENTS_DIR))
+        thumbnails = os.path.join(self.path, self.THUMBNAILS_DIR)
+        return [(root, dirs, files) for root, dirs, files in itertools.ifilterfalse(lambda x: x[1], os.walk(self.path))
+                if root not in skip and not root.startswith(thumbnails)]
+        
+    def _remove_empty_dirs(self, paths):
+        """ Removes the directories of the removed files <paths> that are 
+            empty now (and their parents up to the repository).
+        """
+        
+        for root in sorted(set(os.path.dirname(path) for path in paths), reverse=True):
+            while root != self.path and os.path.isdir(root) and not os.listdir(root):
+                os.rmdir(root)
+                root = os.path.dirname(root)
+    
+    def deduplicate_images(self):
+        """ Converts the thumbnails of a repository to content-addressed
+            storage: every distinct content is kept once, the copies are 
+            removed.
+            
+            OUTPUT:
+                A dictionary with the keys 'images' (number of thumbnails), 
+                'contents' (number of distinct contents), 'before' and 
+                'after' (bytes of the thumbnails before and after) and 
+                'reclaimed' (bytes).
+        """
+        
+        if self.deduplicated:
+            raise Exception("The images are already de-duplicated.")
+        for create in self.CREATE_IMAGE_TABLES:
+            self.db_conn.execute(create)
+        images, before = 0, 0
+        converted_files = list()
+        if self._segments:
+            for id, tag, data in self._segments.iterate(SegmentStore.IMAGE):
+                self._add_content(tag, id, data)
+                images += 1
+                before += len(data)
+        else:
+            # the list of files is complete before the first content is 
+            # written
+            for root, dirs, files in self._tag_dirs():
+                tag = root.split('/')[-1]
+                for file in files:
+                    name, ext = os.path.splitext(file)
+                    if ext != '.jpg':
+                        continue
+                    path = os.path.join(root, file)
+                    with open(path, 'rb') as f:
+                        data = f.read()
+                    self._add_content(tag, long(name), data)
+                    converted_files.append(path)
+                    images += 1
+                    before += len(data)
+        self.set_info('images', 'content')
+        self._deduplicated = True
+        self.commit()
+        
+        # the old copies are removed once the contents are committed
+        if self._segments:
+            self._segments.remove_kind(SegmentStore.IMAGE)
+        for path in converted_files:
+            os.remove(path)
+        self._remove_empty_dirs(converted_files)
+        
+        contents, after = self.db_conn.execute('SELECT COUNT(id), SUM(length) FROM content').fetchone()
+        return {'images': images, 'contents': contents, 'before': before, 'after': after or 0,
+                'reclaimed': before - (after or 0)}
+    
     def close(self):
         """ Closes the current DB connection. """
         
+        if self._segments:
+            self._segments.close()
+        self.writer.flush()
         self.db_conn.commit()
         self.db_conn.close()
             
@@ -0,0 +1,240 @@
+#!/usr/bin/env python
+'''
+Created on Nov 19, 2010
+
+Generates repositories with synthetic flickr pages, e.g. for benchmarks.
+
+    python synthetic.py [-n PAGES] [--seed SEED] [--packed] DIRECTORY
+
+'''
+
+import os, random, bisect, datetime
+
+from storage import Repository
+from lexicon import Lexicon
+
+# common words, used for tags and comments (most frequent first)
+WORDS = """sunset beach sky nature water sea blue clouds light night city travel
+summer landscape red green art portrait street flower dog cat people
+white black tree river bridge snow winter music love life home family
+friends party car train road building old new park garden lake
+mountain sun rain spring autumn fall color photo bird wedding baby
+girl boy woman man kids food church house window door wall reflection
+shadow sand rock forest field island boat harbor ocean wave surf
+festival concert band live stage market shop cafe coffee museum castle
+tower skyline downtown lights fireworks christmas halloween birthday
+graduation holiday vacation trip desert canyon valley hill cliff coast
+shore pier lighthouse sunrise morning evening dusk dawn fog mist storm
+lightning moon stars space macro closeup texture pattern abstract
+minimal urban rural farm horse cow sheep goat duck swan butterfly bee
+insect spider leaf leaves grass rose tulip daisy orchid yellow orange
+purple pink brown gray silver gold vintage retro film analog digital
+camera lens zoom wide angle bokeh fun happy smile face eyes hands hair
+dress fashion style model pose graffiti sign letters number clock time
+history memory dream fantasy magic dark bright soft hard cold warm hot
+wet dry
+""".split()
+
+STOP_WORDS = ('and', 'the', 'a', 'of', 'in')
+
+SEARCH_TAGS = ('sunset', 'beach', 'dog', 'city', 'flower')
+
+MONTHS = ('January', 'February', 'March', 'April', 'May', 'June', 'July',
+          'August', 'September', 'October', 'November', 'December')
+
+
+def _cumulative(n, exponent):
+    """ Cumulative weights of a Zipf distribution over <n> ranks. """
+
+    total, weights = 0., []
+    for rank in xrange(1, n + 1):
+        total += 1. / rank**exponent
+        weights.append(total)
+    return weights
+
+
+class PageGenerator(object):
+    """ Generates pages that look like the photo pages of flickr, as far as
+        the analyzers are concerned, with realistic distributions:
+
+        - tags: The number of tags per image is log-normal (some images have
+                none), the tags follow a Zipf distribution over WORDS and
+                rare tags built from them.
+        - comments: Many images have no comments, the number of comments of
+                    the others is exponential. The commenters follow a Zipf
+                    distribution.
+        - ratings: The number of favorites is Pareto distributed.
+
+        Every page contains filler markup (navigation, scripts, sets), so
+        its size is comparable to a real page.
+
+        INPUT:
+            - seed: Seed of the random generator.
+            - vocabulary: Number of different tags.
+            - users: Number of different commenters.
+            - filler: Number of entries in the navigation and set lists.
+    """
+
+    def __init__(self, seed=0, vocabulary=5000, users=2000, filler=100):
+        self.random = random.Random(seed)
+        words = list(WORDS)
+        self.terms = words + ['%s%i' % (words[i % len(words)], i) for i in xrange(max(vocabulary - len(words), 0))]
+        self._terms = _cumulative(len(self.terms), 1.1)
+        self._words = _cumulative(len(words), 1.)
+        self.users = users
+        self._users = _cumulative(users, 1.2)
+        self.filler = filler
+        r = self.random
+        self._images = ['\xff\xd8\xff\xe0' + ''.join(chr(r.randint(0, 255)) for _ in xrange(4000)) for _ in xrange(16)]
+        self._start = datetime.date(2005, 1, 1).toordinal()
+        self._end = datetime.date(2010, 10, 31).toordinal()
+
+    def _zipf(self, cumulative):
+        return bisect.bisect(cumulative, self.random.random() * cumulative[-1])
+
+    def tags(self, tag):
+        """ Tags of an image found by searching for <tag>. """
+
+        r = self.random
+        if r.random() < 0.15:
+            return [tag]
+        count = min(int(r.lognormvariate(1.6, 0.6)), 40)
+        tags = [tag] + [self.terms[self._zipf(self._terms)] for _ in xrange(count)]
+        # tags are shown the way the user typed them
+        return [t.capitalize() if r.random() < 0.2 else t for t in tags]
+
+    def comments(self):
+        """ Tuples (commenter, text, age) of the comments of an image. """
+
+        r = self.random
+        if r.random() < 0.4:
+            return []
+        comments = []
+        for _ in xrange(min(int(r.expovariate(1 / 4.)) + 1, 60)):
+            words = [WORDS[self._zipf(self._words)] for _ in xrange(r.randint(2, 25))]
+            if r.random() < 0.1:
+                words.append('tr\xc3\xa8s')
+            age = r.choice(('%i minutes' % r.randint(2, 59), '%i days' % r.randint(2, 30),
+                            '%i months' % r.randint(2, 11), '%i years' % r.randint(2, 5)))
+            comments.append(('user%i' % self._zipf(self._users), ' '.join(words), age))
+        return comments
+
+    def rating(self):
+        """ Number of people who marked the image as favorite. """
+
+        return min(int(self.random.paretovariate(1.1)) - 1, 50000)
+
+    def date(self):
+        d = datetime.date.fromordinal(self.random.randint(self._start, self._end))
+        return '%s %i, %i' % (MONTHS[d.month - 1], d.day, d.year)
+
+    def image(self):
+        """ Content of a thumbnail. """
+
+        return self.random.choice(self._images)
+
+    def page(self, id, tag):
+        """ Returns the HTML page of the image <id> found for <tag>. """
+
+        r = self.random
+        parts = ['<!DOCTYPE html PUBLIC "-//W3C//DTD XHTML 1.0 Transitional//EN" "http://www.w3.org/TR/xhtml1/DTD/xhtml1-transitional.dtd">\n'
+                 '<html><head><meta http-equiv="Content-Type" content="text/html; charset=utf-8" />'
+                 '<title>%s | Flickr - Photo Sharing!</title>' % tag,
+                 '<script type="text/javascript">var global_photo_id = %i; var F = {config: "%s"}; '
+                 'if (a < b && b > c) { F.init(); }</script></head>\n<body>' % (id, 'x' * (30 * self.filler)),
+                 '<div id="TopBar"><ul class="nav">']
+        parts.extend('<li class="menu"><a href="/explore/%i/" title="Explore %i">Explore &amp; more %i</a></li>' % (i, i, i)
+                     for i in xrange(self.filler))
+        parts.append('</ul></div>\n<div id="Main">')
+
+        parts.append('<div id="Photo"><div class="photoImgDiv"><img src="/photos/%i.jpg" alt="photo" width="500" height="375" /></div>'
+                     '<div class="Widget"><span>Taken on <a property="dc:date" href="/photos/archives/%i/">%s</a></span></div></div>\n'
+                     % (id, id, self.date()))
+
+        parts.append('<div id="thetags">')
+        for t in self.tags(tag):
+            parts.append('<div id="tagdiv%s"><a href="/photos/tags/%s/" class="Plain">%s</a> '
+                         '<a href="#" class="Grey" title="Remove this tag">[x]</a></div>' % (t.lower(), t.lower(), t))
+        parts.append('</div>\n')
+
+        rating = self.rating()
+        if rating:
+            parts.append('<p class="stats"><span id="fave_countSpan">{0:,} people</span> call this photo a favorite</p>\n'.format(rating))
+
+        parts.append('<div id="DiscussPhoto"><h3>Comments</h3>')
+        for i, (commenter, text, age) in enumerate(self.comments()):
+            parts.append('<div class="comment-block" id="comment%i"><h4><a href="/photos/%s/">%s</a> says:</h4>'
+                         '<div class="comment-content"><p>%s<br /><small>Posted <a href="#comment%i">%s ago</a> '
+                         '( <a href="#">permalink</a> )</small></p></div></div>\n' % (i, commenter, commenter, text, i, age))
+        parts.append('</div>\n<div id="Sidebar"><h3>This photo also belongs to:</h3>')
+        parts.extend('<div class="set"><img src="/sets/%i.jpg" alt="" /><p><a href="/sets/%i/">Set %i</a> (%i <b>photos</b>)</p></div>'
+                     % (i, i, i, r.randint(1, 500)) for i in xrange(self.filler))
+        parts.append('</div></div>\n<div id="Footer"><p>Copyright &copy; Yahoo! Inc.</p></div></body></html>')
+        return ''.join(parts)
+
+
+def generate(path, pages, tags=SEARCH_TAGS, seed=0, packed=False, compression=None, **kwargs):
+    """ Creates a repository with synthetic pages and thumbnails.
+
+        INPUT:
+            - path: Directory of the new repository.
+            - pages: Number of pages.
+            - tags: The tags the images are "fetched" for.
+            - seed: Seed of the random generator.
+            - packed: Create a packed repository.
+            - compression: Compression method for the pages.
+            - kwargs: Passed to PageGenerator.
+    """
+
+    generator = PageGenerator(seed, **kwargs)
+    rep = Repository(path, new=True, packed=packed, compression=compression)
+    id = 4000000000
+    for i in xrange(pages):
+        tag = tags[i % len(tags)]
+        id += generator.random.randint(1, 5000)
+        rep.add_site(tag, id, generator.page(id, tag))
+        rep.add_image(tag, id, generator.image())
+    rep.close()
+
+
+def write_lexicon(path):
+    """ Writes WORDS and STOP_WORDS as lexicon files into the directory
+        <path>, so the analyzers can work with synthetic repositories offline.
+
+        OUTPUT:
+            A Lexicon using these files.
+    """
+
+    if not os.path.exists(path):
+        os.makedirs(path)
+    words, stops = os.path.join(path, 'wordlist.txt'), os.path.join(path, 'stoplist.txt')
+    with open(words, 'w') as f:
+        f.write('\n'.join(WORDS))
+    with open(stops, 'w') as f:
+        f.write('\n'.join(STOP_WORDS))
+    return Lexicon(path, words, stops)
+
+
+def main():
+    from optparse import OptionParser
+
+    parser = OptionParser(usage="usage: %prog [options] DIRECTORY")
+    parser.add_option('-n', '--number', type='int', dest='number', default=1000,
+                      help='number of pages [default: %default]')
+    parser.add_option('--seed', type='int', dest='seed', default=0,
+                      help='seed of the random generator [default: %default]')
+    parser.add_option('--packed', action='store_true', dest='packed', default=False,
+                      help='create a packed repository')
+    parser.add_option('-z', '--compress', dest='compression',
+                      help='compress the pages with METHOD', metavar='METHOD')
+    (options, args) = parser.parse_args()
+
+    if len(args) != 1:
+        parser.error("A directory is required")
+    if os.path.exists(args[0]) and os.listdir(args[0]):
+        parser.error("The directory must be empty")
+    generate(args[0], options.number, seed=options.seed, packed=options.packed,
+             compression=options.compression)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+'''
+Created on Nov 15, 2010
+
+'''
+
+class BatchWriter(object):
+    """ Buffers rows per table and inserts them with "executemany" once
+        <batch_size> rows of a table are collected.
+
+        The buffered rows are only visible in the DB after "flush" was
+        called. Repository.commit does this before committing.
+
+        INPUT:
+            - db_conn: The DB connection to write to.
+            - batch_size: Number of rows per table that are buffered.
+
+        EXAMPLE:
+            writer.insert('images', ('id', 'tag'), (1234, 'sunset'))
+    """
+
+    def __init__(self, db_conn, batch_size=1000):
+        self.db_conn = db_conn
+        self.batch_size = batch_size
+        self._buffers = dict()
+
+    def _buffer(self, table, columns, verb):
+        key = (table, tuple(columns), verb)
+        if key not in self._buffers:
+            self._buffers[key] = list()
+        return key, self._buffers[key]
+
+    def insert(self, table, columns, row, verb='INSERT'):
+        """ Buffers a single row.
+
+            INPUT:
+                - table: The table to insert the row into.
+                - columns: The names of the columns of the row.
+                - row: A tuple of values.
+                - verb: The insert statement, e.g. 'INSERT OR IGNORE'.
+        """
+
+        key, buffer = self._buffer(table, columns, verb)
+        buffer.append(row)
+        if len(buffer) >= self.batch_size:
+            self._flush(key)
+
+    def insert_many(self, table, columns, rows, verb='INSERT'):
+        """ Buffers several rows (see "insert"). """
+
+        key, buffer = self._buffer(table, columns, verb)
+        buffer.extend(rows)
+        if len(buffer) >= self.batch_size:
+            self._flush(key)
+
+    def _flush(self, key):
+        table, columns, verb = key
+        rows = self._buffers[key]
+        if rows:
+            self.db_conn.executemany('%s INTO %s (%s) VALUES (%s)' % (verb, table, ', '.join(columns), ','.join('?' * len(columns))), rows)
+            del rows[:]
+
+    def flush(self):
+        """ Inserts all buffered rows. """
+
+        for key in self._buffers:
+            self._flush(key)
+
+    def discard(self):
+        """ Drops all buffered rows. """
+
+        self._buffers.clear()
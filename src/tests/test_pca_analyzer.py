@@ -0,0 +1,115 @@
+'''
+Created on Dec 2, 2010
+
+Run from the src directory:
+
+    python -m unittest discover -s tests -t .
+'''
+
+import os, shutil, tempfile, unittest
+import numpy as np
+
+from flickr_data_miner import lexicon, synthetic, settings
+from flickr_data_miner.storage import Repository
+from flickr_data_miner.analyzer import initialize_analyzers
+from flickr_data_miner.util import get_class
+from data_analyzer.pca_analyzer import PCAAnalyzer
+from data_analyzer.lsi import TDMBuilder, sp
+
+
+class DownloadedLexicon(lexicon.Lexicon):
+    """ A lexicon that "downloads" the synthetic words. """
+
+    def _download_words(self, amount):
+        self._words, self._fetched = list(synthetic.WORDS), lexicon.MAX_WORDS
+
+    def _download(self, url):
+        return '\n'.join(synthetic.STOP_WORDS)
+
+
+class OfflineLexicon(lexicon.Lexicon):
+    """ A lexicon that is neither cached nor can be downloaded. """
+
+    def _download_words(self, amount):
+        raise IOError('offline')
+
+    def _download(self, url):
+        raise IOError('offline')
+
+
+class PCACacheTest(unittest.TestCase):
+    """ Builds TDMs, reopens the repository and builds again from the
+        cached TDMs, as in a later session.
+    """
+
+    PAGES = 60
+    WORDS = 100
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp, 'repository')
+        lexicon.set_lexicon(synthetic.write_lexicon(os.path.join(self.tmp, 'lexicon')))
+        synthetic.generate(self.path, self.PAGES)
+        rep = Repository(self.path)
+        analyzers = [get_class(m)(rep) for m in settings.ANALYZERS]
+        initialize_analyzers(rep, [a for a in analyzers if a.TABLES])
+        rep.close()
+
+    def tearDown(self):
+        lexicon.set_lexicon(None)
+        shutil.rmtree(self.tmp)
+
+    def build(self, localw, globalw, backend=None):
+        rep = Repository(self.path)
+        try:
+            pca = PCAAnalyzer(rep)
+            pca.backend = backend
+            U = np.array(pca.build(self.WORDS, False, localw, globalw))
+            return U, pca.tdm
+        finally:
+            rep.close()
+
+    def test_reweight_cached_tdm(self):
+        backends = [TDMBuilder.BACKEND_DENSE, TDMBuilder.BACKEND_MEMMAP]
+        if sp is not None:
+            backends.append(TDMBuilder.BACKEND_SPARSE)
+        expected = None
+        for backend in backends:
+            shutil.rmtree(os.path.join(self.path, PCAAnalyzer.CACHE_DIR), True)
+            self.build(TDMBuilder.LOCAL_TERM_FREQUENCY, TDMBuilder.GLOBAL_BINARY, backend)
+            U, tdms = self.build(TDMBuilder.LOCAL_LOG, TDMBuilder.GLOBAL_ENTROPY)
+            self.assertEqual([entry[:-1] for entry in tdms], [(self.WORDS, False)])
+            if expected is None:
+                expected = U
+            # the signs of the components are arbitrary
+            self.assertTrue(np.allclose(np.abs(U), np.abs(expected)), backend)
+
+    def test_lexicon_change(self):
+        _, tdms = self.build(TDMBuilder.LOCAL_TERM_FREQUENCY, TDMBuilder.GLOBAL_BINARY)
+        before = tdms[0][-1].sum()
+        # the same TDM from a word list without the most used words
+        path = os.path.join(self.tmp, 'other')
+        os.makedirs(path)
+        with open(os.path.join(path, 'wordlist.txt'), 'w') as f:
+            f.write('\n'.join(synthetic.WORDS[20:]))
+        lexicon.set_lexicon(lexicon.Lexicon(path, os.path.join(path, 'wordlist.txt'),
+                                            os.path.join(self.tmp, 'lexicon', 'stoplist.txt')))
+        _, tdms = self.build(TDMBuilder.LOCAL_TERM_FREQUENCY, TDMBuilder.GLOBAL_BINARY)
+        self.assertNotEqual(tdms[0][-1].sum(), before)
+
+    def test_reweight_offline(self):
+        lexicon.set_lexicon(DownloadedLexicon(os.path.join(self.tmp, 'downloaded')))
+        self.build(TDMBuilder.LOCAL_TERM_FREQUENCY, TDMBuilder.GLOBAL_BINARY)
+        lexicon.set_lexicon(OfflineLexicon(os.path.join(self.tmp, 'offline')))
+        U, _ = self.build(TDMBuilder.LOCAL_LOG, TDMBuilder.GLOBAL_NORMAL)
+        self.assertEqual(U.shape[1], self.PAGES)
+        # a new TDM needs the lexicon
+        rep = Repository(self.path)
+        try:
+            self.assertRaises(Exception, PCAAnalyzer(rep).build, self.WORDS + 1)
+        finally:
+            rep.close()
+
+
+if __name__ == '__main__':
+    unittest.main()